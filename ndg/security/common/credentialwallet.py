@@ -14,10 +14,21 @@ log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
 import os
+import sys
+import gc
 import warnings
+import heapq
+import threading
+import calendar
+import hashlib
+import sqlite3
+from array import array
+from itertools import count
+from collections import OrderedDict
 
 # Check Attribute Certificate validity times
 from datetime import datetime, timedelta
+from time import time
 
 from ConfigParser import ConfigParser
 
@@ -31,9 +42,18 @@ except ImportError:
 from ndg.saml.utils import SAMLDateTime
 from ndg.saml.saml2.core import Assertion
 
-from ndg.security.common.utils import TypedList
+from ndg.security.common.config import importElementTree
+ElementTree = importElementTree()
+
+from ndg.security.common.utils import TypedList, str2Bool
+from ndg.security.common.utils.etree import canonicalize
+from ndg.security.common.saml_utils.esgf import (ESGFGroupRoleAttributeValue,
+                                                 ESGFAttributeIndex)
+from ndg.security.common.saml_utils.esgf.xml.etree import (
+                                                    ESGFAssertionElementTree,)
 from ndg.security.common.utils.configfileparsers import (     
-                                                    CaseSensitiveConfigParser,)
+                                                    CaseSensitiveConfigParser,
+                                                    readAndValidateProperties)
 
 
 class _CredentialWalletException(Exception):    
@@ -140,17 +160,558 @@ class CredentialContainer(object):
                 setattr(self, attr, val)
         except Exception, e:
             pass
-       
+
+
+class CredentialExpiryIndex(object):
+    """Expiry ordered index of credentials held in a wallet.  Credentials are
+    held in a heap keyed by their expiry time so that those which have expired
+    can be found without scanning every credential in the wallet.
+
+    Entries are invalidated lazily: replacing or removing the credentials for
+    a given key increments a serial number for that key so that superseded
+    heap entries are discarded as they reach the top of the heap.  The heap is
+    rebuilt if superseded entries come to outnumber current ones.
+    """
+    __slots__ = ("__heap", "__keys", "__nEntries", "__sequence")
+
+    def __init__(self):
+        self.__heap = []
+
+        # Map of key to a (serial number, number of live heap entries) pair
+        self.__keys = {}
+        self.__nEntries = 0
+
+        # Tie breaker for entries with equal expiry times so that the
+        # credentials themselves are never compared
+        self.__sequence = count()
+
+    def __len__(self):
+        return self.__nEntries
+
+    def add(self, key, entries):
+        """Index credentials for the given key.  Any existing entries for the
+        key are superseded
+
+        @type key: basestring
+        @param key: key to credentials in the wallet
+        @type entries: iterable
+        @param entries: sequence of (expiry time, credential) tuples
+        """
+        serial = self._invalidate(key)
+        nEntries = 0
+        for expiry, credential in entries:
+            heapq.heappush(self.__heap, (expiry, self.__sequence.next(), key,
+                                         serial, credential))
+            nEntries += 1
+
+        self.__keys[key] = (serial, nEntries)
+        self.__nEntries += nEntries
+        self._prune()
+
+    def remove(self, key):
+        """Remove entries for the given key
+
+        @type key: basestring
+        @param key: key to credentials in the wallet
+        """
+        self._invalidate(key)
+        self._prune()
+
+    def clear(self):
+        """Remove all entries"""
+        self.__heap = []
+        self.__keys.clear()
+        self.__nEntries = 0
+
+    def popExpired(self, cutoff):
+        """Remove and return entries with an expiry time on or before the
+        cutoff
+
+        @type cutoff: datetime
+        @param cutoff: time on or before which entries are deemed to have
+        expired
+        @rtype: list
+        @return: list of (key, credential) tuples for the expired entries
+        """
+        expired = []
+        heap = self.__heap
+        while heap and heap[0][0] <= cutoff:
+            key, serial, credential = heapq.heappop(heap)[2:]
+            keySerial, nEntries = self.__keys.get(key, (None, 0))
+            if serial != keySerial:
+                # Superseded entry
+                continue
+
+            self.__keys[key] = (keySerial, nEntries - 1)
+            self.__nEntries -= 1
+            expired.append((key, credential))
+
+        self._prune()
+        return expired
+
+    def _getNextExpiry(self):
+        if self.__heap:
+            return self.__heap[0][0]
+        else:
+            return None
+
+    nextExpiry = property(_getNextExpiry,
+                          doc="Earliest expiry time of the indexed entries or "
+                              "None if there are no entries")
+
+    def _invalidate(self, key):
+        """Mark existing heap entries for a key as superseded returning the
+        key's last serial number"""
+        serial, nEntries = self.__keys.get(key, (0, 0))
+        self.__nEntries -= nEntries
+
+        # Keep the serial number so that superseded entries can't be confused
+        # with any entries subsequently added for the same key
+        self.__keys[key] = (serial + 1, 0)
+        return serial + 1
+
+    def _prune(self):
+        """Discard superseded entries from the top of the heap so that
+        nextExpiry reflects a current entry, rebuilding the heap altogether if
+        superseded entries outnumber current ones"""
+        heap = self.__heap
+        keys = self.__keys
+        if len(heap) > 2*self.__nEntries + 16:
+            self.__heap = heap = [entry for entry in heap
+                                  if keys[entry[2]][0] == entry[3]]
+            heapq.heapify(heap)
+            for key, (serial, nEntries) in keys.items():
+                if nEntries == 0:
+                    del keys[key]
+
+        while heap and heap[0][3] != keys[heap[0][2]][0]:
+            heapq.heappop(heap)
+
+
+def _parseClockSkewTolerance(value):
+    """Convert a clock skew tolerance setting to a timedelta
+
+    @type value: timedelta, float, int, long or basestring
+    @param value: tolerance as a timedelta or a number of seconds
+    @rtype: timedelta
+    @return: clock skew tolerance
+    """
+    if isinstance(value, (float, int, long)):
+        return timedelta(seconds=value)
+
+    elif isinstance(value, basestring):
+        return timedelta(seconds=float(value))
+
+    elif isinstance(value, timedelta):
+        return value
+
+    else:
+        raise TypeError('Expecting timedelta, float, int, long or string '
+                        'type for "clockSkewTolerance"; got %r' % type(value))
+
+
+def _toEpoch(dt):
+    """Convert a UTC datetime to seconds since the epoch
+    
+    @type dt: datetime
+    @param dt: UTC time
+    @rtype: float
+    @return: seconds since the epoch
+    """
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond * 1e-6
+
+
+def _timedeltaSeconds(td):
+    """Convert a timedelta to seconds
+    
+    @type td: timedelta
+    @param td: time interval
+    @rtype: float
+    @return: interval in seconds
+    """
+    return td.days * 86400. + td.seconds + td.microseconds * 1e-6
+
+
+def _getDeepSize(obj):
+    """Estimate the memory used by an object and everything it references.
+    Types and modules are not followed so that class level attributes are not
+    counted
+
+    @param obj: object to size
+    @rtype: int
+    @return: estimated size in bytes
+    """
+    seen = set()
+    size = 0
+    pending = [obj]
+    while pending:
+        _obj = pending.pop()
+        if id(_obj) in seen or isinstance(_obj, (type, type(sys))):
+            continue
+
+        seen.add(id(_obj))
+        size += sys.getsizeof(_obj)
+        pending.extend(gc.get_referents(_obj))
+
+    return size
+
+
+_INFINITY = float('inf')
+
+# Fields of packed assertion tuples - see _packAssertion
+PACKED_NOT_BEFORE_IDX, PACKED_NOT_ON_OR_AFTER_IDX, PACKED_DATA_IDX = range(3)
+
+
+def _packAssertion(assertion):
+    """Pack an assertion into a compact form for pickling.  The assertion is
+    serialised as XML unless it contains content which can't be serialised, 
+    in which case the assertion object itself is held.
+
+    @type assertion: ndg.saml.saml2.core.Assertion
+    @param assertion: assertion to pack
+    @rtype: tuple
+    @return: (not before, not on or after, XML string or assertion) tuple
+    """
+    conditions = assertion.conditions
+    if conditions is None:
+        notBefore = notOnOrAfter = None
+    else:
+        notBefore = conditions.notBefore
+        notOnOrAfter = conditions.notOnOrAfter
+        
+    try:
+        data = ElementTree.tostring(ESGFAssertionElementTree.toXML(assertion))
+        
+    except Exception, e:
+        log.debug("Error serialising assertion %r for packing, holding the "
+                  "assertion object instead: %s", assertion.id, e)
+        data = assertion
+    
+    return (notBefore, notOnOrAfter, data)
+
+
+def _unpackAssertion(packedAssertion):
+    """Rebuild an assertion from its packed form
+    
+    @type packedAssertion: tuple
+    @param packedAssertion: packed assertion - see _packAssertion
+    @rtype: ndg.saml.saml2.core.Assertion
+    @return: assertion
+    """
+    data = packedAssertion[PACKED_DATA_IDX]
+    if isinstance(data, Assertion):
+        return data
+    
+    return ESGFAssertionElementTree.fromXML(ElementTree.fromstring(data))
+
+
+def _setAttributesFromConfig(obj, cfg, prefix='', section='DEFAULT'):
+    '''Set attributes of an object from the options in the given config file 
+    section
+    @type obj: object
+    @param obj: object to set attributes of
+    @type cfg: basestring /ConfigParser derived type
+    @param cfg: configuration file path or ConfigParser type object
+    @type prefix: basestring
+    @param prefix: prefix for option names e.g. "certExtApp."
+    @type section: baestring
+    @param section: configuration file section from which to extract
+    parameters.
+    '''
+    if isinstance(cfg, basestring):
+        cfgFilePath = os.path.expandvars(cfg)
+        _cfg = CaseSensitiveConfigParser()
+        _cfg.read(cfgFilePath)
+        
+    elif isinstance(cfg, ConfigParser):
+        _cfg = cfg   
+    else:
+        raise AttributeError('Expecting basestring or ConfigParser type '
+                             'for "cfg" attribute; got %r type' % type(cfg))
+    
+    prefixLen = len(prefix)
+    for optName, val in _cfg.items(section):
+        if prefix and optName.startswith(prefix):
+            optName = optName[prefixLen:]
+            
+        setattr(obj, optName, val)
+
+
+class _DigestWriter(object):
+    """Sink for canonicalize which hashes output as it's written rather than
+    holding it"""
+    __slots__ = ("hash", "size")
+    
+    def __init__(self, digestAlgorithm):
+        self.hash = hashlib.new(digestAlgorithm)
+        self.size = 0
+        
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        
+        
+class SAMLAssertionDigestCache(object):
+    """Process wide cache of digests of canonicalised SAML assertions so 
+    that re-signing or forwarding the same assertion doesn't repeat 
+    canonicalization and hashing.  Entries are keyed by assertion ID and 
+    issuer - see makeKey - which SAML requires to identify an assertion
+    uniquely.  The content of an assertion with a cached entry is not 
+    re-read so getDigest must only be used for trusted assertions such as
+    those held in a wallet.  Use checkDigest to verify other assertions.
+    
+    Entries are removed once their assertion's notOnOrAfter time has passed
+    and the least recently used ones are evicted when the number of entries
+    exceeds maxEntries.  Access is serialised with a lock so that an 
+    instance can be shared between threads.
+    """
+    DEFAULT_MAX_ENTRIES = 4096
+    DEFAULT_DIGEST_ALGORITHM = 'sha1'
+    
+    CONFIG_FILE_OPTNAMES = ("maxEntries", "digestAlgorithm", "exclusive")
+    
+    # Fields of each cache entry
+    DIGEST_IDX, SIZE_IDX, NOT_ON_OR_AFTER_IDX = range(3)
+    
+    __slots__ = ("__maxEntries", "__digestAlgorithm", "__exclusive", 
+                 "__entries", "__expiryIndex", "__lock")
+    
+    def __init__(self):
+        self.__maxEntries = SAMLAssertionDigestCache.DEFAULT_MAX_ENTRIES
+        self.__digestAlgorithm = \
+            SAMLAssertionDigestCache.DEFAULT_DIGEST_ALGORITHM
+        self.__exclusive = True
+        self.__lock = threading.RLock()
+        self.clear()
+        
+    @classmethod
+    def fromConfig(cls, cfg, **kw):
+        '''Alternative constructor makes object from config file settings
+        @type cfg: basestring /ConfigParser derived type
+        @param cfg: configuration file path or ConfigParser type object
+        @rtype: SAMLAssertionDigestCache
+        @return: new instance of this class
+        '''
+        digestCache = cls()
+        digestCache.parseConfig(cfg, **kw)
+        
+        return digestCache
+    
+    def parseConfig(self, cfg, prefix='', section='DEFAULT'):
+        '''Read config file settings
+        @type cfg: basestring /ConfigParser derived type
+        @param cfg: configuration file path or ConfigParser type object
+        @type prefix: basestring
+        @param prefix: prefix for option names e.g. "certExtApp."
+        @type section: baestring
+        @param section: configuration file section from which to extract
+        parameters.
+        '''  
+        _setAttributesFromConfig(self, cfg, prefix=prefix, section=section)
+        
+    @staticmethod
+    def makeKey(assertion):
+        """Make a cache key for an assertion
+        
+        @type assertion: ndg.saml.saml2.core.Assertion
+        @param assertion: SAML assertion
+        @rtype: tuple
+        @return: (assertion ID, issuer) key
+        """
+        issuer = assertion.issuer
+        return (assertion.id, issuer.value if issuer is not None else None)
+        
+    def _getMaxEntries(self):
+        return self.__maxEntries
+
+    def _setMaxEntries(self, value):
+        if isinstance(value, basestring):
+            value = int(value)
+            
+        elif not isinstance(value, (int, long)):
+            raise TypeError('Expecting int, long or string type for '
+                            '"maxEntries"; got %r' % type(value))
+        
+        if value < 1:
+            raise ValueError('"maxEntries" must be greater than zero; got %r' %
+                             value)
+        with self.__lock:
+            self.__maxEntries = value
+            self._evict()
+
+    maxEntries = property(_getMaxEntries, _setMaxEntries,
+                          doc="Maximum number of entries held")
+    
+    def _getDigestAlgorithm(self):
+        return self.__digestAlgorithm
+
+    def _setDigestAlgorithm(self, value):
+        if not isinstance(value, basestring):
+            raise TypeError('Expecting string type for "digestAlgorithm"; '
+                            'got %r' % type(value))
+        
+        # Check the algorithm is supported
+        hashlib.new(value)
+        with self.__lock:
+            self.__digestAlgorithm = value
+            self.clear()
+
+    digestAlgorithm = property(_getDigestAlgorithm, _setDigestAlgorithm,
+                               doc="hashlib name of the digest algorithm.  "
+                                   "Changing it clears the cache")
+    
+    def _getExclusive(self):
+        return self.__exclusive
+
+    def _setExclusive(self, value):
+        if isinstance(value, basestring):
+            value = str2Bool(value)
+            
+        elif not isinstance(value, bool):
+            raise TypeError('Expecting bool or string type for "exclusive"; '
+                            'got %r' % type(value))
+        with self.__lock:
+            self.__exclusive = value
+            self.clear()
+
+    exclusive = property(_getExclusive, _setExclusive,
+                         doc="Set to True to digest Exclusive XML "
+                             "Canonicalization output.  Changing it clears "
+                             "the cache")
+    
+    def __len__(self):
+        return len(self.__entries)
+    
+    def clear(self):
+        """Remove all entries"""
+        with self.__lock:
+            # Entries ordered from least to most recently used
+            self.__entries = OrderedDict()
+            self.__expiryIndex = CredentialExpiryIndex()
+    
+    def getDigest(self, assertion):
+        """Get the digest of an assertion's canonical form canonicalising 
+        and hashing it only if a current entry isn't held.  A cached digest
+        is returned for any assertion with the same ID and issuer whatever 
+        its content so only pass assertions which are trusted not to have 
+        been altered e.g. those held in a wallet
+        
+        @type assertion: ndg.saml.saml2.core.Assertion
+        @param assertion: SAML assertion
+        @rtype: tuple
+        @return: (digest, size in bytes of the canonical form)
+        """
+        key = self.makeKey(assertion)
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                notOnOrAfter = entry[
+                            SAMLAssertionDigestCache.NOT_ON_OR_AFTER_IDX]
+                if notOnOrAfter is None or datetime.utcnow() < notOnOrAfter:
+                    # Mark as most recently used
+                    del self.__entries[key]
+                    self.__entries[key] = entry
+                    return entry[:SAMLAssertionDigestCache.SIZE_IDX + 1]
+                
+                self._remove(key)
+            
+            digestAlgorithm = self.__digestAlgorithm
+            exclusive = self.__exclusive
+            
+        # Canonicalise outside of the lock
+        digest, size = self._makeDigest(assertion, digestAlgorithm, exclusive)
+        
+        notOnOrAfter = None
+        if assertion.conditions is not None:
+            notOnOrAfter = assertion.conditions.notOnOrAfter
+            
+        with self.__lock:
+            # Discard the result if the settings changed in the meantime
+            if (digestAlgorithm == self.__digestAlgorithm and 
+                exclusive == self.__exclusive):
+                self._remove(key)
+                self.__entries[key] = (digest, size, notOnOrAfter)
+                if notOnOrAfter is not None:
+                    self.__expiryIndex.add(key, [(notOnOrAfter, None)])
+                    
+                self._removeExpired()
+                self._evict()
+            
+        return digest, size
+    
+    def checkDigest(self, assertion, digest):
+        """Check an assertion against a digest of its canonical form.  The
+        assertion is always canonicalised and hashed - cached entries aren't
+        used - so that an altered assertion can't match
+        
+        @type assertion: ndg.saml.saml2.core.Assertion
+        @param assertion: SAML assertion
+        @type digest: basestring
+        @param digest: expected digest
+        @rtype: bool
+        @return: True if the digests match
+        """
+        with self.__lock:
+            digestAlgorithm = self.__digestAlgorithm
+            exclusive = self.__exclusive
+            
+        return self._makeDigest(assertion, digestAlgorithm, exclusive)[
+                                SAMLAssertionDigestCache.DIGEST_IDX] == digest
+    
+    @staticmethod
+    def _makeDigest(assertion, digestAlgorithm, exclusive):
+        """Canonicalise an assertion writing straight to the hash
+        
+        @rtype: tuple
+        @return: (digest, size in bytes of the canonical form)
+        """
+        digestWriter = _DigestWriter(digestAlgorithm)
+        canonicalize(ESGFAssertionElementTree.toXML(assertion), 
+                     sink=digestWriter, exclusive=exclusive)
+        return digestWriter.hash.digest(), digestWriter.size
+    
+    def audit(self):
+        """Remove expired entries"""
+        with self.__lock:
+            self._removeExpired()
+            
+    def _remove(self, key):
+        """Remove entry for the given key if present.  The lock must be held
+        """
+        if self.__entries.pop(key, None) is not None:
+            self.__expiryIndex.remove(key)
+            
+    def _removeExpired(self):
+        """Remove expired entries.  The lock must be held"""
+        for key, _ in self.__expiryIndex.popExpired(datetime.utcnow()):
+            self.__entries.pop(key, None)
+            
+    def _evict(self):
+        """Evict the least recently used entries to keep within maxEntries.
+        The lock must be held"""
+        while len(self.__entries) > self.__maxEntries:
+            key = next(iter(self.__entries))
+            self._remove(key)
+
 
 class CredentialWalletBase(object):
     """Abstract base class for Credential Wallet implementations
+    
+    Changes to a wallet's content or settings increment its generation 
+    number.  Session middleware can use isDirty to skip saving a wallet which
+    hasn't changed since it was loaded or last saved.
     """ 
     CONFIG_FILE_OPTNAMES = ("userId", )
     __metaclass__ = ABCMeta
-    __slots__ = ("__userId", )
+    __PICKLED_ATTRNAMES = ("__userId", "__generation")
+    __slots__ = __PICKLED_ATTRNAMES + ("__cleanGeneration", 
+                                       "__credentialRepository")
     
     def __init__(self):
         self.__userId = None
+        self.__generation = 0
+        self.__cleanGeneration = 0
+        self.__credentialRepository = None
 
     @classmethod
     def fromConfig(cls, cfg, **kw):
@@ -177,6 +738,19 @@ class CredentialWalletBase(object):
         '''
         raise NotImplementedError(CredentialWalletBase.parseConfig.__doc__)
 
+    def _setOptionsFromConfig(self, cfg, prefix='', section='DEFAULT'):
+        '''Helper for parseConfig implementations - set attributes from the
+        options in the given config file section
+        @type cfg: basestring /ConfigParser derived type
+        @param cfg: configuration file path or ConfigParser type object
+        @type prefix: basestring
+        @param prefix: prefix for option names e.g. "certExtApp."
+        @type section: baestring
+        @param section: configuration file section from which to extract
+        parameters.
+        '''
+        _setAttributesFromConfig(self, cfg, prefix=prefix, section=section)
+
     @abstractmethod
     def addCredentials(self, key, credentials):
         """Add a new credential to the list of credentials held.
@@ -222,14 +796,58 @@ class CredentialWalletBase(object):
             raise TypeError('Expecting string type for "userId"; got %r '
                             'instead' % type(value))
         self.__userId = value
+        self._incrGeneration()
 
     userId = property(_getUserId, _setUserId, 
                       doc="User Identity for this wallet")
+    
+    def _getCredentialRepository(self):
+        return self.__credentialRepository
+
+    def _setCredentialRepository(self, value):
+        if not isinstance(value, (CredentialRepository, type(None))):
+            raise TypeError('Expecting %r or None type for '
+                            '"credentialRepository"; got %r instead' % 
+                            (CredentialRepository, type(value)))
+        self.__credentialRepository = value
+
+    credentialRepository = property(_getCredentialRepository, 
+                                    _setCredentialRepository, 
+                                    doc="Repository for persistent storage of "
+                                        "credentials.  This is not pickled "
+                                        "with the wallet and must be reset "
+                                        "after unpickling")
+    
+    def _getGeneration(self):
+        return self.__generation
+    
+    generation = property(_getGeneration,
+                          doc="Generation number incremented each time the "
+                              "wallet is changed.  It is preserved on "
+                              "pickling and so can be used to validate "
+                              "copies of the wallet's content")
+    
+    def _incrGeneration(self):
+        """Record a change to the wallet"""
+        self.__generation += 1
+        
+    def isDirty(self):
+        """Check whether the wallet has changed since it was created, 
+        unpickled or last marked clean
+        
+        @rtype: bool
+        @return: True if the wallet has changed
+        """
+        return self.__generation != self.__cleanGeneration
+    
+    def markClean(self):
+        """Mark the wallet as unchanged e.g. after saving it to a session"""
+        self.__cleanGeneration = self.__generation
 
     def __getstate__(self):
         '''Enable pickling for use with beaker.session'''
         _dict = {}
-        for attrName in CredentialWalletBase.__slots__:
+        for attrName in CredentialWalletBase.__PICKLED_ATTRNAMES:
             # Ugly hack to allow for derived classes setting private member
             # variables
             if attrName.startswith('__'):
@@ -240,40 +858,114 @@ class CredentialWalletBase(object):
         return _dict
   
     def __setstate__(self, attrDict):
-        '''Enable pickling for use with beaker.session'''
+        '''Enable pickling for use with beaker.session.  The unpickled 
+        wallet is clean'''
+        self.__generation = 0
+        self.__credentialRepository = None
         for attrName, val in attrDict.items():
             setattr(self, attrName, val)
+        
+        self.markClean()
 
 
 class SAMLAssertionWallet(CredentialWalletBase):
     """Wallet for Earth System Grid supporting caching of SAML Assertions
+    
+    When pickled, assertions are saved in a compact packed form as XML 
+    together with their validity times.  On unpickling, the assertions for a
+    given key are rebuilt the first time they are accessed.  audit checks 
+    assertions which have not been rebuilt using their packed validity times.
+    Packed assertions are re-used when pickling again only for keys whose 
+    assertions have not been rebuilt.  Once rebuilt, assertions may be 
+    altered in place by the caller and so are always re-packed.
     """
     CONFIG_FILE_OPTNAMES = CredentialWalletBase.CONFIG_FILE_OPTNAMES + (
-                           "clockSkewTolerance", )
-    __slots__ = ("__clockSkewTolerance", "__assertionsMap")
+                           "clockSkewTolerance", "auditOnRetrieve")
+    
+    # Reasons for rejecting assertions reported by addCredentialsBatch
+    INVALID_TYPE_REASON = "invalid type"
+    NO_CONDITIONS_REASON = "no validity conditions"
+    NOT_YET_VALID_REASON = "not yet valid"
+    EXPIRED_REASON = "expired"
+    
+    # Pickled state format version.  State from earlier versions holds the 
+    # assertion objects themselves and has no version number
+    STATE_VERSION = 2
+    STATE_VERSION_KEY = 'stateVersion'
+    PACKED_ASSERTIONS_KEY = 'packedAssertions'
+    
+    # Digest cache shared by wallets for which one hasn't been set
+    DEFAULT_DIGEST_CACHE = SAMLAssertionDigestCache()
+
+    # Attributes saved when pickling.  Assertions are saved separately in 
+    # packed form and the expiry index is rebuilt on unpickling
+    __PICKLED_ATTRNAMES = ("__clockSkewTolerance", "__auditOnRetrieve")
+    __slots__ = __PICKLED_ATTRNAMES + (
+        "__assertionsMap", 
+        "__packedAssertionsMap", 
+        "__expiryIndex", 
+        "__notYetValidKeys",
+        "__validityBounds",
+        "__attributeIndex",
+        "__indexedAssertions",
+        "__digestCache"
+    )
 
     def __init__(self):
         super(SAMLAssertionWallet, self).__init__()
         self.__clockSkewTolerance = timedelta(seconds=0.)
+        self.__auditOnRetrieve = False
+        self.__digestCache = None
+        self._initAssertions()
+        
+    def _initAssertions(self):
+        """Initialise assertion storage"""
         self.__assertionsMap = {}
-    
+        
+        # Map of key to packed assertions for keys whose assertions have yet
+        # to be rebuilt following unpickling
+        self.__packedAssertionsMap = {}
+        self.__expiryIndex = CredentialExpiryIndex()
+
+        # Keys for assertions which were not yet valid when added.  audit
+        # checks these in full as the expiry index covers notOnOrAfter only
+        self.__notYetValidKeys = set()
+        
+        # Map of key to an array of validity bounds for the assertions held -
+        # (notBefore - clock skew tolerance, notOnOrAfter + clock skew 
+        # tolerance) pairs as seconds since the epoch in the same order as
+        # the assertions.  These allow validity to be checked with two float
+        # comparisons
+        self.__validityBounds = {}
+        
+        # Index of attribute values to the assertions carrying them.  It's
+        # built when first accessed and then updated for each key whose 
+        # assertions change.  The assertions indexed for each key are kept so
+        # that they can be removed from the index
+        self.__attributeIndex = None
+        self.__indexedAssertions = {}
+
     def _getClockSkewTolerance(self):
         return self.__clockSkewTolerance
 
     def _setClockSkewTolerance(self, value):
-        if isinstance(value, (float, int, long)):
-            self.__clockSkewTolerance = timedelta(seconds=value)
-            
-        elif isinstance(value, basestring):
-            self.__clockSkewTolerance = timedelta(seconds=float(value))
-            
-        elif isinstance(value, timedelta):
-            self.__clockSkewTolerance = value
-            
-        else:
-            raise TypeError('Expecting timedelta, float, int, long or string '
-                            'type for "clockSkewTolerance"; got %r' % 
-                            type(value))
+        clockSkewTolerance = _parseClockSkewTolerance(value)
+
+        # A reduced tolerance may render assertions not yet valid
+        if clockSkewTolerance < self.__clockSkewTolerance:
+            self.__notYetValidKeys.update(self._keys())
+        
+        # Widen or narrow the validity bounds by the change in tolerance
+        delta = _timedeltaSeconds(clockSkewTolerance - 
+                                  self.__clockSkewTolerance)
+        if delta:
+            for bounds in self.__validityBounds.values():
+                for i in xrange(0, len(bounds), 2):
+                    bounds[i] -= delta
+                    bounds[i + 1] += delta
+
+        self.__clockSkewTolerance = clockSkewTolerance
+        self._incrGeneration()
 
     clockSkewTolerance = property(_getClockSkewTolerance, 
                                   _setClockSkewTolerance, 
@@ -282,6 +974,31 @@ class SAMLAssertionWallet(CredentialWalletBase):
                                       "notBeforeTime - tolerance < now < "
                                       "notAfterTime + tolerance")
 
+    def _getAuditOnRetrieve(self):
+        return self.__auditOnRetrieve
+
+    def _setAuditOnRetrieve(self, value):
+        if isinstance(value, bool):
+            self.__auditOnRetrieve = value
+
+        elif isinstance(value, basestring):
+            self.__auditOnRetrieve = str2Bool(value)
+
+        else:
+            raise TypeError('Expecting bool or string type for '
+                            '"auditOnRetrieve"; got %r' % type(value))
+        
+        self._incrGeneration()
+
+    auditOnRetrieve = property(_getAuditOnRetrieve,
+                               _setAuditOnRetrieve,
+                               doc="Set to True to remove expired or not yet "
+                                   "valid assertions for a given key when "
+                                   "they are retrieved with "
+                                   "retrieveCredentials.  This avoids the "
+                                   "need to audit the whole wallet before "
+                                   "each retrieval")
+
     def parseConfig(self, cfg, prefix='', section='DEFAULT'):
         '''Read config file settings
         @type cfg: basestring /ConfigParser derived type
@@ -292,23 +1009,7 @@ class SAMLAssertionWallet(CredentialWalletBase):
         @param section: configuration file section from which to extract
         parameters.
         '''  
-        if isinstance(cfg, basestring):
-            cfgFilePath = os.path.expandvars(cfg)
-            _cfg = CaseSensitiveConfigParser()
-            _cfg.read(cfgFilePath)
-            
-        elif isinstance(cfg, ConfigParser):
-            _cfg = cfg   
-        else:
-            raise AttributeError('Expecting basestring or ConfigParser type '
-                                 'for "cfg" attribute; got %r type' % type(cfg))
-        
-        prefixLen = len(prefix)
-        for optName, val in _cfg.items(section):
-            if prefix and optName.startswith(prefix):
-                optName = optName[prefixLen:]
-                
-            setattr(self, optName, val)
+        self._setOptionsFromConfig(cfg, prefix=prefix, section=section)
          
     def addCredentials(self, key, assertions, verifyCredentials=True):
         """Add a new assertion to the list of assertion credentials held.
@@ -319,88 +1020,1303 @@ class SAMLAssertionWallet(CredentialWalletBase):
         @param key: key by which these credentials should be referred to
         @type verifyCredential: bool
         @param verifyCredential: if set to True, test validity of credential
-        by calling isValidCredential method.
+        against the current time allowing for the clock skew tolerance
         """        
         for assertion in assertions:
             if not isinstance(assertion, Assertion):
                 raise TypeError("Input credentials must be %r type; got %r" %
                                 (Assertion, assertion))
+        
+        # The validity bounds are checked against a single clock reading and
+        # then re-used for indexing
+        validityTimes = self._getValidityTimes(assertions)
+        bounds = self._makeValidityBounds(validityTimes)
+        if verifyCredentials:
+            now = time()
+            for i, assertion in enumerate(assertions):
+                if assertion.conditions is None:
+                    raise CredentialWalletError("No validity conditions set "
+                                                "for assertion %r" % assertion)
+                    
+                if not bounds[2*i] <= now < bounds[2*i + 1]:
+                    # Log the reason
+                    self.isValidCredential(assertion)
+                    raise CredentialWalletError("Validity time error with "
+                                                "assertion %r" % assertion)
+        
+        self._setCredentials(key, assertions, bounds=bounds)
+        
+    def addCredentialsBatch(self, credentials, verifyCredentials=True):
+        """Add assertions for many keys at once e.g. when loading a wallet 
+        from a credential repository.  Unlike addCredentials, invalid 
+        assertions are skipped and reported rather than raising an exception.
+        All validity checks are made against a single reading of the clock.
+        
+        @type credentials: dict / iterable
+        @param credentials: dict of lists of assertions keyed by credential 
+        key or iterable of (key, assertions) tuples.  For each key with valid
+        assertions, any existing assertions are overwritten
+        @type verifyCredentials: bool
+        @param verifyCredentials: if set to True, reject assertions which are
+        not valid at the current time
+        @rtype: dict
+        @return: lists of (assertion, reason) tuples for rejected assertions 
+        keyed by credential key.  reason is one of INVALID_TYPE_REASON, 
+        NO_CONDITIONS_REASON, NOT_YET_VALID_REASON or EXPIRED_REASON
+        """
+        if hasattr(credentials, 'items'):
+            credentials = credentials.items()
+            
+        utcNow = datetime.utcnow()
+        now = _toEpoch(utcNow)
+        
+        rejected = {}
+        for key, assertions in credentials:
+            # (assertion, reason) pairs in input order.  reason is None for 
+            # assertions which pass the checks made so far
+            checkedAssertions = []
+            candidates = []
+            for assertion in assertions:
+                if not isinstance(assertion, Assertion):
+                    reason = SAMLAssertionWallet.INVALID_TYPE_REASON
+                    
+                elif verifyCredentials and (
+                                assertion.conditions is None or 
+                                assertion.conditions.notBefore is None or
+                                assertion.conditions.notOnOrAfter is None):
+                    reason = SAMLAssertionWallet.NO_CONDITIONS_REASON
+                else:
+                    reason = None
+                    candidates.append(assertion)
+                    
+                checkedAssertions.append((assertion, reason))
+            
+            # The validity bounds are calculated once for each key and then 
+            # re-used for indexing
+            bounds = self._makeValidityBounds(
+                                        self._getValidityTimes(candidates))
+            if verifyCredentials:
+                candidateReasons = []
+                validBounds = array('d')
+                for i in xrange(len(candidates)):
+                    notBefore, notOnOrAfter = bounds[2*i:2*i + 2]
+                    if now < notBefore:
+                        candidateReasons.append(
+                                    SAMLAssertionWallet.NOT_YET_VALID_REASON)
+                    elif now >= notOnOrAfter:
+                        candidateReasons.append(
+                                    SAMLAssertionWallet.EXPIRED_REASON)
+                    else:
+                        candidateReasons.append(None)
+                        validBounds.extend((notBefore, notOnOrAfter))
+                        
+                candidateReasons = iter(candidateReasons)
+                checkedAssertions = [
+                    (assertion, 
+                     candidateReasons.next() if reason is None else reason)
+                    for assertion, reason in checkedAssertions]
+            else:
+                validBounds = bounds
+                
+            validAssertions = [assertion 
+                               for assertion, reason in checkedAssertions
+                               if reason is None]
+            rejectedAssertions = [(assertion, reason) 
+                                  for assertion, reason in checkedAssertions
+                                  if reason is not None]
+            if rejectedAssertions:
+                rejected[key] = rejectedAssertions
                 
-            elif verifyCredentials and not self.isValidCredential(assertion):
-                raise CredentialWalletError("Validity time error with "
-                                            "assertion %r" % assertion)
+            if validAssertions:
+                self._setCredentials(key, validAssertions, utcNow=utcNow,
+                                     bounds=validBounds)
+                
+        if rejected and log.isEnabledFor(logging.WARNING):
+            log.warning("SAMLAssertionWallet.addCredentialsBatch: rejected %d "
+                        "assertion(s) for key(s) %s", 
+                        sum([len(v) for v in rejected.values()]),
+                        ", ".join([repr(k) for k in rejected]))
+        return rejected
+    
+    def _setCredentials(self, key, assertions, utcNow=None, bounds=None):
+        """Set the assertions held for a key overwriting any existing ones
         
-        # Any existing credentials are overwritten
+        @type key: basestring
+        @param key: key by which these credentials should be referred to
+        @type assertions: iterable
+        @param assertions: list of SAML assertions
+        @type utcNow: datetime / None type
+        @param utcNow: current time, defaults to reading the clock
+        @type bounds: array.array / None type
+        @param bounds: validity bounds for the assertions if already 
+        calculated
+        """
         self.__assertionsMap[key] = assertions
+        self.__packedAssertionsMap.pop(key, None)
+        self._indexCredentials(key, assertions, utcNow=utcNow, bounds=bounds)
+        self._updateAttributeIndex(key, assertions)
+        self._incrGeneration()
 
-    def retrieveCredentials(self, key):
-        """Retrieve credentials for the given key
+    def _getAttributeIndex(self):
+        if self.__attributeIndex is None:
+            attributeIndex = ESGFAttributeIndex()
+            for key in self._keys():
+                assertions = self._getAssertions(key)
+                attributeIndex.add(assertions)
+                self.__indexedAssertions[key] = list(assertions)
+                
+            self.__attributeIndex = attributeIndex
+            
+        return self.__attributeIndex
+    
+    attributeIndex = property(_getAttributeIndex,
+                              doc="Index of attribute values to the "
+                                  "assertions carrying them.  It is built "
+                                  "when first accessed and then updated as "
+                                  "assertions are added or removed.  Entries "
+                                  "may include assertions which have expired "
+                                  "but not yet been removed by audit.  "
+                                  "Changes made in place to the lists of "
+                                  "assertions held aren't reflected")
+    
+    def _updateAttributeIndex(self, key, assertions):
+        """Replace the attribute index entries for the assertions held for a
+        key.  This has no effect if the index hasn't been built
         
-        @param key: key index to credentials to retrieve
         @type key: basestring
-        @rtype: iterable / None type if none found for key
-        @return: cached credentials indexed by input key
+        @param key: key to assertions
+        @type assertions: list / None type
+        @param assertions: assertions now held for this key or None if the
+        key has been removed
         """
-        return self.__assertionsMap.get(key)
-                        
-    def audit(self):
-        """Check the credentials held in the wallet removing any that have
-        expired or are otherwise invalid."""
-
-        log.debug("SAMLAssertionWallet.audit ...")
+        if self.__attributeIndex is None:
+            return
         
-        for k, v in self.__assertionsMap.items():
-            creds = [credential for credential in v
-                     if self.isValidCredential(credential)]
-            if len(creds) > 0:
-                self.__assertionsMap[k] = creds
-            else:
-                del self.__assertionsMap[k]
-
-    def isValidCredential(self, assertion):
-        """Validate SAML assertion time validity"""
-        utcNow = datetime.utcnow()
-        if utcNow < assertion.conditions.notBefore - self.clockSkewTolerance:
-            msg = ('The current clock time [%s] is before the SAML Attribute '
-                   'Response assertion conditions not before time [%s] ' 
-                   '(with clock skew tolerance = %s)' % 
-                   (SAMLDateTime.toString(utcNow),
-                    assertion.conditions.notBefore,
-                    self.clockSkewTolerance))
-            log.warning(msg)
-            return False
+        indexedAssertions = self.__indexedAssertions.pop(key, None)
+        if indexedAssertions:
+            self.__attributeIndex.remove(indexedAssertions)
             
-        if (utcNow >= 
-            assertion.conditions.notOnOrAfter + self.clockSkewTolerance):
-            msg = ('The current clock time [%s] is on or after the SAML '
-                   'Attribute Response assertion conditions not on or after '
-                   'time [%s] (with clock skew tolerance = %s)' % 
-                   (SAMLDateTime.toString(utcNow),
-                    assertion.conditions.notOnOrAfter,
-                    self.clockSkewTolerance))
-            log.warning(msg)
-            return False
+        if assertions:
+            self.__attributeIndex.add(assertions)
+            self.__indexedAssertions[key] = list(assertions)
             
-        return True
-    
-    # Implement abstract method
-    updateCredentialRepository = lambda self: None
-    
-    def __getstate__(self):
-        '''Enable pickling for use with beaker.session'''
-        _dict = super(SAMLAssertionWallet, self).__getstate__()
+    def _hasValidAssertion(self, assertions):
+        """Check whether any of the assertions is within its validity period
+        allowing for the clock skew tolerance
         
-        for attrName in SAMLAssertionWallet.__slots__:
-            # Ugly hack to allow for derived classes setting private member
-            # variables
-            if attrName.startswith('__'):
-                attrName = "_SAMLAssertionWallet" + attrName
+        @type assertions: iterable
+        @param assertions: assertions to check
+        @rtype: bool
+        @return: True if any of the assertions is valid
+        """
+        utcNow = datetime.utcnow()
+        notBeforeCutoff = utcNow + self.clockSkewTolerance
+        notOnOrAfterCutoff = utcNow - self.clockSkewTolerance
+        for assertion in assertions:
+            conditions = assertion.conditions
+            if conditions is None:
+                return True
+            
+            if ((conditions.notBefore is None or 
+                 conditions.notBefore <= notBeforeCutoff) and
+                (conditions.notOnOrAfter is None or 
+                 conditions.notOnOrAfter > notOnOrAfterCutoff)):
+                return True
+            
+        return False
+
+    def hasAttribute(self, name, value):
+        """Check whether any assertion held carries an xs:string attribute
+        value
+        
+        @type name: basestring
+        @param name: attribute name
+        @type value: basestring
+        @param value: attribute value
+        @rtype: bool
+        @return: True if the attribute value is held by an assertion within
+        its validity period
+        """
+        return self._hasValidAssertion(
+                    self.attributeIndex.getAttributeAssertions(name, value))
+
+    def hasGroupRole(self, group, 
+                     role=ESGFGroupRoleAttributeValue.DEFAULT_ROLE_NAME):
+        """Check whether any assertion held carries an ESG group/role
+        attribute value
+        
+        @type group: basestring
+        @param group: group name
+        @type role: basestring
+        @param role: role name.  The default role matches any role held for
+        the group
+        @rtype: bool
+        @return: True if the group/role is held by an assertion within its
+        validity period
+        """
+        return self._hasValidAssertion(
+                    self.attributeIndex.getGroupRoleAssertions(group, role))
+    
+    def _getDigestCache(self):
+        if self.__digestCache is None:
+            return SAMLAssertionWallet.DEFAULT_DIGEST_CACHE
+        
+        return self.__digestCache
+
+    def _setDigestCache(self, value):
+        if not isinstance(value, (SAMLAssertionDigestCache, type(None))):
+            raise TypeError('Expecting %r type for "digestCache"; got %r' %
+                            (SAMLAssertionDigestCache, type(value)))
+        self.__digestCache = value
+
+    digestCache = property(_getDigestCache, _setDigestCache,
+                           doc="Cache of digests of the canonicalised "
+                               "assertions held.  Defaults to a cache shared "
+                               "between wallets.  It isn't pickled")
+    
+    def getCredentialDigests(self, key):
+        """Get digests of the canonical form of the credentials for the 
+        given key e.g. for an integrity check before forwarding them.  
+        Canonicalization is only carried out for assertions without a 
+        current entry in the digest cache
+        
+        @param key: key index to credentials
+        @type key: basestring
+        @rtype: list / None type if no credentials are found for key
+        @return: list of (digest, canonical size in bytes) tuples in the same
+        order as the credentials
+        """
+        assertions = self.retrieveCredentials(key)
+        if assertions is None:
+            return None
+        
+        digestCache = self.digestCache
+        return [digestCache.getDigest(assertion) for assertion in assertions]
+
+    def retrieveCredentials(self, key):
+        """Retrieve credentials for the given key
+        
+        @param key: key index to credentials to retrieve
+        @type key: basestring
+        @rtype: iterable / None type if none found for key
+        @return: cached credentials indexed by input key
+        """
+        assertions = self._getAssertions(key)
+        if assertions is None or not self.auditOnRetrieve:
+            return assertions
+
+        # Check only the assertions for this key using a single clock reading
+        now = time()
+        bounds = self._getValidityBounds(key, assertions)
+        creds = [assertion for i, assertion in enumerate(assertions)
+                 if bounds[2*i] <= now < bounds[2*i + 1]]
+        if len(creds) == len(assertions):
+            return assertions
+        
+        if log.isEnabledFor(logging.WARNING):
+            log.warning("SAMLAssertionWallet.retrieveCredentials: removing "
+                        "%d assertion(s) for key %r outside of their validity "
+                        "period (with clock skew tolerance = %s)",
+                        len(assertions) - len(creds), key, 
+                        self.clockSkewTolerance)
+
+        if len(creds) > 0:
+            self.__assertionsMap[key] = creds
+            self._indexCredentials(key, creds)
+            self._updateAttributeIndex(key, creds)
+            self._incrGeneration()
+            return creds
+
+        self._removeKey(key)
+        return None
+                        
+    def audit(self):
+        """Check the credentials held in the wallet removing any that have
+        expired or are otherwise invalid."""
+
+        log.debug("SAMLAssertionWallet.audit ...")
+
+        # Only those assertions which have reached their expiry time need be
+        # visited along with any which were not yet valid when added
+        expired = {}
+        cutoff = datetime.utcnow() - self.clockSkewTolerance
+        for k, assertion in self.__expiryIndex.popExpired(cutoff):
+            expired.setdefault(k, set()).add(id(assertion))
+
+        for k in self.__notYetValidKeys:
+            expired.setdefault(k, set())
+        self.__notYetValidKeys.clear()
+
+        now = time()
+        for k, expiredIds in expired.items():
+            if k in self.__assertionsMap:
+                v = self.__assertionsMap[k]
+                bounds = self._getValidityBounds(k, v)
+                
+            elif k in self.__packedAssertionsMap:
+                # Assertions yet to be rebuilt following unpickling
+                v = self.__packedAssertionsMap[k]
+                bounds = self.__validityBounds[k]
+            else:
+                continue
+
+            validIdx = [i for i, credential in enumerate(v)
+                        if (id(credential) not in expiredIds and
+                            bounds[2*i] <= now < bounds[2*i + 1])]
+            if len(validIdx) == 0:
+                self._removeKey(k)
+                continue
+            
+            if len(validIdx) == len(v):
+                # Nothing removed - only keys for assertions not yet valid are
+                # visited without any expired assertions
+                continue
+            
+            self._incrGeneration()
+            creds = [v[i] for i in validIdx]
+            if k in self.__assertionsMap:
+                self.__assertionsMap[k] = creds
+                self._updateAttributeIndex(k, creds)
+                indexCredentials = self._indexCredentials
+            else:
+                # Building the attribute index rebuilds all the assertions so
+                # packed ones are never indexed
+                self.__packedAssertionsMap[k] = creds
+                indexCredentials = self._indexPackedCredentials
+                
+            if len(creds) < len(v) - len(expiredIds):
+                # Assertions not yet valid were removed as well as expired
+                # ones - re-index the remainder
+                indexCredentials(k, creds)
+            else:
+                self.__validityBounds[k] = array(
+                                        'd', 
+                                        [bound for i in validIdx 
+                                         for bound in bounds[2*i:2*i + 2]])
+
+    def _getNextExpiry(self):
+        nextExpiry = self.__expiryIndex.nextExpiry
+        if nextExpiry is None:
+            return None
+
+        return nextExpiry + self.clockSkewTolerance
+
+    nextExpiry = property(_getNextExpiry,
+                          doc="Time at which the next assertion held will "
+                              "expire allowing for the clock skew tolerance "
+                              "or None if no assertions are held")
+
+    def hasExpiredCredentials(self, utcNow=None):
+        """Check whether any assertions held have expired and are due to be
+        removed by audit
+
+        @type utcNow: datetime / None type
+        @param utcNow: time to check against, defaults to the current time
+        @rtype: bool
+        @return: True if any assertions held have expired
+        """
+        nextExpiry = self.nextExpiry
+        if nextExpiry is None:
+            return False
+
+        if utcNow is None:
+            utcNow = datetime.utcnow()
+
+        return utcNow >= nextExpiry
+    
+    def _keys(self):
+        """Get the keys for all the assertions held including those yet to be
+        rebuilt following unpickling
+        
+        @rtype: set
+        @return: keys
+        """
+        return set(self.__assertionsMap).union(self.__packedAssertionsMap)
+    
+    def _getAssertions(self, key):
+        """Get the assertions for a key, rebuilding them from their packed 
+        form if they have not been accessed since unpickling
+        
+        @type key: basestring
+        @param key: key to assertions
+        @rtype: list / None type
+        @return: assertions for this key or None if none are held
+        """
+        assertions = self.__assertionsMap.get(key)
+        if assertions is not None:
+            return assertions
+        
+        packedAssertions = self.__packedAssertionsMap.pop(key, None)
+        if packedAssertions is None:
+            return None
+        
+        # The packed form is discarded as the caller may alter the rebuilt 
+        # assertions in place
+        assertions = [_unpackAssertion(packedAssertion) 
+                      for packedAssertion in packedAssertions]
+        
+        self.__assertionsMap[key] = assertions
+        self._indexCredentials(key, assertions)
+        
+        return assertions
+        
+    def _removeKey(self, key):
+        """Remove the assertions held for a key
+        
+        @type key: basestring
+        @param key: key to assertions
+        """
+        self.__assertionsMap.pop(key, None)
+        self.__packedAssertionsMap.pop(key, None)
+        self.__expiryIndex.remove(key)
+        self.__notYetValidKeys.discard(key)
+        self.__validityBounds.pop(key, None)
+        self._updateAttributeIndex(key, None)
+        self._incrGeneration()
+        
+    def _getValidityBounds(self, key, assertions):
+        """Get the validity bounds for the assertions held for a key 
+        re-indexing them if the list of assertions has been altered in place
+        
+        @type key: basestring
+        @param key: key to assertions
+        @type assertions: list
+        @param assertions: assertions held for this key
+        @rtype: array.array
+        @return: validity bounds for these assertions
+        """
+        bounds = self.__validityBounds.get(key)
+        if bounds is None or len(bounds) != 2*len(assertions):
+            self._indexCredentials(key, assertions)
+            bounds = self.__validityBounds[key]
+            
+        return bounds
+        
+    def _indexCredentials(self, key, assertions, utcNow=None, bounds=None):
+        """Update the expiry index for the assertions held under a key noting
+        any which are not yet valid
+
+        @type key: basestring
+        @param key: key to assertions
+        @type assertions: iterable
+        @param assertions: assertions for this key
+        @type utcNow: datetime / None type
+        @param utcNow: current time, defaults to reading the clock
+        @type bounds: array.array / None type
+        @param bounds: validity bounds for the assertions if already 
+        calculated
+        """
+        self._indexValidityTimes(key, self._getValidityTimes(assertions), 
+                                 utcNow=utcNow, bounds=bounds)
+        
+    @staticmethod
+    def _getValidityTimes(assertions):
+        """Get the validity times of assertions
+        
+        @type assertions: iterable
+        @param assertions: assertions
+        @rtype: list
+        @return: (not before, not on or after, assertion) tuples
+        """
+        validityTimes = []
+        for assertion in assertions:
+            conditions = assertion.conditions
+            if conditions is None:
+                validityTimes.append((None, None, assertion))
+            else:
+                validityTimes.append((conditions.notBefore, 
+                                      conditions.notOnOrAfter, 
+                                      assertion))
+        return validityTimes
+    
+    def _makeValidityBounds(self, validityTimes):
+        """Convert validity times to (notBefore - clock skew tolerance, 
+        notOnOrAfter + clock skew tolerance) pairs of seconds since the epoch
+        
+        @type validityTimes: iterable
+        @param validityTimes: (not before, not on or after, credential) 
+        tuples
+        @rtype: array.array
+        @return: validity bounds
+        """
+        bounds = array('d')
+        skew = _timedeltaSeconds(self.clockSkewTolerance)
+        for notBefore, notOnOrAfter, credential in validityTimes:
+            if notBefore is not None:
+                bounds.append(_toEpoch(notBefore) - skew)
+            else:
+                bounds.append(-_INFINITY)
+                
+            if notOnOrAfter is not None:
+                bounds.append(_toEpoch(notOnOrAfter) + skew)
+            else:
+                bounds.append(_INFINITY)
                 
+        return bounds
+        
+    def _indexPackedCredentials(self, key, packedAssertions):
+        """Update the expiry index for packed assertions held under a key
+        
+        @type key: basestring
+        @param key: key to assertions
+        @type packedAssertions: iterable
+        @param packedAssertions: packed assertions for this key
+        """
+        self._indexValidityTimes(key, 
+                                 [packedAssertion[:PACKED_DATA_IDX] + 
+                                  (packedAssertion,)
+                                  for packedAssertion in packedAssertions])
+            
+    def _indexValidityTimes(self, key, validityTimes, utcNow=None, 
+                            bounds=None):
+        """Update the expiry index and validity bounds for the credentials 
+        held under a key noting any which are not yet valid
+
+        @type key: basestring
+        @param key: key to credentials
+        @type validityTimes: iterable
+        @param validityTimes: (not before, not on or after, credential) 
+        tuples for credentials held for this key
+        @type utcNow: datetime / None type
+        @param utcNow: current time, defaults to reading the clock
+        @type bounds: array.array / None type
+        @param bounds: validity bounds for the credentials if already 
+        calculated
+        """
+        if utcNow is None:
+            utcNow = datetime.utcnow()
+            
+        if bounds is None:
+            bounds = self._makeValidityBounds(validityTimes)
+            
+        entries = []
+        notBeforeCutoff = utcNow + self.clockSkewTolerance
+        for notBefore, notOnOrAfter, credential in validityTimes:
+            if notOnOrAfter is not None:
+                entries.append((notOnOrAfter, credential))
+
+            if notBefore is not None and notBefore > notBeforeCutoff:
+                self.__notYetValidKeys.add(key)
+
+        self.__expiryIndex.add(key, entries)
+        self.__validityBounds[key] = bounds
+
+    def isValidCredential(self, assertion, utcNow=None):
+        """Validate SAML assertion time validity.  A single assertion is 
+        checked with datetime arithmetic which is no slower than converting 
+        its validity times to the epoch seconds used by the bulk checks in
+        addCredentials, retrieveCredentials and audit
+        
+        @type assertion: ndg.saml.saml2.core.Assertion
+        @param assertion: assertion to check
+        @type utcNow: datetime / None type
+        @param utcNow: time to check against, defaults to the current time
+        @rtype: bool
+        @return: True if the assertion is valid for the time given
+        """
+        return self._isValidPeriod(assertion.conditions.notBefore,
+                                   assertion.conditions.notOnOrAfter,
+                                   utcNow=utcNow)
+    
+    def _isValidPeriod(self, notBefore, notOnOrAfter, utcNow=None):
+        """Check the time is within the given validity period allowing for
+        the clock skew tolerance
+        
+        @type notBefore: datetime
+        @param notBefore: start of validity period
+        @type notOnOrAfter: datetime
+        @param notOnOrAfter: end of validity period
+        @type utcNow: datetime / None type
+        @param utcNow: time to check against, defaults to the current time
+        @rtype: bool
+        @return: True if the time is within the validity period
+        """
+        if utcNow is None:
+            utcNow = datetime.utcnow()
+            
+        if utcNow < notBefore - self.clockSkewTolerance:
+            if log.isEnabledFor(logging.WARNING):
+                log.warning('The current clock time [%s] is before the SAML '
+                            'Attribute Response assertion conditions not '
+                            'before time [%s] (with clock skew tolerance = '
+                            '%s)', SAMLDateTime.toString(utcNow), notBefore,
+                            self.clockSkewTolerance)
+            return False
+            
+        if utcNow >= notOnOrAfter + self.clockSkewTolerance:
+            if log.isEnabledFor(logging.WARNING):
+                log.warning('The current clock time [%s] is on or after the '
+                            'SAML Attribute Response assertion conditions not '
+                            'on or after time [%s] (with clock skew tolerance '
+                            '= %s)', SAMLDateTime.toString(utcNow), 
+                            notOnOrAfter, self.clockSkewTolerance)
+            return False
+            
+        return True
+    
+    def updateCredentialRepository(self, auditCred=True):
+        """Copy the assertions held by the wallet into the credential 
+        repository replacing any held there for the same keys.  This has no
+        effect if no repository has been set.
+        
+        @type auditCred: bool
+        @param auditCred: remove expired credentials held in the repository 
+        for this wallet's user"""
+        credentialRepository = self.credentialRepository
+        if credentialRepository is None:
+            return
+        
+        if self.userId is None:
+            raise CredentialWalletError('No "userId" set for updating the '
+                                        'credential repository')
+        if auditCred:
+            credentialRepository.auditCredentials(userId=self.userId)
+            
+        credentialRepository.replaceCredentials(
+                    self.userId, 
+                    dict([(key, self._getAssertions(key)) 
+                          for key in self._keys()]))
+    
+    def __getstate__(self):
+        '''Enable pickling for use with beaker.session.  Assertions are saved
+        in packed form'''
+        _dict = super(SAMLAssertionWallet, self).__getstate__()
+
+        for attrName in SAMLAssertionWallet.__PICKLED_ATTRNAMES:
+            # Ugly hack to allow for derived classes setting private member
+            # variables
+            if attrName.startswith('__'):
+                attrName = "_SAMLAssertionWallet" + attrName
+
             _dict[attrName] = getattr(self, attrName)
+        
+        packedAssertionsMap = {}
+        for key, assertions in self.__assertionsMap.items():
+            packedAssertionsMap[key] = [_packAssertion(assertion) 
+                                        for assertion in assertions]
+            
+        # Assertions yet to be rebuilt are unchanged since unpickling
+        packedAssertionsMap.update(self.__packedAssertionsMap)
+            
+        _dict[SAMLAssertionWallet.STATE_VERSION_KEY
+              ] = SAMLAssertionWallet.STATE_VERSION
+        _dict[SAMLAssertionWallet.PACKED_ASSERTIONS_KEY] = packedAssertionsMap
+        
+        return _dict
+
+    def __setstate__(self, attrDict):
+        '''Enable pickling for use with beaker.session - the expiry index is
+        rebuilt from the unpickled assertions.  State pickled by earlier 
+        versions holding the assertion objects themselves is also accepted'''
+        attrDict = attrDict.copy()
+        version = attrDict.pop(SAMLAssertionWallet.STATE_VERSION_KEY, 1)
+        if version > SAMLAssertionWallet.STATE_VERSION:
+            raise CredentialWalletError('Unsupported %r pickled state version '
+                                        '%r' % (type(self), version))
+            
+        packedAssertionsMap = attrDict.pop(
+                                SAMLAssertionWallet.PACKED_ASSERTIONS_KEY, {})
+        
+        self.__clockSkewTolerance = timedelta(seconds=0.)
+        self.__auditOnRetrieve = False
+        self.__digestCache = None
+        self._initAssertions()
+
+        super(SAMLAssertionWallet, self).__setstate__(attrDict)
+
+        for key, assertions in self.__assertionsMap.items():
+            self._indexCredentials(key, assertions)
+            
+        for key, packedAssertions in packedAssertionsMap.items():
+            self.__packedAssertionsMap[key] = packedAssertions
+            self._indexPackedCredentials(key, packedAssertions)
+
+
+class SAMLAssertionCache(CredentialWalletBase):
+    """Process wide cache of SAML assertions for sharing between user
+    sessions.  Sessions can check the cache before making a new attribute
+    query to an attribute authority.  Entries are keyed by subject, issuer
+    and the set of attributes requested - see makeKey.
+    
+    Expired entries are evicted first and then the least recently used ones
+    when the number of entries or their estimated size in bytes exceeds the
+    configured limits.  Access is serialised with a lock so that an instance
+    can be shared between threads.
+    """
+    DEFAULT_MAX_ENTRIES = 1024
+    DEFAULT_MAX_SIZE = 32 * 1024 * 1024
+    
+    CONFIG_FILE_OPTNAMES = CredentialWalletBase.CONFIG_FILE_OPTNAMES + (
+                           "clockSkewTolerance", "maxEntries", "maxSize")
+    
+    __PICKLED_ATTRNAMES = ("__clockSkewTolerance", "__maxEntries", 
+                           "__maxSize", "__entries")
+    __slots__ = __PICKLED_ATTRNAMES + ("__size", "__expiryIndex", "__lock")
+    
+    # Fields of each cache entry
+    ASSERTIONS_IDX, SIZE_IDX, NOT_BEFORE_IDX, NOT_ON_OR_AFTER_IDX = range(4)
+    
+    def __init__(self):
+        super(SAMLAssertionCache, self).__init__()
+        self.__clockSkewTolerance = timedelta(seconds=0.)
+        self.__maxEntries = SAMLAssertionCache.DEFAULT_MAX_ENTRIES
+        self.__maxSize = SAMLAssertionCache.DEFAULT_MAX_SIZE
+        self.__lock = threading.RLock()
+        self._initEntries()
+
+    def _initEntries(self):
+        """Initialise the entries held, ordered from least to most recently
+        used"""
+        self.__entries = OrderedDict()
+        self.__size = 0
+        self.__expiryIndex = CredentialExpiryIndex()
+        
+    @staticmethod
+    def makeKey(subject, issuer, attributeNames):
+        """Make a cache key
+        
+        @type subject: basestring
+        @param subject: subject NameID value
+        @type issuer: basestring
+        @param issuer: issuer or attribute authority identifier
+        @type attributeNames: iterable
+        @param attributeNames: names of the attributes requested
+        @rtype: tuple
+        @return: key for use with addCredentials and retrieveCredentials
+        """
+        return (subject, issuer, frozenset(attributeNames))
+    
+    def _getClockSkewTolerance(self):
+        return self.__clockSkewTolerance
+
+    def _setClockSkewTolerance(self, value):
+        clockSkewTolerance = _parseClockSkewTolerance(value)
+        with self.__lock:
+            self.__clockSkewTolerance = clockSkewTolerance
+            self._incrGeneration()
+
+    clockSkewTolerance = property(_getClockSkewTolerance, 
+                                  _setClockSkewTolerance, 
+                                  doc="Allow a tolerance (seconds) for "
+                                      "checking timestamps of the form: "
+                                      "notBeforeTime - tolerance < now < "
+                                      "notAfterTime + tolerance")
+
+    def _getMaxEntries(self):
+        return self.__maxEntries
+
+    def _setMaxEntries(self, value):
+        if isinstance(value, basestring):
+            value = int(value)
+            
+        elif not isinstance(value, (int, long)):
+            raise TypeError('Expecting int, long or string type for '
+                            '"maxEntries"; got %r' % type(value))
+        
+        if value < 1:
+            raise ValueError('"maxEntries" must be greater than zero; got %r' %
+                             value)
+        with self.__lock:
+            self.__maxEntries = value
+            self._incrGeneration()
+            self._evict()
+
+    maxEntries = property(_getMaxEntries, _setMaxEntries,
+                          doc="Maximum number of entries held")
+
+    def _getMaxSize(self):
+        return self.__maxSize
+
+    def _setMaxSize(self, value):
+        if isinstance(value, basestring):
+            value = int(value)
+            
+        elif not isinstance(value, (int, long)):
+            raise TypeError('Expecting int, long or string type for '
+                            '"maxSize"; got %r' % type(value))
+            
+        if value < 1:
+            raise ValueError('"maxSize" must be greater than zero; got %r' %
+                             value)
+        with self.__lock:
+            self.__maxSize = value
+            self._incrGeneration()
+            self._evict()
+
+    maxSize = property(_getMaxSize, _setMaxSize,
+                       doc="Ceiling for the estimated memory in bytes used by "
+                           "the assertions held")
+    
+    def _getSize(self):
+        return self.__size
+    
+    size = property(_getSize, 
+                    doc="Estimated memory in bytes used by the assertions "
+                        "held")
+    
+    def __len__(self):
+        return len(self.__entries)
+    
+    def parseConfig(self, cfg, prefix='', section='DEFAULT'):
+        '''Read config file settings
+        @type cfg: basestring /ConfigParser derived type
+        @param cfg: configuration file path or ConfigParser type object
+        @type prefix: basestring
+        @param prefix: prefix for option names e.g. "certExtApp."
+        @type section: baestring
+        @param section: configuration file section from which to extract
+        parameters.
+        '''  
+        self._setOptionsFromConfig(cfg, prefix=prefix, section=section)
+        
+    def addCredentials(self, key, assertions, verifyCredentials=True):
+        """Cache assertions replacing any held for the given key.  
+        Assertions too large to fit in the cache are not added.
+
+        @type key: tuple
+        @param key: key for these assertions - see makeKey
+        @type assertions: iterable
+        @param assertions: list of SAML assertions
+        @type verifyCredentials: bool
+        @param verifyCredentials: if set to True, check that the assertions
+        are currently valid
+        """
+        assertions = list(assertions)
+        notBefore = None
+        notOnOrAfter = None
+        for assertion in assertions:
+            if not isinstance(assertion, Assertion):
+                raise TypeError("Input credentials must be %r type; got %r" %
+                                (Assertion, assertion))
+
+            conditions = assertion.conditions
+            if conditions is None:
+                continue
+            
+            # An entry is valid only whilst all of its assertions are
+            if (conditions.notBefore is not None and 
+                (notBefore is None or conditions.notBefore > notBefore)):
+                notBefore = conditions.notBefore
+                
+            if (conditions.notOnOrAfter is not None and 
+                (notOnOrAfter is None or 
+                 conditions.notOnOrAfter < notOnOrAfter)):
+                notOnOrAfter = conditions.notOnOrAfter
+         
+        if verifyCredentials and not self._isValidEntry(notBefore, 
+                                                        notOnOrAfter, 
+                                                        datetime.utcnow()):
+            raise CredentialWalletError("Validity time error with "
+                                        "assertions for key %r" % (key,))
+            
+        # Sizing is carried out before taking the lock as it visits every
+        # object in the assertions
+        size = _getDeepSize(assertions)
+        
+        with self.__lock:
+            self._remove(key)
+            
+            if size > self.__maxSize:
+                log.debug("SAMLAssertionCache.addCredentials: assertions for "
+                          "key %r exceed the maximum cache size, skipping",
+                          key)
+                return
+                
+            self.__entries[key] = (assertions, size, notBefore, notOnOrAfter)
+            self.__size += size
+            self._incrGeneration()
+            if notOnOrAfter is not None:
+                self.__expiryIndex.add(key, [(notOnOrAfter, None)])
+
+            self._evict()
+
+    def retrieveCredentials(self, key):
+        """Retrieve assertions for the given key.  Expired entries are
+        removed.
+        
+        @type key: tuple
+        @param key: key for assertions - see makeKey
+        @rtype: list / None type
+        @return: copy of the list of cached assertions or None if no valid 
+        entry is held for this key
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            
+            notBefore, notOnOrAfter = entry[
+                SAMLAssertionCache.NOT_BEFORE_IDX:
+                SAMLAssertionCache.NOT_ON_OR_AFTER_IDX + 1]
+            utcNow = datetime.utcnow()
+            if (notOnOrAfter is not None and 
+                utcNow >= notOnOrAfter + self.__clockSkewTolerance):
+                self._remove(key)
+                return None
+
+            if not self._isValidEntry(notBefore, notOnOrAfter, utcNow):
+                return None
+            
+            # Mark as most recently used
+            del self.__entries[key]
+            self.__entries[key] = entry
+            
+            return list(entry[SAMLAssertionCache.ASSERTIONS_IDX])
+
+    def audit(self):
+        """Remove expired entries"""
+        with self.__lock:
+            self._removeExpired()
+
+    def clear(self):
+        """Remove all entries"""
+        with self.__lock:
+            self._initEntries()
+            self._incrGeneration()
+
+    # Implement abstract method
+    updateCredentialRepository = lambda self, auditCred=True: None
+    
+    def _isValidEntry(self, notBefore, notOnOrAfter, utcNow):
+        """Check entry validity times allowing for the clock skew tolerance
+        """
+        if (notBefore is not None and 
+            utcNow < notBefore - self.__clockSkewTolerance):
+            return False
+        
+        if (notOnOrAfter is not None and 
+            utcNow >= notOnOrAfter + self.__clockSkewTolerance):
+            return False
+        
+        return True
+    
+    def _remove(self, key):
+        """Remove entry for the given key if present.  The lock must be held
+        """
+        entry = self.__entries.pop(key, None)
+        if entry is not None:
+            self.__size -= entry[SAMLAssertionCache.SIZE_IDX]
+            self.__expiryIndex.remove(key)
+            self._incrGeneration()
+            
+    def _removeExpired(self):
+        """Remove expired entries.  The lock must be held"""
+        cutoff = datetime.utcnow() - self.__clockSkewTolerance
+        for key, _ in self.__expiryIndex.popExpired(cutoff):
+            entry = self.__entries.pop(key, None)
+            if entry is not None:
+                self.__size -= entry[SAMLAssertionCache.SIZE_IDX]
+                self._incrGeneration()
+                
+    def _evict(self):
+        """Evict entries to keep within the configured limits - expired 
+        entries first followed by the least recently used.  The lock must be 
+        held"""
+        if not self._isOverLimit():
+            return
+        
+        self._removeExpired()
+        while self._isOverLimit():
+            key = next(iter(self.__entries))
+            log.debug("SAMLAssertionCache: evicting least recently used "
+                      "entry %r", key)
+            self._remove(key)
+            
+    def _isOverLimit(self):
+        return (len(self.__entries) > self.__maxEntries or 
+                self.__size > self.__maxSize)
+    
+    def __getstate__(self):
+        '''Enable pickling - the lock and expiry index are not saved'''
+        _dict = super(SAMLAssertionCache, self).__getstate__()
+        
+        with self.__lock:
+            for attrName in SAMLAssertionCache.__PICKLED_ATTRNAMES:
+                # Ugly hack to allow for derived classes setting private 
+                # member variables
+                if attrName.startswith('__'):
+                    attrName = "_SAMLAssertionCache" + attrName
+    
+                _dict[attrName] = getattr(self, attrName)
+                
+            _dict["_SAMLAssertionCache__entries"] = OrderedDict(
+                                                        self.__entries.items())
+        return _dict
+    
+    def __setstate__(self, attrDict):
+        '''Enable pickling - the size total and expiry index are rebuilt 
+        from the unpickled entries'''
+        self.__lock = threading.RLock()
+        self.__clockSkewTolerance = timedelta(seconds=0.)
+        self.__maxEntries = SAMLAssertionCache.DEFAULT_MAX_ENTRIES
+        self.__maxSize = SAMLAssertionCache.DEFAULT_MAX_SIZE
+        self._initEntries()
+        
+        super(SAMLAssertionCache, self).__setstate__(attrDict)
+        
+        for key, entry in self.__entries.items():
+            self.__size += entry[SAMLAssertionCache.SIZE_IDX]
+            notOnOrAfter = entry[SAMLAssertionCache.NOT_ON_OR_AFTER_IDX]
+            if notOnOrAfter is not None:
+                self.__expiryIndex.add(key, [(notOnOrAfter, None)])
+        
+        
+class AttributeAuthorityFailureCache(object):
+    """Process wide record of failed attribute authority lookups so that
+    they aren't repeated straight away:
+    
+     - negative cache: subjects for which an attribute authority returned no
+     attributes are held for negativeTTL seconds keyed by subject and 
+     attribute authority URI
+     - circuit breaker: after failureThreshold consecutive errors querying 
+     an attribute authority, its circuit is opened and it isn't queried for
+     errorTTL seconds.  After this a single trial query is allowed through.
+     If this succeeds the circuit is closed again otherwise it's reopened
+     
+    Access is serialised with a lock so that an instance can be shared 
+    between threads.
+    """
+    DEFAULT_NEGATIVE_TTL = 60.
+    DEFAULT_ERROR_TTL = 30.
+    DEFAULT_FAILURE_THRESHOLD = 3
+    
+    CONFIG_FILE_OPTNAMES = ("negativeTTL", "errorTTL", "failureThreshold")
+    
+    # Fields of each circuit entry
+    N_FAILURES_IDX, OPEN_UNTIL_IDX = range(2)
+    
+    __slots__ = ("__negativeTTL", "__errorTTL", "__failureThreshold", 
+                 "__negativeEntries", "__circuits", "__lock")
+    
+    def __init__(self):
+        self.__negativeTTL = AttributeAuthorityFailureCache.DEFAULT_NEGATIVE_TTL
+        self.__errorTTL = AttributeAuthorityFailureCache.DEFAULT_ERROR_TTL
+        self.__failureThreshold = \
+            AttributeAuthorityFailureCache.DEFAULT_FAILURE_THRESHOLD
+        self.__lock = threading.RLock()
+        self.clear()
+        
+    @classmethod
+    def fromConfig(cls, cfg, **kw):
+        '''Alternative constructor makes object from config file settings
+        @type cfg: basestring /ConfigParser derived type
+        @param cfg: configuration file path or ConfigParser type object
+        @rtype: AttributeAuthorityFailureCache
+        @return: new instance of this class
+        '''
+        failureCache = cls()
+        failureCache.parseConfig(cfg, **kw)
+        
+        return failureCache
+    
+    def parseConfig(self, cfg, prefix='', section='DEFAULT'):
+        '''Read config file settings
+        @type cfg: basestring /ConfigParser derived type
+        @param cfg: configuration file path or ConfigParser type object
+        @type prefix: basestring
+        @param prefix: prefix for option names e.g. "certExtApp."
+        @type section: baestring
+        @param section: configuration file section from which to extract
+        parameters.
+        '''  
+        _setAttributesFromConfig(self, cfg, prefix=prefix, section=section)
+        
+    @staticmethod
+    def _parseTTL(name, value):
+        if isinstance(value, basestring):
+            value = float(value)
             
-        return _dict
+        elif not isinstance(value, (int, long, float)):
+            raise TypeError('Expecting float, int, long or string type for '
+                            '%r; got %r' % (name, type(value)))
+        if value < 0:
+            raise ValueError('%r must be zero or greater; got %r' % 
+                             (name, value))
+        return float(value)
+    
+    def _getNegativeTTL(self):
+        return self.__negativeTTL
+
+    def _setNegativeTTL(self, value):
+        self.__negativeTTL = self._parseTTL("negativeTTL", value)
+
+    negativeTTL = property(_getNegativeTTL, _setNegativeTTL,
+                           doc="Time in seconds for which a subject with no "
+                               "attributes at an attribute authority isn't "
+                               "queried for again")
+
+    def _getErrorTTL(self):
+        return self.__errorTTL
+
+    def _setErrorTTL(self, value):
+        self.__errorTTL = self._parseTTL("errorTTL", value)
+
+    errorTTL = property(_getErrorTTL, _setErrorTTL,
+                        doc="Time in seconds for which an attribute "
+                            "authority isn't queried once its circuit has "
+                            "been opened")
+
+    def _getFailureThreshold(self):
+        return self.__failureThreshold
+
+    def _setFailureThreshold(self, value):
+        if isinstance(value, basestring):
+            value = int(value)
+            
+        elif not isinstance(value, (int, long)):
+            raise TypeError('Expecting int, long or string type for '
+                            '"failureThreshold"; got %r' % type(value))
+        
+        if value < 1:
+            raise ValueError('"failureThreshold" must be greater than zero; '
+                             'got %r' % value)
+        self.__failureThreshold = value
+
+    failureThreshold = property(_getFailureThreshold, _setFailureThreshold,
+                                doc="Number of consecutive errors querying "
+                                    "an attribute authority after which its "
+                                    "circuit is opened")
+    
+    def clear(self):
+        """Remove all entries and close all circuits"""
+        with self.__lock:
+            # (subject, attribute authority URI) to expiry time ordered by
+            # time added
+            self.__negativeEntries = OrderedDict()
+            
+            # Attribute authority URI to [number of consecutive failures, 
+            # time circuit is open until]
+            self.__circuits = {}
+        
+    def isNegative(self, subject, attributeAuthorityURI):
+        """Check for a cached negative result
+        
+        @type subject: basestring
+        @param subject: subject NameID value
+        @type attributeAuthorityURI: basestring
+        @param attributeAuthorityURI: attribute authority endpoint
+        @rtype: bool
+        @return: True if the attribute authority recently returned no 
+        attributes for this subject
+        """
+        key = (subject, attributeAuthorityURI)
+        with self.__lock:
+            expiry = self.__negativeEntries.get(key)
+            if expiry is None:
+                return False
+            
+            if time() >= expiry:
+                del self.__negativeEntries[key]
+                return False
+            
+            return True
+        
+    def addNegative(self, subject, attributeAuthorityURI):
+        """Record that an attribute authority returned no attributes for a
+        subject
+        
+        @type subject: basestring
+        @param subject: subject NameID value
+        @type attributeAuthorityURI: basestring
+        @param attributeAuthorityURI: attribute authority endpoint
+        """
+        key = (subject, attributeAuthorityURI)
+        now = time()
+        with self.__lock:
+            # Re-insert so that entries stay in order of expiry
+            self.__negativeEntries.pop(key, None)
+            self.__negativeEntries[key] = now + self.__negativeTTL
+            self._removeExpired(now)
+            
+    def removeNegative(self, subject, attributeAuthorityURI):
+        """Remove any negative result held for a subject and attribute
+        authority e.g. following a change to the subject's attributes
+        
+        @type subject: basestring
+        @param subject: subject NameID value
+        @type attributeAuthorityURI: basestring
+        @param attributeAuthorityURI: attribute authority endpoint
+        """
+        with self.__lock:
+            self.__negativeEntries.pop((subject, attributeAuthorityURI), None)
+        
+    def isCircuitOpen(self, attributeAuthorityURI):
+        """Check whether an attribute authority should be queried.  Once 
+        errorTTL has elapsed for an open circuit, the first caller is allowed
+        a trial query and the circuit stays open for other callers whilst it
+        is made
+        
+        @type attributeAuthorityURI: basestring
+        @param attributeAuthorityURI: attribute authority endpoint
+        @rtype: bool
+        @return: True if the attribute authority shouldn't be queried
+        """
+        with self.__lock:
+            circuit = self.__circuits.get(attributeAuthorityURI)
+            if circuit is None:
+                return False
+            
+            openUntil = circuit[AttributeAuthorityFailureCache.OPEN_UNTIL_IDX]
+            if openUntil is None:
+                return False
+            
+            now = time()
+            if now < openUntil:
+                return True
+            
+            circuit[AttributeAuthorityFailureCache.OPEN_UNTIL_IDX] = (
+                                                    now + self.__errorTTL)
+            log.debug("AttributeAuthorityFailureCache: allowing trial query "
+                      "to %r", attributeAuthorityURI)
+            return False
+        
+    def recordFailure(self, attributeAuthorityURI):
+        """Record an error querying an attribute authority opening its
+        circuit if failureThreshold consecutive errors have been recorded
         
+        @type attributeAuthorityURI: basestring
+        @param attributeAuthorityURI: attribute authority endpoint
+        """
+        with self.__lock:
+            circuit = self.__circuits.setdefault(attributeAuthorityURI, 
+                                                 [0, None])
+            circuit[AttributeAuthorityFailureCache.N_FAILURES_IDX] += 1
+            nFailures = circuit[AttributeAuthorityFailureCache.N_FAILURES_IDX]
+            if nFailures >= self.__failureThreshold:
+                circuit[AttributeAuthorityFailureCache.OPEN_UNTIL_IDX] = (
+                                                    time() + self.__errorTTL)
+                log.warning("AttributeAuthorityFailureCache: %d consecutive "
+                            "error(s) querying %r, suspending queries for %s "
+                            "second(s)", nFailures, attributeAuthorityURI,
+                            self.__errorTTL)
+                
+    def recordSuccess(self, attributeAuthorityURI):
+        """Record a successful query to an attribute authority closing its
+        circuit
         
+        @type attributeAuthorityURI: basestring
+        @param attributeAuthorityURI: attribute authority endpoint
+        """
+        with self.__lock:
+            self.__circuits.pop(attributeAuthorityURI, None)
+            
+    def audit(self):
+        """Remove expired negative entries"""
+        with self.__lock:
+            self._removeExpired(time())
+            
+    def _removeExpired(self, now):
+        """Remove expired negative entries.  Entries are held in order of 
+        expiry unless negativeTTL has been changed so stop at the first which
+        hasn't expired.  The lock must be held"""
+        while self.__negativeEntries:
+            key, expiry = next(self.__negativeEntries.iteritems())
+            if expiry > now:
+                break
+            
+            del self.__negativeEntries[key]
+            
+
 class CredentialRepositoryError(_CredentialWalletException):   
     """Exception handling for NDG Credential Repository class."""
 
@@ -484,6 +2400,30 @@ class CredentialRepository(object):
         """
         raise NotImplementedError(
             self.addCredentials.__doc__.replace('\n       ',''))
+        
+    def replaceCredentials(self, userId, credentialsMap):
+        """Replace the credentials held for a user for the given keys.  This
+        default implementation adds the credentials as (key, credential) 
+        tuples with addCredentials.  Derived classes should override it to 
+        remove credentials previously held for the keys.
+        
+        @type userId: string
+        @param userId: users userId, name or X.509 cert. distinguished name
+        @type credentialsMap: dict
+        @param credentialsMap: lists of credentials keyed by credential key
+        """
+        self.addCredentials(userId, [(key, credential)
+                                     for key, credentials in 
+                                     credentialsMap.items()
+                                     for credential in credentials])
+        
+    def flush(self):
+        """Complete any pending writes.  This default implementation does 
+        nothing"""
+        
+    def close(self):
+        """Complete any pending writes and release resources.  This default 
+        implementation does nothing"""
 
 
 class NullCredentialRepository(CredentialRepository):
@@ -504,4 +2444,656 @@ class NullCredentialRepository(CredentialRepository):
         return []
        
     def addCredentials(self, userId, attCertList):
-        """Null Credential Repository addCredentials placeholder"""
\ No newline at end of file
+        """Null Credential Repository addCredentials placeholder"""
+
+
+class SQLiteCredentialRepository(CredentialRepository):
+    """Credential Repository implementation using an SQLite database.  
+    Assertions are stored as XML together with their validity times.  Only
+    XML is stored so that loading credentials never unpickles data read from
+    the database file.  Assertions which can't be serialised as XML are 
+    rejected.
+    Expiry times are indexed so that auditing is carried out with a single
+    DELETE statement.
+    
+    The database connection is shared between threads and access to it is
+    serialised with a lock.  File based databases use write ahead logging so
+    that readers in other processes aren't blocked by writes.
+    """
+    PROPERTY_DEFAULTS = {
+        'dbFilePath': ':memory:',
+        'clockSkewTolerance': 0.,
+        'timeout': 5.
+    }
+    
+    # Assertion storage format.  Other values are rejected on loading
+    XML_FORMAT = 0
+    
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS users ("
+        "    userId TEXT PRIMARY KEY,"
+        "    dn TEXT)",
+        "CREATE TABLE IF NOT EXISTS credentials ("
+        "    id INTEGER PRIMARY KEY,"
+        "    userId TEXT NOT NULL "
+        "        REFERENCES users (userId) ON DELETE CASCADE,"
+        "    credentialKey TEXT NOT NULL,"
+        "    assertionId TEXT NOT NULL,"
+        "    notBefore REAL,"
+        "    notOnOrAfter REAL,"
+        "    format INTEGER NOT NULL,"
+        "    assertion BLOB NOT NULL,"
+        "    UNIQUE (userId, credentialKey, assertionId))",
+        "CREATE INDEX IF NOT EXISTS credentials_notOnOrAfter "
+        "    ON credentials (notOnOrAfter)"
+    )
+    
+    def __init__(self, propFilePath=None, dbPPhrase=None, **prop):
+        """Open the repository database creating the tables if necessary
+        
+        @type propFilePath: string
+        @param propFilePath: file path to a properties file setting any of
+        the options in PROPERTY_DEFAULTS
+        @type dbPPhrase: string
+        @param dbPPhrase: not applicable to SQLite and ignored
+        @type **prop: dict
+        @param **prop: dbFilePath - database file path, clockSkewTolerance - 
+        tolerance in seconds applied when auditing, timeout - seconds to wait 
+        for a lock held by another connection.  These override settings from
+        the properties file
+        """
+        if propFilePath is not None:
+            properties = readAndValidateProperties(
+                        propFilePath, 
+                        validKeys=SQLiteCredentialRepository.PROPERTY_DEFAULTS)
+        else:
+            properties = SQLiteCredentialRepository.PROPERTY_DEFAULTS.copy()
+            
+        invalidKeys = [k for k in prop 
+                       if k not in SQLiteCredentialRepository.PROPERTY_DEFAULTS]
+        if invalidKeys:
+            raise CredentialRepositoryError('Invalid property names: %s' %
+                                            ', '.join(invalidKeys))
+        properties.update(prop)
+        
+        self.__dbFilePath = os.path.expandvars(properties['dbFilePath'])
+        self.__clockSkewTolerance = _parseClockSkewTolerance(
+                                        properties['clockSkewTolerance'])
+        
+        self.__lock = threading.Lock()
+        try:
+            self.__connection = sqlite3.connect(
+                                        self.__dbFilePath,
+                                        timeout=float(properties['timeout']),
+                                        check_same_thread=False)
+            self.__connection.execute("PRAGMA foreign_keys = ON")
+            if self.__dbFilePath != ':memory:':
+                self.__connection.execute("PRAGMA journal_mode = WAL")
+            
+            with self.__connection:
+                for statement in SQLiteCredentialRepository.SCHEMA:
+                    self.__connection.execute(statement)
+                    
+        except sqlite3.Error, e:
+            raise CredentialRepositoryError('Error initialising credential '
+                                            'repository %r: %s' % 
+                                            (self.__dbFilePath, e))
+    
+    def _getDbFilePath(self):
+        return self.__dbFilePath
+    
+    dbFilePath = property(_getDbFilePath, doc="Database file path")
+    
+    def _getClockSkewTolerance(self):
+        return self.__clockSkewTolerance
+    
+    clockSkewTolerance = property(_getClockSkewTolerance, 
+                                  doc="Tolerance applied to expiry times "
+                                      "when auditing credentials")
+                
+    def _execute(self, func):
+        """Call func with the database connection in a transaction
+        
+        @type func: callable
+        @param func: function taking the connection as its argument
+        @return: return value of func
+        """
+        with self.__lock:
+            try:
+                with self.__connection:
+                    return func(self.__connection)
+                
+            except sqlite3.IntegrityError, e:
+                raise CredentialRepositoryError('Credential repository '
+                                                'integrity error: %s' % e)
+            except sqlite3.Error, e:
+                raise CredentialRepositoryError('Credential repository '
+                                                'error: %s' % e)
+    
+    def addUser(self, userId, dn=None):
+        """A new user to Credentials Repository
+        
+        @type userId: string
+        @param userId: userId for new user
+        @type dn: string
+        @param dn: users Distinguished Name (optional)
+        @raise CredentialRepositoryError: if the user is already registered
+        """
+        self._execute(lambda connection: connection.execute(
+            "INSERT INTO users (userId, dn) VALUES (?, ?)", (userId, dn)))
+                            
+    def auditCredentials(self, userId=None, **assertionValidKeys):
+        """Delete expired credentials
+        
+        @type userId: basestring/list or tuple
+        @param userId: audit credentials for the input user ID or list of IDs.
+        Defaults to all users
+        @type assertionValidKeys: dict
+        @param **assertionValidKeys: not used - validity times alone are 
+        checked
+        @rtype: int
+        @return: number of credentials deleted
+        """
+        cutoff = _toEpoch(datetime.utcnow() - self.__clockSkewTolerance)
+        statement = "DELETE FROM credentials WHERE notOnOrAfter <= ?"
+        params = [cutoff]
+        if userId is not None:
+            if isinstance(userId, basestring):
+                userId = [userId]
+                
+            statement += " AND userId IN (%s)" % ', '.join('?' * len(userId))
+            params.extend(userId)
+            
+        return self._execute(
+            lambda connection: connection.execute(statement, params).rowcount)
+        
+    def retrieveCredentials(self, userId):
+        """Get the list of credentials for a given user
+        
+        @type userId: string
+        @param userId: users userId, name or X.509 cert. distinguished name
+        @rtype: list 
+        @return: list of assertions"""
+        return [assertion 
+                for assertions in self.retrieveCredentialsMap(userId).values()
+                for assertion in assertions]
+        
+    def retrieveCredentialsMap(self, userId):
+        """Get the credentials for a given user organised by the keys they 
+        were saved with
+        
+        @type userId: string
+        @param userId: users userId, name or X.509 cert. distinguished name
+        @rtype: dict
+        @return: lists of assertions keyed by credential key"""
+        rows = self._execute(lambda connection: connection.execute(
+            "SELECT credentialKey, format, assertion FROM credentials "
+            "WHERE userId = ? ORDER BY id", (userId,)).fetchall())
+        
+        credentialsMap = {}
+        for key, _format, data in rows:
+            credentialsMap.setdefault(key, []).append(
+                                            self._loadAssertion(_format, data))
+        return credentialsMap
+    
+    def addCredentials(self, userId, credentialsList):
+        """Add credentials for a user.  The user must have been previously 
+        registered in the repository.  An assertion with the same key and ID
+        as one already held replaces it.  Other assertions held for the key
+        are kept - use replaceCredentials to replace all of them.
+
+        @type userId: string
+        @param userId: users userId, name or X.509 cert. distinguished name
+        @type credentialsList: list
+        @param credentialsList: list of assertions or (key, assertion) tuples.
+        Assertions without a key are saved with their issuer name as key
+        """
+        rows = [self._makeRow(userId, credential) 
+                for credential in credentialsList]
+        
+        self._execute(lambda connection: connection.executemany(
+            "INSERT OR REPLACE INTO credentials (userId, credentialKey, "
+            "assertionId, notBefore, notOnOrAfter, format, assertion) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)", rows))
+        
+    def replaceCredentials(self, userId, credentialsMap):
+        """Replace the credentials held for a user for the given keys in a
+        single transaction.  The user is registered if not already present.
+        
+        @type userId: string
+        @param userId: users userId, name or X.509 cert. distinguished name
+        @type credentialsMap: dict
+        @param credentialsMap: lists of assertions keyed by credential key
+        """
+        rows = [self._makeRow(userId, (key, assertion))
+                for key, assertions in credentialsMap.items()
+                for assertion in assertions]
+        
+        def _replace(connection):
+            connection.execute("INSERT OR IGNORE INTO users (userId) "
+                               "VALUES (?)", (userId,))
+            connection.executemany("DELETE FROM credentials WHERE userId = ? "
+                                   "AND credentialKey = ?",
+                                   [(userId, key) for key in credentialsMap])
+            connection.executemany(
+                "INSERT OR REPLACE INTO credentials (userId, credentialKey, "
+                "assertionId, notBefore, notOnOrAfter, format, assertion) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            
+        self._execute(_replace)
+        
+    def close(self):
+        """Close the database connection"""
+        with self.__lock:
+            self.__connection.close()
+        
+    def _makeRow(self, userId, credential):
+        """Make a credentials table row
+        
+        @type userId: string
+        @param userId: users userId
+        @type credential: ndg.saml.saml2.core.Assertion / tuple
+        @param credential: assertion or (key, assertion) tuple
+        @rtype: tuple
+        @return: row values
+        @raise CredentialRepositoryError: if the assertion can't be 
+        serialised as XML
+        """
+        if isinstance(credential, Assertion):
+            assertion = credential
+            key = assertion.issuer.value if assertion.issuer else ''
+        else:
+            key, assertion = credential
+            
+        if not isinstance(assertion, Assertion):
+            raise TypeError("Input credentials must be %r type; got %r" %
+                            (Assertion, assertion))
+            
+        notBefore, notOnOrAfter, data = _packAssertion(assertion)
+        if not isinstance(data, basestring):
+            raise CredentialRepositoryError('Assertion %r for key %r can\'t '
+                                            'be serialised as XML for '
+                                            'storage' % (assertion.id, key))
+            
+        return (userId,
+                key,
+                assertion.id or '',
+                _toEpoch(notBefore) if notBefore is not None else None,
+                _toEpoch(notOnOrAfter) if notOnOrAfter is not None else None,
+                SQLiteCredentialRepository.XML_FORMAT,
+                sqlite3.Binary(data))
+    
+    def _loadAssertion(self, _format, data):
+        """Rebuild an assertion from a credentials table row
+        
+        @type _format: int
+        @param _format: storage format
+        @type data: buffer
+        @param data: assertion data
+        @rtype: ndg.saml.saml2.core.Assertion
+        @return: assertion
+        @raise CredentialRepositoryError: if the storage format is not XML
+        """
+        if _format != SQLiteCredentialRepository.XML_FORMAT:
+            raise CredentialRepositoryError('Unsupported credential storage '
+                                            'format %r' % _format)
+        
+        return _unpackAssertion((None, None, str(data)))
+
+
+class WriteBehindCredentialRepository(CredentialRepository):
+    """Wrap a Credential Repository so that updates are written by a 
+    background thread.  This keeps storage latency out of request handling 
+    when wallets call updateCredentialRepository.
+    
+    Credential replacements and per user audits are queued and coalesced by
+    userId so that only the latest credentials for each key are written.  A
+    merged audit is carried out before the replacements if it was queued 
+    before any of them and after them if queued after any of them, so an 
+    audit is never lost behind a later replacement.  The
+    number of users with pending updates is bounded.  When the queue is full,
+    updates are either written synchronously in the caller's thread or 
+    rejected with CredentialRepositoryError depending on syncFallback.  
+    Reads and other operations for a user are carried out after any pending 
+    update for that user has been written.
+    """
+    DEFAULT_MAX_PENDING = 1024
+    
+    # Fields of pending update entries
+    AUDIT_IDX, CREDENTIALS_MAP_IDX, AUDIT_AFTER_IDX = range(3)
+    
+    def __init__(self, propFilePath=None, dbPPhrase=None, 
+                 credentialRepository=None, 
+                 maxPending=DEFAULT_MAX_PENDING,
+                 syncFallback=False,
+                 **prop):
+        """Start the background writer
+        
+        @type propFilePath: string
+        @param propFilePath: not used - configure the wrapped repository
+        @type dbPPhrase: string
+        @param dbPPhrase: not used - configure the wrapped repository
+        @type credentialRepository: CredentialRepository
+        @param credentialRepository: repository to write to
+        @type maxPending: int
+        @param maxPending: maximum number of users with pending updates
+        @type syncFallback: bool
+        @param syncFallback: set to True to write updates synchronously when
+        the queue is full instead of raising CredentialRepositoryError
+        @type **prop: dict
+        @param **prop: not used
+        """
+        if not isinstance(credentialRepository, CredentialRepository):
+            raise TypeError('Expecting %r type for "credentialRepository"; '
+                            'got %r' % (CredentialRepository, 
+                                        type(credentialRepository)))
+        if isinstance(maxPending, basestring):
+            maxPending = int(maxPending)
+        if maxPending < 1:
+            raise ValueError('"maxPending" must be greater than zero; got %r' %
+                             maxPending)
+        if isinstance(syncFallback, basestring):
+            syncFallback = str2Bool(syncFallback)
+            
+        self.__credentialRepository = credentialRepository
+        self.__maxPending = maxPending
+        self.__syncFallback = syncFallback
+        
+        # Pending updates keyed by userId in the order they were queued
+        self.__pending = OrderedDict()
+        
+        # userIds whose updates are being written
+        self.__inProgress = set()
+        self.__closed = False
+        self.__repositoryClosed = False
+        self.__condition = threading.Condition(threading.Lock())
+        
+        self.__worker = threading.Thread(target=self._run, 
+                                         name="WriteBehindCredentialRepository")
+        self.__worker.setDaemon(True)
+        self.__worker.start()
+        
+    def _getCredentialRepository(self):
+        return self.__credentialRepository
+    
+    credentialRepository = property(_getCredentialRepository,
+                                    doc="Wrapped credential repository")
+    
+    def _getMaxPending(self):
+        return self.__maxPending
+    
+    maxPending = property(_getMaxPending,
+                          doc="Maximum number of users with pending updates")
+    
+    def _getSyncFallback(self):
+        return self.__syncFallback
+    
+    syncFallback = property(_getSyncFallback,
+                            doc="Write updates synchronously when the queue is "
+                                "full")
+    
+    def _getNumPending(self):
+        with self.__condition:
+            return len(self.__pending) + len(self.__inProgress)
+    
+    numPending = property(_getNumPending, 
+                          doc="Number of users with updates waiting to be "
+                              "written or being written")
+    
+    def addUser(self, userId, dn=None):
+        """Add a user to the wrapped repository
+        
+        @type userId: string
+        @param userId: userId for new user
+        @type dn: string
+        @param dn: users Distinguished Name (optional)"""
+        self.__credentialRepository.addUser(userId, dn=dn)
+        
+    def auditCredentials(self, userId=None, **assertionValidKeys):
+        """Queue an audit of the credentials held for the given users.  If no
+        userId is given, pending updates are written and all users' 
+        credentials are audited synchronously
+        
+        @type userId: basestring/list or tuple
+        @param userId: audit credentials for the input user ID or list of IDs
+        @type assertionValidKeys: dict
+        @param **assertionValidKeys: passed to the wrapped repository for 
+        synchronous audits
+        """
+        if userId is None:
+            self.flush()
+            return self.__credentialRepository.auditCredentials(
+                                                        **assertionValidKeys)
+        
+        if isinstance(userId, basestring):
+            userId = [userId]
+            
+        for _userId in userId:
+            self._queue(_userId, True, {})
+    
+    def retrieveCredentials(self, userId):
+        """Get the list of credentials for a given user after writing any 
+        pending update for the user
+        
+        @type userId: string
+        @param userId: users userId, name or X.509 cert. distinguished name
+        @rtype: list 
+        @return: list of credentials"""
+        self.flush(userId=userId)
+        return self.__credentialRepository.retrieveCredentials(userId)
+    
+    def retrieveCredentialsMap(self, userId):
+        """Get the credentials for a given user organised by key after writing
+        any pending update for the user.  The wrapped repository must 
+        implement this method
+        
+        @type userId: string
+        @param userId: users userId, name or X.509 cert. distinguished name
+        @rtype: dict
+        @return: lists of credentials keyed by credential key"""
+        self.flush(userId=userId)
+        return self.__credentialRepository.retrieveCredentialsMap(userId)
+    
+    def addCredentials(self, userId, credentialsList):
+        """Add credentials for a user after writing any pending update for the
+        user
+
+        @type userId: string
+        @param userId: users userId, name or X.509 cert. distinguished name
+        @type credentialsList: list
+        @param credentialsList: list of credentials
+        """
+        self.flush(userId=userId)
+        self.__credentialRepository.addCredentials(userId, credentialsList)
+        
+    def replaceCredentials(self, userId, credentialsMap):
+        """Queue replacement of the credentials held for a user for the given
+        keys.  This is merged with any update already pending for the user
+        
+        @type userId: string
+        @param userId: users userId, name or X.509 cert. distinguished name
+        @type credentialsMap: dict
+        @param credentialsMap: lists of credentials keyed by credential key
+        """
+        self._queue(userId, False, dict(credentialsMap))
+        
+    def flush(self, userId=None, timeout=None):
+        """Wait for pending updates to be written
+        
+        @type userId: string / None type
+        @param userId: wait for updates for this user only.  Defaults to all 
+        users
+        @type timeout: float / None type
+        @param timeout: maximum time in seconds to wait
+        @rtype: bool
+        @return: True if the updates were written, False if the timeout was
+        reached
+        """
+        if userId is None:
+            isPending = lambda: self.__pending or self.__inProgress
+        else:
+            isPending = lambda: (userId in self.__pending or 
+                                 userId in self.__inProgress)
+            
+        if timeout is not None:
+            endTime = time() + timeout
+            
+        with self.__condition:
+            while isPending():
+                if timeout is None:
+                    self.__condition.wait()
+                else:
+                    remaining = endTime - time()
+                    if remaining <= 0:
+                        return False
+                    self.__condition.wait(remaining)
+                    
+        return True
+    
+    def close(self, timeout=None):
+        """Write pending updates, stop the background thread and close the 
+        wrapped repository.  No further updates are accepted once this is 
+        called.  If the timeout is reached, the wrapped repository is left 
+        open for the background thread to finish writing and 
+        CredentialRepositoryError is raised.  Call close again to wait for it
+        
+        @type timeout: float / None type
+        @param timeout: maximum time in seconds to wait for pending updates
+        @raise CredentialRepositoryError: timed out waiting for pending 
+        updates to be written
+        """
+        if timeout is not None:
+            endTime = time() + timeout
+            
+        getRemaining = lambda: (None if timeout is None 
+                                else max(endTime - time(), 0.))
+        
+        with self.__condition:
+            if self.__repositoryClosed:
+                return
+            
+            # The worker writes any updates still pending before it exits
+            self.__closed = True
+            self.__condition.notifyAll()
+            
+        # Also wait for synchronous writes made in callers' threads
+        written = self.flush(timeout=getRemaining())
+        self.__worker.join(getRemaining())
+        if not written or self.__worker.isAlive():
+            raise CredentialRepositoryError('Timed out waiting for pending '
+                                            'credential updates to be '
+                                            'written; the wrapped credential '
+                                            'repository has not been closed')
+            
+        with self.__condition:
+            if self.__repositoryClosed:
+                return
+            self.__repositoryClosed = True
+            
+        self.__credentialRepository.close()
+        
+    def _queue(self, userId, auditCred, credentialsMap):
+        """Queue an update for a user merging it with any already pending
+        
+        @type userId: string
+        @param userId: users userId
+        @type auditCred: bool
+        @param auditCred: audit the user's credentials before writing
+        @type credentialsMap: dict
+        @param credentialsMap: lists of credentials keyed by credential key
+        """
+        with self.__condition:
+            if self.__closed:
+                raise CredentialRepositoryError('Credential repository is '
+                                                'closed')
+            
+            entry = self.__pending.get(userId)
+            if entry is not None:
+                # Keep the audit in order relative to pending replacements
+                if auditCred:
+                    if entry[WriteBehindCredentialRepository.
+                             CREDENTIALS_MAP_IDX]:
+                        auditIdx = WriteBehindCredentialRepository.\
+                                                            AUDIT_AFTER_IDX
+                    else:
+                        auditIdx = WriteBehindCredentialRepository.AUDIT_IDX
+                    entry[auditIdx] = True
+                    
+                entry[WriteBehindCredentialRepository.CREDENTIALS_MAP_IDX
+                      ].update(credentialsMap)
+                return
+            
+            if len(self.__pending) < self.__maxPending:
+                self.__pending[userId] = [auditCred, credentialsMap, False]
+                self.__condition.notifyAll()
+                return
+            
+            if not self.__syncFallback:
+                raise CredentialRepositoryError('Credential repository write '
+                                                'queue is full')
+            
+            # Write in this thread once any update in progress for this user
+            # has completed
+            while userId in self.__inProgress:
+                self.__condition.wait()
+            self.__inProgress.add(userId)
+            
+        try:
+            self._write(userId, auditCred, credentialsMap)
+        finally:
+            with self.__condition:
+                self.__inProgress.discard(userId)
+                self.__condition.notifyAll()
+            
+    def _write(self, userId, auditCred, credentialsMap, auditAfter=False):
+        """Write an update to the wrapped repository
+        
+        @type userId: string
+        @param userId: users userId
+        @type auditCred: bool
+        @param auditCred: audit the user's credentials before writing
+        @type credentialsMap: dict
+        @param credentialsMap: lists of credentials keyed by credential key
+        @type auditAfter: bool
+        @param auditAfter: audit the user's credentials after writing
+        """
+        if auditCred:
+            self.__credentialRepository.auditCredentials(userId=userId)
+            
+        if credentialsMap:
+            self.__credentialRepository.replaceCredentials(userId, 
+                                                           credentialsMap)
+            
+        if auditAfter:
+            self.__credentialRepository.auditCredentials(userId=userId)
+            
+    def _run(self):
+        """Background thread writing queued updates"""
+        while True:
+            with self.__condition:
+                userId = None
+                while userId is None:
+                    # Skip any users with a synchronous write in progress
+                    for _userId in self.__pending:
+                        if _userId not in self.__inProgress:
+                            userId = _userId
+                            break
+                    else:
+                        if self.__closed:
+                            return
+                        self.__condition.wait()
+                        
+                auditCred, credentialsMap, auditAfter = self.__pending.pop(
+                                                                        userId)
+                self.__inProgress.add(userId)
+                
+            try:
+                self._write(userId, auditCred, credentialsMap, 
+                            auditAfter=auditAfter)
+            except Exception, e:
+                log.exception("Error writing credentials for user %r to the "
+                              "credential repository: %s", userId, e)
+            finally:
+                with self.__condition:
+                    self.__inProgress.discard(userId)
+                    self.__condition.notifyAll()
@@ -0,0 +1,560 @@
+"""SAML 2.0 Attribute Query client querying multiple attribute authorities
+concurrently
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "17/10/26"
+__copyright__ = "(C) 2009 Science and Technology Facilities Council"
+__license__ = "BSD - see LICENSE file in top-level directory"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import logging
+log = logging.getLogger(__name__)
+import threading
+import Queue
+from time import time
+
+# datetime.strptime imports _strptime on first use which isn't thread safe.
+# Import it here as SAML timestamps are parsed in concurrent threads
+import _strptime
+from collections import OrderedDict
+
+from ndg.saml.saml2.core import Attribute, Issuer, StatusCode
+from ndg.saml.xml.etree import AttributeQueryElementTree
+from ndg.saml.saml2.binding.soap import SOAPBindingInvalidResponse
+from ndg.saml.saml2.binding.soap.client import SOAPBinding
+from ndg.soap.etree import SOAPEnvelope
+from ndg.soap.client import UrlLib2SOAPRequest
+
+from ndg.security.common.saml_utils.esgf import (ESGFSamlNamespaces,
+                                                 ESGFDefaultQueryAttributes)
+from ndg.security.common.saml_utils.esgf.xml.etree import \
+    ESGFResponseElementTree
+from ndg.security.common.saml_utils.esgf.xml.template import \
+    ESGFAttributeQueryTemplate
+from ndg.security.common.credentialwallet import (
+                                                AttributeAuthorityFailureCache,
+                                                CredentialWalletError)
+from ndg.security.common.utils.connectionpool import (HTTPConnectionPool,
+                                                      PooledHTTPHandler,
+                                                      PooledHTTPSHandler)
+
+
+class AttributeQueryFanOutError(Exception):
+    """Error querying an attribute authority"""
+
+
+class AttributeQueryTimeoutError(AttributeQueryFanOutError):
+    """No response was received from an attribute authority within its
+    timeout"""
+
+
+class AttributeAuthorityUnavailableError(AttributeQueryFanOutError):
+    """Attribute authority not queried because its circuit is open following
+    repeated errors"""
+
+
+class AttributeQueryNegativeResultError(AttributeQueryFanOutError):
+    """Attribute authority not queried because it recently returned no
+    attributes for the subject"""
+
+
+class _SerialisedQuerySOAPEnvelope(SOAPEnvelope):
+    """SOAP envelope for a query already serialised from its template.  The 
+    query XML is inserted into the serialised envelope rather than being
+    parsed into the body element
+    """
+    QUERY_FIELD = '${query}'
+    
+    # Serialised empty envelope split either side of the body content
+    envelope = SOAPEnvelope()
+    envelope.create()
+    envelope.body.elem.text = QUERY_FIELD
+    ENVELOPE_FRAGMENTS = tuple(envelope.serialize().split(QUERY_FIELD))
+    del envelope
+    
+    def __init__(self, queryXML):
+        """@type queryXML: str
+        @param queryXML: serialised query for the SOAP body
+        """
+        SOAPEnvelope.__init__(self)
+        self.__queryXML = queryXML
+        
+    def _getQueryXML(self):
+        return self.__queryXML
+    
+    queryXML = property(_getQueryXML, doc="Serialised query")
+    
+    def serialize(self):
+        """Serialise the envelope with the query in its body"""
+        return self.__class__.ENVELOPE_FRAGMENTS[0] + self.__queryXML + \
+            self.__class__.ENVELOPE_FRAGMENTS[1]
+
+
+class AttributeAuthorityMapping(object):
+    """Mapping of attribute IDs to the attribute authorities which hold them
+    as read from a Policy Information Point mapping file.  Entries are
+    whitespace delimited <attribute id> <attribute authority> pairs, one per
+    line.  An attribute ID may be mapped to more than one authority.  Blank
+    lines and lines starting with '#' are ignored
+    """
+    COMMENT_CHAR = '#'
+
+    def __init__(self):
+        self.__attributeAuthorities = OrderedDict()
+
+    @classmethod
+    def fromFile(cls, filePath):
+        """Create from a mapping file
+
+        @type filePath: basestring
+        @param filePath: mapping file path
+        @rtype: AttributeAuthorityMapping
+        @return: new mapping
+        """
+        mapping = cls()
+        mappingFile = open(filePath)
+        try:
+            mapping.parse(mappingFile)
+        finally:
+            mappingFile.close()
+
+        return mapping
+
+    def parse(self, lines):
+        """Read mapping entries
+
+        @type lines: iterable
+        @param lines: mapping file lines
+        @raise ValueError: invalid mapping entry
+        """
+        for lineNum, line in enumerate(lines):
+            line = line.strip()
+            if not line or line.startswith(self.__class__.COMMENT_CHAR):
+                continue
+
+            fields = line.split()
+            if len(fields) != 2:
+                raise ValueError('Expecting <attribute id> <attribute '
+                                 'authority> mapping entry at line %d; got %r'
+                                 % (lineNum + 1, line))
+            self.add(*fields)
+
+    def add(self, attributeId, attributeAuthorityURI):
+        """Map an attribute ID to an attribute authority
+
+        @type attributeId: basestring
+        @param attributeId: attribute ID
+        @type attributeAuthorityURI: basestring
+        @param attributeAuthorityURI: attribute authority endpoint
+        """
+        uris = self.__attributeAuthorities.setdefault(attributeId, [])
+        if attributeAuthorityURI not in uris:
+            uris.append(attributeAuthorityURI)
+
+    def getAttributeAuthorities(self, attributeId):
+        """Get the attribute authorities for an attribute ID
+
+        @type attributeId: basestring
+        @param attributeId: attribute ID
+        @rtype: list
+        @return: attribute authority endpoints
+        """
+        return list(self.__attributeAuthorities.get(attributeId, ()))
+
+    def groupByAuthority(self, attributeIds):
+        """Group attribute IDs by the attribute authorities which hold them
+
+        @type attributeIds: iterable
+        @param attributeIds: attribute IDs
+        @rtype: collections.OrderedDict
+        @return: attribute authority endpoint to attribute IDs map.  Attribute
+        IDs with no mapping entry are omitted
+        """
+        attributeIdsByAuthority = OrderedDict()
+        for attributeId in attributeIds:
+            uris = self.__attributeAuthorities.get(attributeId)
+            if not uris:
+                log.warning("No attribute authority is mapped to attribute "
+                            "ID %r", attributeId)
+                continue
+
+            for uri in uris:
+                ids = attributeIdsByAuthority.setdefault(uri, [])
+                if attributeId not in ids:
+                    ids.append(attributeId)
+
+        return attributeIdsByAuthority
+
+    def __contains__(self, attributeId):
+        return attributeId in self.__attributeAuthorities
+
+    def __len__(self):
+        return len(self.__attributeAuthorities)
+
+
+class AttributeQueryFanOutClient(object):
+    """Query the attribute authorities holding a set of attributes
+    concurrently.  Requested attributes are grouped by authority using an
+    AttributeAuthorityMapping and one query is sent to each authority from a
+    separate thread so that overall latency is that of the slowest authority
+    rather than the sum of them all.  Each authority has its own timeout.
+
+    Assertions are added to a SAMLAssertionWallet, keyed by attribute
+    authority endpoint, from the calling thread as each response arrives.
+
+    An optional AttributeAuthorityFailureCache skips authorities which
+    recently returned no attributes for the subject or are failing.
+    """
+    DEFAULT_TIMEOUT = 30.
+
+    def __init__(self,
+                 mapping,
+                 issuerName,
+                 issuerFormat=Issuer.X509_SUBJECT,
+                 subjectIdFormat=ESGFSamlNamespaces.NAMEID_FORMAT,
+                 timeout=DEFAULT_TIMEOUT,
+                 timeouts=None,
+                 connectionPool=None,
+                 sslContext=None,
+                 failureCache=None):
+        """
+        @type mapping: AttributeAuthorityMapping
+        @param mapping: attribute ID to attribute authority mapping
+        @type issuerName: basestring
+        @param issuerName: issuer of queries
+        @type issuerFormat: basestring
+        @param issuerFormat: issuer name format
+        @type subjectIdFormat: basestring
+        @param subjectIdFormat: subject ID format
+        @type timeout: float
+        @param timeout: default timeout (seconds) for each authority
+        @type timeouts: dict / None type
+        @param timeouts: timeouts for specific authorities keyed by endpoint
+        @type connectionPool: ndg.security.common.utils.connectionpool.
+        HTTPConnectionPool / None type
+        @param connectionPool: pool of persistent connections to send queries
+        with.  If omitted, a new connection is made for each query
+        @type sslContext: ssl.SSLContext / None type
+        @param sslContext: SSL context for HTTPS connections made with
+        connectionPool.  This replaces the M2Crypto SSL configuration of the
+        SOAP binding.  If None, the standard library default context is used
+        @type failureCache: ndg.security.common.credentialwallet.
+        AttributeAuthorityFailureCache / None type
+        @param failureCache: negative result cache and circuit breaker for
+        the attribute authorities queried.  This may be shared between
+        clients
+        """
+        if not isinstance(mapping, AttributeAuthorityMapping):
+            raise TypeError('Expecting %r type for "mapping"; got %r' %
+                            (AttributeAuthorityMapping, type(mapping)))
+        self.__mapping = mapping
+        self.__issuerName = issuerName
+        self.__issuerFormat = issuerFormat
+        self.__subjectIdFormat = subjectIdFormat
+        self.__timeout = float(timeout)
+        self.__timeouts = dict(timeouts or {})
+
+        if (connectionPool is not None and
+            not isinstance(connectionPool, HTTPConnectionPool)):
+            raise TypeError('Expecting %r type for "connectionPool"; got %r' %
+                            (HTTPConnectionPool, type(connectionPool)))
+        self.__connectionPool = connectionPool
+        self.__sslContext = sslContext
+
+        if (failureCache is not None and
+            not isinstance(failureCache, AttributeAuthorityFailureCache)):
+            raise TypeError('Expecting %r type for "failureCache"; got %r' %
+                            (AttributeAuthorityFailureCache,
+                             type(failureCache)))
+        self.__failureCache = failureCache
+
+        # Query templates keyed by the attribute IDs queried
+        self.__templates = {}
+        self.__templatesLock = threading.Lock()
+
+    def _getMapping(self):
+        return self.__mapping
+
+    mapping = property(_getMapping,
+                       doc="Attribute ID to attribute authority mapping")
+
+    def _getTimeout(self):
+        return self.__timeout
+
+    timeout = property(_getTimeout,
+                       doc="Default timeout (seconds) for each authority")
+
+    def _getConnectionPool(self):
+        return self.__connectionPool
+
+    connectionPool = property(_getConnectionPool,
+                              doc="Pool of persistent connections to send "
+                                  "queries with or None")
+
+    def _getFailureCache(self):
+        return self.__failureCache
+
+    failureCache = property(_getFailureCache,
+                            doc="Negative result cache and circuit breaker "
+                                "for the attribute authorities queried or "
+                                "None")
+
+    def getTimeout(self, attributeAuthorityURI):
+        """Get the timeout for an attribute authority
+
+        @type attributeAuthorityURI: basestring
+        @param attributeAuthorityURI: attribute authority endpoint
+        @rtype: float
+        @return: timeout (seconds)
+        """
+        return self.__timeouts.get(attributeAuthorityURI, self.__timeout)
+
+    def setTimeout(self, attributeAuthorityURI, timeout):
+        """Set the timeout for an attribute authority
+
+        @type attributeAuthorityURI: basestring
+        @param attributeAuthorityURI: attribute authority endpoint
+        @type timeout: float
+        @param timeout: timeout (seconds)
+        """
+        self.__timeouts[attributeAuthorityURI] = float(timeout)
+
+    def _getTemplate(self, attributeIds):
+        """Get the query template for a set of attribute IDs creating it if
+        necessary
+        """
+        key = tuple(attributeIds)
+        template = self.__templates.get(key)
+        if template is None:
+            attributes = []
+            for attributeId in attributeIds:
+                attribute = Attribute()
+                attribute.name = attributeId
+                attribute.nameFormat = ESGFDefaultQueryAttributes.XSSTRING_NS
+                attributes.append(attribute)
+
+            template = ESGFAttributeQueryTemplate(self.__issuerName,
+                                        issuerFormat=self.__issuerFormat,
+                                        subjectIdFormat=self.__subjectIdFormat,
+                                        attributes=attributes)
+            self.__templatesLock.acquire()
+            try:
+                template = self.__templates.setdefault(key, template)
+            finally:
+                self.__templatesLock.release()
+
+        return template
+
+    def _makeBinding(self, attributeAuthorityURI):
+        """Make a SOAP binding for querying an attribute authority.  Override
+        to customise the transport
+
+        @type attributeAuthorityURI: basestring
+        @param attributeAuthorityURI: attribute authority endpoint
+        @rtype: ndg.saml.saml2.binding.soap.client.SOAPBinding
+        @return: binding with timeout set for this authority
+        """
+        binding = SOAPBinding()
+        binding.serialise = AttributeQueryElementTree.toXML
+        binding.deserialise = ESGFResponseElementTree.fromXML
+        binding.client.timeout = self.getTimeout(attributeAuthorityURI)
+        if self.__connectionPool is not None:
+            openerDirector = binding.client.openerDirector
+            openerDirector.add_handler(
+                                PooledHTTPHandler(self.__connectionPool))
+            openerDirector.add_handler(
+                                PooledHTTPSHandler(self.__connectionPool,
+                                                   sslContext=self.__sslContext))
+        return binding
+
+    def _send(self, attributeAuthorityURI, subjectId, attributeIds,
+              responseQueue):
+        """Query an attribute authority putting the response or the
+        exception raised on the response queue
+        """
+        try:
+            # Serialise direct from the template rather than building and
+            # serialising the query element tree
+            queryXML = self._getTemplate(attributeIds).serialise(subjectId)
+            binding = self._makeBinding(attributeAuthorityURI)
+            
+            request = UrlLib2SOAPRequest()
+            request.envelope = _SerialisedQuerySOAPEnvelope(queryXML)
+            request.envelope.create()
+            request.url = attributeAuthorityURI
+            log.debug("Attribute query for %r: %s", attributeAuthorityURI, 
+                      queryXML)
+            
+            response = binding.client.send(request)
+            if len(response.envelope.body.elem) != 1:
+                raise SOAPBindingInvalidResponse("Expecting single child "
+                                                 "element in SOAP body")
+                
+            result = binding.deserialise(response.envelope.body.elem[0])
+
+        except Exception, e:
+            log.error("Error querying attribute authority %r: %s",
+                      attributeAuthorityURI, e)
+            result = e
+
+        responseQueue.put((attributeAuthorityURI, result))
+
+    def query(self, subjectId, attributeIds, wallet=None):
+        """Query the attribute authorities holding the given attributes
+
+        @type subjectId: basestring
+        @param subjectId: subject to query attributes for
+        @type attributeIds: iterable
+        @param attributeIds: IDs of attributes to query
+        @type wallet: ndg.security.common.credentialwallet.SAMLAssertionWallet
+        / None type
+        @param wallet: wallet to add assertions to as each response arrives.
+        Assertions are added only for responses with a success status
+        @rtype: collections.OrderedDict
+        @return: attribute authority endpoint to result map.  Results are
+        the Response object returned by the authority or, for authorities
+        which couldn't be queried, were skipped by the failure cache,
+        didn't respond in time or returned assertions rejected by the
+        wallet, the exception raised
+        """
+        attributeIdsByAuthority = self.__mapping.groupByAuthority(
+                                                                attributeIds)
+        results = OrderedDict.fromkeys(attributeIdsByAuthority)
+        if not results:
+            return results
+
+        responseQueue = Queue.Queue()
+        deadlines = {}
+        for uri, ids in attributeIdsByAuthority.items():
+            skipped = self._checkFailureCache(subjectId, uri)
+            if skipped is not None:
+                results[uri] = skipped
+                continue
+
+            deadlines[uri] = time() + self.getTimeout(uri)
+            thread = threading.Thread(target=self._send,
+                                      args=(uri, subjectId, ids,
+                                            responseQueue),
+                                      name="AttributeQuery: %s" % uri)
+
+            # Don't prevent exit for authorities which fail to respond
+            thread.daemon = True
+            thread.start()
+
+        # The socket timeout applies to individual reads so also enforce each
+        # authority's timeout here
+        pending = set(deadlines)
+        while pending:
+            wait = min([deadlines[uri] for uri in pending]) - time()
+            try:
+                uri, result = responseQueue.get(timeout=max(wait, 0.))
+
+            except Queue.Empty:
+                now = time()
+                for uri in [uri for uri in pending if deadlines[uri] <= now]:
+                    pending.discard(uri)
+                    results[uri] = AttributeQueryTimeoutError(
+                            'No response from attribute authority %r within '
+                            'the %s second(s) timeout' %
+                            (uri, self.getTimeout(uri)))
+                    self._updateFailureCache(subjectId, uri, results[uri])
+                continue
+
+            if uri not in pending:
+                # Response received after this authority timed out
+                continue
+
+            pending.discard(uri)
+            if wallet is not None and not isinstance(result, Exception):
+                try:
+                    self._addCredentials(wallet, uri, result)
+
+                except CredentialWalletError, e:
+                    log.error("Error adding assertions from attribute "
+                              "authority %r to the wallet: %s", uri, e)
+                    result = e
+
+            results[uri] = result
+            self._updateFailureCache(subjectId, uri, result)
+
+        return results
+
+    def _checkFailureCache(self, subjectId, attributeAuthorityURI):
+        """Check whether an attribute authority should be skipped
+
+        @rtype: AttributeQueryFanOutError / None type
+        @return: exception to return as the result for the authority or None
+        if it should be queried
+        """
+        if self.__failureCache is None:
+            return None
+
+        if self.__failureCache.isNegative(subjectId, attributeAuthorityURI):
+            return AttributeQueryNegativeResultError(
+                        'Attribute authority %r recently returned no '
+                        'attributes for subject %r' %
+                        (attributeAuthorityURI, subjectId))
+
+        if self.__failureCache.isCircuitOpen(attributeAuthorityURI):
+            return AttributeAuthorityUnavailableError(
+                        'Attribute authority %r is not being queried '
+                        'following repeated errors' % attributeAuthorityURI)
+
+        return None
+
+    def _updateFailureCache(self, subjectId, attributeAuthorityURI, result):
+        """Record the result of querying an attribute authority in the
+        failure cache.  Responses with a success status and no assertions or
+        with an unknown principal status are cached as negative results for
+        the subject.  Other statuses are recorded as failures of the
+        authority
+        """
+        if self.__failureCache is None:
+            return
+
+        if isinstance(result, Exception):
+            self.__failureCache.recordFailure(attributeAuthorityURI)
+            return
+
+        statusCodeValue = self._getStatusCodeValue(result)
+        if statusCodeValue == StatusCode.SUCCESS_URI:
+            self.__failureCache.recordSuccess(attributeAuthorityURI)
+            if len(result.assertions) == 0:
+                self.__failureCache.addNegative(subjectId,
+                                                attributeAuthorityURI)
+
+        elif statusCodeValue == StatusCode.UNKNOWN_PRINCIPAL_URI:
+            self.__failureCache.recordSuccess(attributeAuthorityURI)
+            self.__failureCache.addNegative(subjectId, attributeAuthorityURI)
+
+        else:
+            self.__failureCache.recordFailure(attributeAuthorityURI)
+
+    @staticmethod
+    def _getStatusCodeValue(response):
+        if response.status is None or response.status.statusCode is None:
+            return None
+
+        return response.status.statusCode.value
+
+    @classmethod
+    def _isSuccess(cls, response):
+        return cls._getStatusCodeValue(response) == StatusCode.SUCCESS_URI
+
+    def _addCredentials(self, wallet, attributeAuthorityURI, response):
+        """Add the assertions from a response to a wallet
+
+        @raise ndg.security.common.credentialwallet.CredentialWalletError:
+        the response contains an assertion outside its validity period
+        """
+        if not self._isSuccess(response):
+            log.warning("Attribute authority %r returned a response with "
+                        "status %r: no assertions added to the wallet",
+                        attributeAuthorityURI,
+                        self._getStatusCodeValue(response))
+            return
+
+        if len(response.assertions) > 0:
+            wallet.addCredentials(attributeAuthorityURI, response.assertions)
@@ -8,6 +8,10 @@ __copyright__ = "(C) 2009 Science and Technology Facilities Council"
 __license__ = "BSD - see LICENSE file in top-level directory"
 __contact__ = "Philip.Kershaw@stfc.ac.uk"
 __revision__ = '$Id$'
+import threading
+import copy
+from weakref import WeakValueDictionary
+
 from ndg.saml.saml2.core import (XSStringAttributeValue, AttributeValue, 
                                  Attribute)
 from ndg.saml.common.xml import QName, SAMLConstants
@@ -51,9 +55,11 @@ class ESGFSamlNamespaces(object):
     __metaclass__ = _MetaESGFSamlNamespaces
     
     
-class ESGFGroupRoleAttributeValue(AttributeValue): 
-    '''ESG Specific Group/Role attribute value.  ESG attribute permissions are
-    organised into group/role pairs
+class ESGFGroupRoleAttributeValueBase(AttributeValue):
+    '''Base class for ESG Group/Role attribute values.  It adds no instance
+    attributes so that derived classes may be fully slotted.  Check for 
+    Group/Role values with this type to match both mutable and interned 
+    values
     '''
     DEFAULT_NS = "http://www.earthsystemgrid.org"
     DEFAULT_PREFIX = "esg"
@@ -67,11 +73,41 @@ class ESGFGroupRoleAttributeValue(AttributeValue):
     TYPE_NAME = QName(DEFAULT_NS, 
                       TYPE_LOCAL_NAME, 
                       DEFAULT_PREFIX)
-     
-    def __init__(self, 
-                 namespaceURI=DEFAULT_NS, 
-                 elementLocalName=TYPE_LOCAL_NAME, 
-                 namespacePrefix=DEFAULT_PREFIX):
+    
+    __slots__ = ()
+    
+    def getOrderedChildren(self):
+        # no children
+        return None
+    
+    
+class ESGFGroupRoleAttributeValue(ESGFGroupRoleAttributeValueBase): 
+    '''ESG Specific Group/Role attribute value.  ESG attribute permissions are
+    organised into group/role pairs
+    '''
+    # Attributes saved when pickling
+    __PICKLED_ATTRNAMES = (
+        '__namespaceURI',
+        '__elementLocalName',
+        '__namespacePrefix',
+        '__group',
+        '__role'
+    )
+    
+    # Class level defaults for instances unpickled from state saved by 
+    # earlier versions which didn't include these attributes
+    __namespaceURI = ESGFGroupRoleAttributeValueBase.DEFAULT_NS
+    __elementLocalName = ESGFGroupRoleAttributeValueBase.TYPE_LOCAL_NAME
+    __namespacePrefix = ESGFGroupRoleAttributeValueBase.DEFAULT_PREFIX
+    __group = None
+    __role = None
+
+    def __init__(self,
+                 namespaceURI=ESGFGroupRoleAttributeValueBase.DEFAULT_NS, 
+                 elementLocalName=
+                    ESGFGroupRoleAttributeValueBase.TYPE_LOCAL_NAME, 
+                 namespacePrefix=
+                    ESGFGroupRoleAttributeValueBase.DEFAULT_PREFIX):
         '''@param namespaceURI: the namespace the element is in
         @param elementLocalName: the local name of the XML element this Object 
         represents
@@ -156,33 +192,476 @@ class ESGFGroupRoleAttributeValue(AttributeValue):
     
     value = property(_getValue, _setValue, 
                      doc="group/role attribute value tuple")
+
+    def __getstate__(self):
+        '''Enable pickling
+
+        @return: object's attribute dictionary
+        @rtype: dict
+        '''
+        _dict = super(ESGFGroupRoleAttributeValue, self).__getstate__()
+        for attrName in ESGFGroupRoleAttributeValue.__PICKLED_ATTRNAMES:
+            # Ugly hack to allow for derived classes setting private member
+            # variables
+            if attrName.startswith('__'):
+                attrName = "_ESGFGroupRoleAttributeValue" + attrName
+
+            try:
+                _dict[attrName] = getattr(self, attrName)
+            except AttributeError:
+                pass
+
+        return _dict
+
+
+class ESGFInternedGroupRoleAttributeValue(ESGFGroupRoleAttributeValueBase):
+    '''Immutable and hashable ESG Group/Role attribute value.  Instances are
+    interned so that repeated group/role pairs share a single object and
+    namespace settings are the class defaults rather than held per instance.
+    Group and role are held in slots - there is no instance dictionary - and
+    attributes can't be set once created.  Create with a group and 
+    optionally a role, or from an existing value with fromValue.
     
-    def getOrderedChildren(self):
-        # no children
-        return None
+    Interned values compare equal only to other interned values.  Mutable
+    ESGFGroupRoleAttributeValue instances hash by identity and so never 
+    compare equal to an interned value - convert them with fromValue first.
+    '''
+    # __weakref__ is needed for the intern table
+    __slots__ = ('__group', '__role', '__hash', '__weakref__')
+
+    # Intern table of (group, role) to instances
+    __instances = WeakValueDictionary()
+    __instancesLock = threading.Lock()
+
+    def __new__(cls, group, 
+                role=ESGFGroupRoleAttributeValueBase.DEFAULT_ROLE_NAME):
+        for name, value in (('group', group), ('role', role)):
+            if not isinstance(value, basestring):
+                raise TypeError('Expecting a string type for "%s" attribute; '
+                                'got %r' % (name, type(value)))
+                
+        key = (group, role)
+        cls.__instancesLock.acquire()
+        try:
+            attributeValue = cls.__instances.get(key)
+            if attributeValue is None:
+                attributeValue = super(ESGFInternedGroupRoleAttributeValue,
+                                       cls).__new__(cls)
+                
+                # Bypass __setattr__ which rejects all updates
+                for attrName, value in (('__group', group), 
+                                        ('__role', role), 
+                                        ('__hash', hash(key))):
+                    object.__setattr__(attributeValue, 
+                                       '_ESGFInternedGroupRoleAttributeValue' +
+                                       attrName, 
+                                       value)
+                cls.__instances[key] = attributeValue
+        finally:
+            cls.__instancesLock.release()
+
+        return attributeValue
+
+    def __init__(self, group, 
+                 role=ESGFGroupRoleAttributeValueBase.DEFAULT_ROLE_NAME):
+        '''Instances are set up in __new__ so that interned ones are not
+        reset
+
+        @param group: group name
+        @type group: basestring
+        @param role: role name, defaults to DEFAULT_ROLE_NAME
+        @type role: basestring
+        '''
+
+    @classmethod
+    def fromValue(cls, attributeValue):
+        '''Get the interned instance equivalent to a Group/Role attribute
+        value
+
+        @param attributeValue: Group/Role attribute value
+        @type attributeValue: ESGFGroupRoleAttributeValueBase
+        @return: interned Group/Role attribute value
+        @rtype: ESGFInternedGroupRoleAttributeValue
+        '''
+        if isinstance(attributeValue, cls):
+            return attributeValue
+
+        if not isinstance(attributeValue, ESGFGroupRoleAttributeValueBase):
+            raise TypeError('Expecting %r type; got %r' %
+                            (ESGFGroupRoleAttributeValueBase,
+                             type(attributeValue)))
+
+        return cls(attributeValue.group, attributeValue.role)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%r instances are immutable' % self.__class__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%r instances are immutable' % self.__class__)
+
+    namespaceURI = property(
+            fget=lambda self: ESGFGroupRoleAttributeValueBase.DEFAULT_NS,
+            doc="the namespace the element is in")
+
+    elementLocalName = property(
+            fget=lambda self: ESGFGroupRoleAttributeValueBase.TYPE_LOCAL_NAME,
+            doc="the local name of the XML element this Object represents")
+
+    namespacePrefix = property(
+            fget=lambda self: ESGFGroupRoleAttributeValueBase.DEFAULT_PREFIX,
+            doc="the prefix for the given namespace")
+
+    def _getGroup(self):
+        return self.__group
+
+    group = property(fget=_getGroup, doc="Group value")
+
+    def _getRole(self):
+        return self.__role
+
+    role = property(fget=_getRole, doc="Role value")
+
+    def _getValue(self):
+        return self.__group, self.__role
+
+    value = property(fget=_getValue, doc="group/role attribute value tuple")
+
+    def __hash__(self):
+        return self.__hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+
+        if not isinstance(other, ESGFInternedGroupRoleAttributeValue):
+            return NotImplemented
+
+        return self.value == other.value
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+
+        return not result
+
+    def __reduce__(self):
+        '''Unpickle to the interned instance'''
+        return self.__class__, self.value
+
+    def __repr__(self):
+        return "<%s group=%r role=%r>" % (self.__class__.__name__,
+                                          self.group,
+                                          self.role)
+
+
+class ESGFAttributeIndex(object):
+    '''Inverted index of attribute values to the assertions carrying them.
+    xs:string values are indexed by (attribute name, value) and ESG Group/Role
+    values by (group, role) so that membership checks are a single dictionary
+    lookup rather than a walk over every assertion's attribute statements.
+
+    A Group/Role value is also indexed under (group, ANY_ROLE) so that a check
+    for the default role matches membership of the group with any role.
+    '''
+    ANY_ROLE = None
+
+    __slots__ = ('__attributeValues', '__groupRoles')
+
+    def __init__(self, assertions=()):
+        '''@param assertions: SAML assertions to index
+        @type assertions: iterable
+        '''
+        self.__attributeValues = {}
+        self.__groupRoles = {}
+        self.add(assertions)
+
+    @staticmethod
+    def _addEntry(index, key, assertion):
+        entries = index.setdefault(key, [])
+
+        # Values for a given assertion are indexed together so only the last
+        # entry need be checked for duplicates
+        if not entries or entries[-1] is not assertion:
+            entries.append(assertion)
+
+    @staticmethod
+    def _removeEntry(index, key, assertion):
+        entries = index.get(key)
+        if entries is None:
+            return
+        
+        for i, entry in enumerate(entries):
+            if entry is assertion:
+                del entries[i]
+                break
+            
+        if not entries:
+            del index[key]
+
+    def _update(self, assertions, updateEntry):
+        '''Call updateEntry for each value carried by the assertions
+
+        @param assertions: SAML assertions
+        @type assertions: iterable
+        @param updateEntry: _addEntry or _removeEntry
+        @type updateEntry: callable
+        '''
+        for assertion in assertions:
+            for attributeStatement in assertion.attributeStatements:
+                for attribute in attributeStatement.attributes:
+                    for attributeValue in attribute.attributeValues:
+                        if isinstance(attributeValue,
+                                      ESGFGroupRoleAttributeValueBase):
+                            group, role = attributeValue.value
+                            updateEntry(self.__groupRoles, (group, role),
+                                        assertion)
+                            updateEntry(self.__groupRoles,
+                                        (group, ESGFAttributeIndex.ANY_ROLE),
+                                        assertion)
+
+                        elif isinstance(attributeValue,
+                                        XSStringAttributeValue):
+                            updateEntry(self.__attributeValues,
+                                        (attribute.name, attributeValue.value),
+                                        assertion)
+
+    def add(self, assertions):
+        '''Add assertions to the index
+
+        @param assertions: SAML assertions to index
+        @type assertions: iterable
+        '''
+        self._update(assertions, self._addEntry)
+
+    def remove(self, assertions):
+        '''Remove assertions from the index.  Assertions are matched by 
+        identity and must carry the same values as when they were added
+
+        @param assertions: SAML assertions to remove
+        @type assertions: iterable
+        '''
+        self._update(assertions, self._removeEntry)
+
+    def clear(self):
+        '''Remove all entries from the index'''
+        self.__attributeValues.clear()
+        self.__groupRoles.clear()
+
+    @staticmethod
+    def _groupRoleKey(group, role):
+        if role == ESGFGroupRoleAttributeValue.DEFAULT_ROLE_NAME:
+            role = ESGFAttributeIndex.ANY_ROLE
+
+        return group, role
+
+    def hasAttribute(self, name, value):
+        '''Check for an xs:string attribute value
+
+        @param name: attribute name
+        @type name: basestring
+        @param value: attribute value
+        @type value: basestring
+        @return: True if any assertion indexed carries this value
+        @rtype: bool
+        '''
+        return (name, value) in self.__attributeValues
+
+    def hasGroupRole(self, group,
+                     role=ESGFGroupRoleAttributeValue.DEFAULT_ROLE_NAME):
+        '''Check for membership of a group with a given role
+
+        @param group: group name
+        @type group: basestring
+        @param role: role name.  DEFAULT_ROLE_NAME or None matches any role
+        held for the group
+        @type role: basestring / None type
+        @return: True if any assertion indexed carries this group/role
+        @rtype: bool
+        '''
+        return self._groupRoleKey(group, role) in self.__groupRoles
+
+    def getAttributeAssertions(self, name, value):
+        '''Get the assertions carrying an xs:string attribute value
+
+        @param name: attribute name
+        @type name: basestring
+        @param value: attribute value
+        @type value: basestring
+        @return: assertions carrying this value
+        @rtype: list
+        '''
+        return list(self.__attributeValues.get((name, value), ()))
+
+    def getGroupRoleAssertions(self, group,
+                               role=ESGFGroupRoleAttributeValue.DEFAULT_ROLE_NAME):
+        '''Get the assertions carrying a group/role
+
+        @param group: group name
+        @type group: basestring
+        @param role: role name.  DEFAULT_ROLE_NAME or None matches any role
+        held for the group
+        @type role: basestring / None type
+        @return: assertions carrying this group/role
+        @rtype: list
+        '''
+        return list(self.__groupRoles.get(self._groupRoleKey(group, role), ()))
+
+
+class ESGFReadOnlyAttribute(Attribute):
+    '''Attribute which can't be altered once created so that instances may
+    be shared between lists and queries.  Attribute values are held in a 
+    tuple.  Where they are all of IMMUTABLE_VALUE_TYPES the attribute is 
+    fully immutable - see hasImmutableValues.  Use toAttribute for an 
+    alterable copy.
+    '''
+    IMMUTABLE_VALUE_TYPES = (ESGFInternedGroupRoleAttributeValue,)
+    
+    __slots__ = ()
+    
+    def __init__(self, name, friendlyName=None, nameFormat=None,
+                 attributeValues=()):
+        '''@param name: attribute name
+        @type name: basestring
+        @param friendlyName: friendly name
+        @type friendlyName: basestring / None type
+        @param nameFormat: name format
+        @type nameFormat: basestring / None type
+        @param attributeValues: attribute values
+        @type attributeValues: iterable
+        '''
+        if not isinstance(name, basestring):
+            raise TypeError('Expecting a string type for "name" attribute; '
+                            'got %r' % type(name))
+            
+        for attrName, value in (('friendlyName', friendlyName), 
+                                ('nameFormat', nameFormat)):
+            if value is not None and not isinstance(value, basestring):
+                raise TypeError('Expecting a string or None type for "%s" '
+                                'attribute; got %r' % (attrName, type(value)))
+                
+        attributeValues = tuple(attributeValues)
+        for attributeValue in attributeValues:
+            if not isinstance(attributeValue, AttributeValue):
+                raise TypeError('Expecting %r type for attribute value; got '
+                                '%r' % (AttributeValue, type(attributeValue)))
+        
+        # Bypass __setattr__ which rejects all updates
+        for attrName, value in (
+                ('_SAMLObject__qname', QName(
+                                        SAMLConstants.SAML20_NS,
+                                        Attribute.DEFAULT_ELEMENT_LOCAL_NAME,
+                                        SAMLConstants.SAML20_PREFIX)),
+                ('_Attribute__name', name),
+                ('_Attribute__friendlyName', friendlyName),
+                ('_Attribute__nameFormat', nameFormat),
+                ('_Attribute__attributeValues', attributeValues)):
+            object.__setattr__(self, attrName, value)
+    
+    @classmethod
+    def fromAttribute(cls, attribute):
+        '''Make a read-only copy of an attribute.  Attribute values are 
+        deep copied unless they are immutable
+        
+        @param attribute: attribute to copy
+        @type attribute: ndg.saml.saml2.core.Attribute
+        @return: read-only attribute, the input attribute itself if it's 
+        already read-only with immutable values
+        @rtype: ESGFReadOnlyAttribute
+        '''
+        if isinstance(attribute, cls) and attribute.hasImmutableValues():
+            return attribute
+        
+        if not isinstance(attribute, Attribute):
+            raise TypeError('Expecting %r type; got %r' % (Attribute, 
+                                                           type(attribute)))
+        
+        return cls(attribute.name,
+                   friendlyName=attribute.friendlyName,
+                   nameFormat=attribute.nameFormat,
+                   attributeValues=[
+                        attributeValue 
+                        if isinstance(attributeValue, 
+                                      cls.IMMUTABLE_VALUE_TYPES)
+                        else copy.deepcopy(attributeValue)
+                        for attributeValue in attribute.attributeValues])
+        
+    def toAttribute(self):
+        '''Make an alterable copy of this attribute
+        
+        @return: new attribute with copies of the attribute values
+        @rtype: ndg.saml.saml2.core.Attribute
+        '''
+        attribute = Attribute()
+        attribute.name = self.name
+        if self.friendlyName is not None:
+            attribute.friendlyName = self.friendlyName
+        if self.nameFormat is not None:
+            attribute.nameFormat = self.nameFormat
+        attribute.attributeValues = copy.deepcopy(list(self.attributeValues))
+        return attribute
+        
+    def hasImmutableValues(self):
+        '''@return: True if all the attribute values are immutable so that 
+        this attribute is safe to share
+        @rtype: bool
+        '''
+        for attributeValue in self.attributeValues:
+            if not isinstance(attributeValue, 
+                              self.__class__.IMMUTABLE_VALUE_TYPES):
+                return False
+            
+        return True
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%r instances are immutable' % self.__class__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%r instances are immutable' % self.__class__)
+
+    def __reduce__(self):
+        '''Enable pickling and copying - __setstate__ can't be used as it 
+        sets attributes'''
+        return self.__class__, (self.name, 
+                                self.friendlyName, 
+                                self.nameFormat,
+                                self.attributeValues)
 
 
 class ESGFDefaultQueryAttributes(object):    
+    """Default attributes for Earth System Grid attribute queries"""
     XSSTRING_NS = "%s#%s" % (
         SAMLConstants.XSD_NS,
         XSStringAttributeValue.TYPE_LOCAL_NAME
     )
     
-    ATTRIBUTES = TypedList(Attribute)
-    N_ATTRIBUTES = 3
-    i = 0
-    for i in range(N_ATTRIBUTES): 
-        ATTRIBUTES.append(Attribute())
-    del i
+    # Attribute name, friendly name pairs
+    ATTRIBUTE_NAMES = (
+        (ESGFSamlNamespaces.FIRSTNAME_ATTRNAME, 
+         ESGFSamlNamespaces.FIRSTNAME_FRIENDLYNAME),
+        (ESGFSamlNamespaces.LASTNAME_ATTRNAME, 
+         ESGFSamlNamespaces.LASTNAME_FRIENDLYNAME),
+        (ESGFSamlNamespaces.EMAILADDRESS_ATTRNAME,
+         ESGFSamlNamespaces.EMAILADDRESS_FRIENDLYNAME)
+    )
+    N_ATTRIBUTES = len(ATTRIBUTE_NAMES)
     
-    ATTRIBUTES[0].name = ESGFSamlNamespaces.FIRSTNAME_ATTRNAME 
-    ATTRIBUTES[0].friendlyName = ESGFSamlNamespaces.FIRSTNAME_FRIENDLYNAME
-    ATTRIBUTES[0].nameFormat = XSSTRING_NS
-
-    ATTRIBUTES[1].name = ESGFSamlNamespaces.LASTNAME_ATTRNAME 
-    ATTRIBUTES[1].friendlyName = ESGFSamlNamespaces.LASTNAME_FRIENDLYNAME
-    ATTRIBUTES[1].nameFormat = XSSTRING_NS
+    # Shared between all users and so read-only.  Use getAttributes for a 
+    # list which may be altered
+    ATTRIBUTES = tuple([ESGFReadOnlyAttribute(name, 
+                                              friendlyName=friendlyName,
+                                              nameFormat=XSSTRING_NS)
+                        for name, friendlyName in ATTRIBUTE_NAMES])
     
-    ATTRIBUTES[2].name = ESGFSamlNamespaces.EMAILADDRESS_ATTRNAME
-    ATTRIBUTES[2].friendlyName = ESGFSamlNamespaces.EMAILADDRESS_FRIENDLYNAME
-    ATTRIBUTES[2].nameFormat =  XSSTRING_NS
\ No newline at end of file
+    @classmethod
+    def getAttributes(cls):
+        """Get a copy of the default attributes.  Use this where the caller
+        may alter the list or its items - ATTRIBUTES is read-only
+        
+        @rtype: ndg.security.common.utils.TypedList
+        @return: new list of copies of the default attributes
+        """
+        attributes = TypedList(Attribute)
+        attributes.extend([attribute.toAttribute() 
+                           for attribute in cls.ATTRIBUTES])
+        return attributes
@@ -11,16 +11,33 @@ __revision__ = '$Id$'
 import logging
 log = logging.getLogger(__name__)
 
-from ndg.security.common.config import Config, importElementTree
+from cStringIO import StringIO
+from xml.etree import ElementTree as PyElementTree
+
+from ndg.security.common.config import importElementTree
 ElementTree = importElementTree()
 
 from ndg.saml.xml import XMLTypeParseError, UnknownAttrProfile
+from ndg.saml.common.xml import SAMLConstants
+from ndg.saml.saml2.core import Assertion, Response, AttributeValue
 from ndg.saml.xml.etree import (AttributeValueElementTreeBase, 
+                                AssertionElementTree,
                                 ResponseElementTree,
                                 QName)
 
 import ndg.security.common.utils.etree as etree
-from ndg.security.common.saml_utils.esgf import ESGFGroupRoleAttributeValue
+from ndg.security.common.saml_utils.esgf import (
+                                        ESGFGroupRoleAttributeValueBase,
+                                        ESGFGroupRoleAttributeValue,
+                                        ESGFInternedGroupRoleAttributeValue)
+
+# Set namespace prefixes once for serialisation of SAML and ESGF types
+for _nsURI, _nsPrefix in (
+        (SAMLConstants.SAML20_NS, SAMLConstants.SAML20_PREFIX),
+        (SAMLConstants.SAML20P_NS, SAMLConstants.SAML20P_PREFIX),
+        (ESGFGroupRoleAttributeValue.DEFAULT_NS, 
+         ESGFGroupRoleAttributeValue.DEFAULT_PREFIX)):
+    etree.registerNamespace(_nsURI, _nsPrefix)
 
 
 class ESGFGroupRoleAttributeValueElementTree(AttributeValueElementTreeBase,
@@ -41,13 +58,13 @@ class ESGFGroupRoleAttributeValueElementTree(AttributeValueElementTreeBase,
         """
         elem = AttributeValueElementTreeBase.toXML(attributeValue)
         
-        if not isinstance(attributeValue, ESGFGroupRoleAttributeValue):
+        if not isinstance(attributeValue, ESGFGroupRoleAttributeValueBase):
             raise TypeError("Expecting %r type; got: %r" % 
-                            (ESGFGroupRoleAttributeValue, type(attributeValue)))
+                            (ESGFGroupRoleAttributeValueBase, 
+                             type(attributeValue)))
             
-        if not Config.use_lxml:
-            ElementTree._namespace_map[attributeValue.namespaceURI
-                                       ] = attributeValue.namespacePrefix
+        etree.registerNamespace(attributeValue.namespaceURI, 
+                                attributeValue.namespacePrefix)
                                    
         tag = str(QName.fromGeneric(cls.TYPE_NAME))    
         groupRoleElem = etree.makeEtreeElement(tag,
@@ -71,11 +88,6 @@ class ESGFGroupRoleAttributeValueElementTree(AttributeValueElementTreeBase,
         @rtype: saml.saml2.core.ESGFGroupRoleAttributeValue
         @return: SAML ESG Group/Role Attribute value
         """
-        
-        # Update namespace map for the Group/Role type referenced.  
-        if not Config.use_lxml:
-            ElementTree._namespace_map[cls.DEFAULT_NS] = cls.DEFAULT_PREFIX
-        
         if not ElementTree.iselement(elem):
             raise TypeError("Expecting %r input type for parsing; got %r" %
                             (ElementTree.Element, elem))
@@ -144,6 +156,184 @@ class ESGFGroupRoleAttributeValueElementTree(AttributeValueElementTreeBase,
         return None
 
 
+class AttributeValueElementTreeRegistry(object):
+    """Registry of custom Attribute Value types and their ElementTree 
+    representations.  When parsing, the representation for an AttributeValue
+    element is found with a single dictionary lookup on the tag of its first
+    child element or failing that, its xsi:type attribute value resolved to
+    {namespace}localName in place of probing each type in turn.  xs:string 
+    values are left to ndg.saml's own handling
+    
+    @type XSI_TYPE_ATTRIB_NAME: string
+    @cvar XSI_TYPE_ATTRIB_NAME: xsi:type attribute name in Clark notation
+    """
+    XSI_TYPE_ATTRIB_NAME = "{http://www.w3.org/2001/XMLSchema-instance}type"
+    
+    def __init__(self):
+        self.__toXMLTypeMap = {}
+        self.__childTagMap = {}
+        self.__xsiTypeMap = {}
+        
+    def register(self, samlClass, etreeClass, childTag=None, xsiType=None):
+        """Register a custom Attribute Value type
+        
+        @type samlClass: type
+        @param samlClass: ndg.saml.saml2.core.AttributeValue derived class
+        @type etreeClass: type
+        @param etreeClass: ElementTree representation for samlClass with 
+        toXML and fromXML class methods
+        @type childTag: basestring / None type
+        @param childTag: tag in Clark notation ({namespace}localName) of the
+        child element of AttributeValue elements of this type
+        @type xsiType: basestring / None type
+        @param xsiType: type set with the xsi:type attribute of 
+        AttributeValue elements of this type in Clark notation 
+        ({namespace}localName).  Types in no namespace are given by local 
+        name alone
+        """
+        if not issubclass(samlClass, AttributeValue):
+            raise TypeError("Expecting %r derived class; got %r" %
+                            (AttributeValue, samlClass))
+            
+        if childTag is None and xsiType is None:
+            raise TypeError('Expecting "childTag" or "xsiType" keyword to be '
+                            'set for %r' % samlClass)
+            
+        self.__toXMLTypeMap[samlClass] = etreeClass
+        if childTag is not None:
+            self.__childTagMap[childTag] = etreeClass
+            
+        if xsiType is not None:
+            # Keyed by local name first so that most unregistered types are 
+            # rejected without resolving the namespace prefix
+            self.__xsiTypeMap.setdefault(etree.QName.getLocalPart(xsiType), 
+                                         {})[etree.QName.getNs(xsiType)] = \
+                                                                    etreeClass
+        
+    def unregister(self, samlClass):
+        """Remove a custom Attribute Value type
+        
+        @type samlClass: type
+        @param samlClass: ndg.saml.saml2.core.AttributeValue derived class
+        """
+        etreeClass = self.__toXMLTypeMap.pop(samlClass)
+        
+        # Parsing entries are kept while other types share the same 
+        # representation
+        if etreeClass in self.__toXMLTypeMap.values():
+            return
+        
+        for typeMap in [self.__childTagMap] + self.__xsiTypeMap.values():
+            for key, value in typeMap.items():
+                if value is etreeClass:
+                    del typeMap[key]
+                    
+        for localName, typeMap in self.__xsiTypeMap.items():
+            if not typeMap:
+                del self.__xsiTypeMap[localName]
+
+    def _getToXMLTypeMap(self):
+        """@rtype: dict
+        @return: copy of SAML class to ElementTree class mapping
+        """
+        return self.__toXMLTypeMap.copy()
+    
+    toXMLTypeMap = property(_getToXMLTypeMap, 
+                            doc="Mapping of SAML Attribute Value classes to "
+                                "their ElementTree representation")
+                                
+    def matchFunc(self, elem):
+        """Match function for use with AttributeValueElementTreeFactory
+        
+        @type elem: ElementTree.Element
+        @param elem: Attribute value as ElementTree XML element
+        @rtype: type / None
+        @return: ElementTree class to parse elem or None if it is not a 
+        registered type
+        """
+        if len(elem):
+            return self.__childTagMap.get(elem[0].tag)
+        
+        xsiType = elem.get(self.__class__.XSI_TYPE_ATTRIB_NAME)
+        if xsiType is None:
+            return None
+        
+        if ':' in xsiType:
+            prefix, localName = xsiType.split(':', 1)
+        else:
+            prefix, localName = '', xsiType
+            
+        typeMap = self.__xsiTypeMap.get(localName)
+        if typeMap is None:
+            return None
+        
+        nsURI = self._resolvePrefix(elem, prefix)
+        if nsURI is None:
+            return None
+        
+        return typeMap.get(nsURI)
+    
+    @staticmethod
+    def _resolvePrefix(elem, prefix):
+        """Get the namespace for a prefix from the declarations in scope for
+        an element.  Standard Library ElementTree elements don't keep their
+        namespace declarations so for these, the prefixes registered for
+        serialisation are used instead
+        
+        @type elem: ElementTree.Element
+        @param elem: element in whose scope the prefix is used
+        @type prefix: basestring
+        @param prefix: namespace prefix or '' for none
+        @rtype: basestring / None type
+        @return: namespace URI, '' for no namespace or None if the prefix is
+        not declared
+        """
+        nsmap = getattr(elem, 'nsmap', None)
+        if nsmap is not None:
+            return nsmap.get(prefix or None, None if prefix else '')
+        
+        if not prefix:
+            return ''
+        
+        for nsURI, nsPrefix in PyElementTree._namespace_map.items():
+            if nsPrefix == prefix:
+                return nsURI
+            
+        return None
+
+    def updateKeywords(self, kw):
+        """Add the registered types to keywords for 
+        AttributeValueElementTreeFactory passed to ndg.saml toXML/fromXML 
+        class methods.  Any existing custom type maps set are copied rather
+        than altered
+        
+        @type kw: dict
+        @param kw: keywords to update
+        @rtype: dict
+        @return: kw
+        """
+        toXMLTypeMap = self.toXMLTypeMap
+        toXMLTypeMap.update(kw.get('customToXMLTypeMap', {}))
+        kw['customToXMLTypeMap'] = toXMLTypeMap
+        
+        toSAMLTypeMap = list(kw.get('customToSAMLTypeMap', []))
+        toSAMLTypeMap.append(self.matchFunc)
+        kw['customToSAMLTypeMap'] = toSAMLTypeMap
+        
+        return kw
+
+
+# Registry used by the ESGF ElementTree classes below.  Register third party
+# Attribute Value types with this to make them available for parsing
+attributeValueElementTreeRegistry = AttributeValueElementTreeRegistry()
+for _samlClass in (ESGFGroupRoleAttributeValue, 
+                   ESGFInternedGroupRoleAttributeValue):
+    attributeValueElementTreeRegistry.register(
+        _samlClass,
+        ESGFGroupRoleAttributeValueElementTree,
+        childTag=str(QName.fromGeneric(ESGFGroupRoleAttributeValue.TYPE_NAME)))
+
+
 class ESGFResponseElementTree(ResponseElementTree):
     """Extend ResponseElementTree type for Attribute Query Response to include 
     ESG custom Group/Role Attribute support"""
@@ -158,11 +348,7 @@ class ESGFResponseElementTree(ResponseElementTree):
         @rtype: ElementTree.Element
         @return: ESGF Group/Role attribute value as ElementTree.Element
         """
-        toXMLTypeMap = kw.get('customToXMLTypeMap', {})
-        toXMLTypeMap[ESGFGroupRoleAttributeValue
-                     ] = ESGFGroupRoleAttributeValueElementTree
-        
-        kw['customToXMLTypeMap'] = toXMLTypeMap
+        attributeValueElementTreeRegistry.updateKeywords(kw)
         
         # Convert to ElementTree representation to enable attachment to SOAP
         # response body
@@ -177,9 +363,99 @@ class ESGFResponseElementTree(ResponseElementTree):
         @rtype: ndg.security.common.saml_utils.etree.ESGFGroupRoleAttributeValue
         @return: ESGF Group/Role attribute value 
         """
-        toSAMLTypeMap = kw.get('customToSAMLTypeMap', [])
-        toSAMLTypeMap.append(
-                        ESGFGroupRoleAttributeValueElementTree.factoryMatchFunc)
-        kw['customToSAMLTypeMap'] = toSAMLTypeMap
+        attributeValueElementTreeRegistry.updateKeywords(kw)
         
         return ResponseElementTree.fromXML(elem, **kw)
+    
+    @classmethod
+    def fromXMLStream(cls, source, **kw):
+        """Parse a Response incrementally from a string or file-like object.
+        Each assertion is converted as soon as its closing tag is read and 
+        its elements discarded so that only one assertion is held as an 
+        ElementTree at a time.  The Response may be the root element or 
+        enclosed in another such as a SOAP envelope.  The result is the same
+        as for fromXML
+         
+        @type source: basestring / file-like object
+        @param source: XML containing the response
+        @rtype: ndg.saml.saml2.core.Response
+        @return: SAML Response
+        """
+        if isinstance(source, basestring):
+            if isinstance(source, unicode):
+                source = source.encode('utf-8')
+            source = StringIO(source)
+            
+        attributeValueElementTreeRegistry.updateKeywords(kw)
+        
+        response = None
+        responseElem = None
+        responseDepth = None
+        assertions = []
+        depth = 0
+        for event, elem in ElementTree.iterparse(source, 
+                                                 events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if (responseElem is None and response is None and 
+                    QName.getLocalPart(elem.tag) == 
+                    Response.DEFAULT_ELEMENT_LOCAL_NAME):
+                    responseElem = elem
+                    responseDepth = depth
+                continue
+                
+            if responseElem is not None:
+                if elem is responseElem:
+                    # Assertions have been removed and converted already
+                    response = ResponseElementTree.fromXML(responseElem, **kw)
+                    response.assertions.extend(assertions)
+                    responseElem.clear()
+                    responseElem = None
+                
+                elif (depth == responseDepth + 1 and 
+                      QName.getLocalPart(elem.tag) == 
+                      Assertion.DEFAULT_ELEMENT_LOCAL_NAME):
+                    assertions.append(
+                                    AssertionElementTree.fromXML(elem, **kw))
+                    responseElem.remove(elem)
+                    elem.clear()
+                    
+            depth -= 1
+            
+        if response is None:
+            raise XMLTypeParseError('No "%s" element found' %
+                                    Response.DEFAULT_ELEMENT_LOCAL_NAME)
+            
+        return response
+
+
+class ESGFAssertionElementTree(AssertionElementTree):
+    """Extend AssertionElementTree type to include ESG custom Group/Role 
+    Attribute support"""
+    
+    @classmethod
+    def toXML(cls, assertion, **kw):
+        """Extend base method adding mapping for ESG Group/Role Attribute Value 
+        to enable ElementTree Attribute Value factory to render the XML output
+        
+        @type assertion: ndg.saml.saml2.core.Assertion
+        @param assertion: SAML assertion
+        @rtype: ElementTree.Element
+        @return: assertion as ElementTree.Element
+        """
+        attributeValueElementTreeRegistry.updateKeywords(kw)
+        
+        return AssertionElementTree.toXML(assertion, **kw)
+    
+    @classmethod
+    def fromXML(cls, elem, **kw):
+        """Extend base method adding mapping for ESG Group/Role Attribute Value
+         
+        @type elem: ElementTree.Element
+        @param elem: assertion as ElementTree.Element
+        @rtype: ndg.saml.saml2.core.Assertion
+        @return: SAML assertion
+        """
+        attributeValueElementTreeRegistry.updateKeywords(kw)
+        
+        return AssertionElementTree.fromXML(elem, **kw)
@@ -0,0 +1,545 @@
+"""Template based serialisation of SAML 2.0 Earth System Grid Attribute
+Queries and Responses
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "17/10/26"
+__copyright__ = "(C) 2009 Science and Technology Facilities Council"
+__license__ = "BSD - see LICENSE file in top-level directory"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import logging
+log = logging.getLogger(__name__)
+import copy
+from datetime import datetime
+from uuid import uuid4
+
+from ndg.saml.utils import SAMLDateTime
+from ndg.saml.common import SAMLVersion
+from ndg.saml.common.xml import SAMLConstants
+from ndg.saml.saml2.core import (Response, XSStringAttributeValue, 
+                                 AttributeQuery, Attribute, Issuer, Subject,
+                                 NameID)
+from ndg.saml.xml.etree import AttributeQueryElementTree
+
+from ndg.security.common.config import importElementTree
+ElementTree = importElementTree()
+
+from ndg.security.common.utils import TypedList
+from ndg.security.common.saml_utils.esgf import (
+                                        ESGFSamlNamespaces,
+                                        ESGFDefaultQueryAttributes,
+                                        ESGFReadOnlyAttribute,
+                                        ESGFGroupRoleAttributeValue,
+                                        ESGFInternedGroupRoleAttributeValue)
+from ndg.security.common.saml_utils.esgf.xml.etree import \
+    ESGFResponseElementTree
+
+
+def _escapeText(text):
+    """Escape element text in the same way as ElementTree serialisation
+
+    @type text: basestring
+    @param text: text to escape
+    @rtype: str
+    @return: escaped text.  Unicode characters outside of ASCII are written
+    as character references
+    """
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    if isinstance(text, unicode):
+        text = text.encode('ascii', 'xmlcharrefreplace')
+    return text
+
+
+def _escapeAttrib(text):
+    """Escape an attribute value in the same way as ElementTree serialisation
+
+    @type text: basestring
+    @param text: attribute value to escape
+    @rtype: str
+    @return: escaped attribute value
+    """
+    text = _escapeText(text)
+    if '"' in text:
+        text = text.replace('"', '&quot;')
+    if '\n' in text:
+        text = text.replace('\n', '&#10;')
+    return text
+
+
+class _Fallback(Exception):
+    """Raised internally for responses which the template doesn't cover"""
+
+
+class ESGFResponseTemplateSerialiser(object):
+    """Serialise ESGF Attribute Query Responses direct to a string from
+    fixed fragments of XML.  Only identifiers, timestamps, issuer, subject
+    and attribute values are written per response avoiding the construction
+    of an ElementTree.  The output is the same as serialising the result of
+    ESGFResponseElementTree.toXML with ElementTree.tostring.
+
+    Responses with content not covered by the template - for example,
+    statements other than attribute statements, or attribute value types
+    other than xs:string and ESGF Group/Role - are serialised with
+    ESGFResponseElementTree
+    """
+    SAML_PREFIX = SAMLConstants.SAML20_PREFIX
+    SAMLP_PREFIX = SAMLConstants.SAML20P_PREFIX
+    ESG_PREFIX = ESGFGroupRoleAttributeValue.DEFAULT_PREFIX
+
+    # Namespace declarations, sorted by prefix as ElementTree does
+    NS_DECLARATIONS = dict([
+        (prefix, ' xmlns:%s="%s"' % (prefix, nsURI))
+        for prefix, nsURI in (
+            (SAML_PREFIX, SAMLConstants.SAML20_NS),
+            (SAMLP_PREFIX, SAMLConstants.SAML20P_NS),
+            (ESG_PREFIX, ESGFGroupRoleAttributeValue.DEFAULT_NS))
+    ])
+
+    RESPONSE_START = '<%s:Response' % SAMLP_PREFIX
+    RESPONSE_ATTRIBS = (' ID="%s" InResponseTo="%s" IssueInstant="%s" '
+                        'Version="%s">')
+    RESPONSE_END = '</%s:Response>' % SAMLP_PREFIX
+
+    ISSUER_START = '<%s:Issuer' % SAML_PREFIX
+    ISSUER_END = '</%s:Issuer>' % SAML_PREFIX
+
+    STATUS_START = '<%s:Status><%s:StatusCode Value="' % (SAMLP_PREFIX,
+                                                          SAMLP_PREFIX)
+    STATUS_CODE_END = '" />'
+    STATUS_MESSAGE_START = '<%s:StatusMessage>' % SAMLP_PREFIX
+    STATUS_MESSAGE_END = '</%s:StatusMessage>' % SAMLP_PREFIX
+    STATUS_END = '</%s:Status>' % SAMLP_PREFIX
+
+    ASSERTION_START = '<%s:Assertion ID="' % SAML_PREFIX
+    ASSERTION_ATTRIBS = '%s" IssueInstant="%s" Version="%s"'
+    ASSERTION_END = '</%s:Assertion>' % SAML_PREFIX
+
+    SUBJECT_START = '<%s:Subject><%s:NameID Format="' % (SAML_PREFIX,
+                                                         SAML_PREFIX)
+    SUBJECT_END = '</%s:NameID></%s:Subject>' % (SAML_PREFIX, SAML_PREFIX)
+
+    CONDITIONS = '<%s:Conditions NotBefore="%%s" NotOnOrAfter="%%s" />' % \
+                                                                    SAML_PREFIX
+
+    ATTRIBUTE_STATEMENT_START = '<%s:AttributeStatement' % SAML_PREFIX
+    ATTRIBUTE_STATEMENT_END = '</%s:AttributeStatement>' % SAML_PREFIX
+
+    ATTRIBUTE_START = '<%s:Attribute' % SAML_PREFIX
+    ATTRIBUTE_END = '</%s:Attribute>' % SAML_PREFIX
+
+    XSSTRING_VALUE_START = (
+        '<%s:AttributeValue xmlns:%s="%s" xmlns:%s="%s" %s:type="%s:%s"' %
+        (SAML_PREFIX,
+         SAMLConstants.XSD_PREFIX, SAMLConstants.XSD_NS,
+         SAMLConstants.XSI_PREFIX, SAMLConstants.XSI_NS,
+         SAMLConstants.XSI_PREFIX, SAMLConstants.XSD_PREFIX,
+         XSStringAttributeValue.TYPE_LOCAL_NAME))
+    XSSTRING_VALUE_END = '</%s:AttributeValue>' % SAML_PREFIX
+
+    GROUPROLE_VALUE = (
+        '<%s:AttributeValue><%s:%s %s="%%s" %s="%%s" /></%s:AttributeValue>' %
+        (SAML_PREFIX, ESG_PREFIX, ESGFGroupRoleAttributeValue.TYPE_LOCAL_NAME,
+         ESGFGroupRoleAttributeValue.GROUP_ATTRIB_NAME,
+         ESGFGroupRoleAttributeValue.ROLE_ATTRIB_NAME, SAML_PREFIX))
+
+    GROUPROLE_VALUE_TYPES = (ESGFGroupRoleAttributeValue,
+                             ESGFInternedGroupRoleAttributeValue)
+
+    EMPTY_ELEM_END = ' />'
+
+    @classmethod
+    def serialise(cls, response):
+        """Serialise a response
+
+        @type response: ndg.saml.saml2.core.Response
+        @param response: ESGF Attribute Query Response
+        @rtype: str
+        @return: XML serialisation of response
+        """
+        if not isinstance(response, Response):
+            raise TypeError("Expecting %r class, got %r" % (Response,
+                                                            type(response)))
+        try:
+            return cls._serialise(response)
+
+        except _Fallback, e:
+            log.debug("ESGFResponseTemplateSerialiser.serialise: serialising "
+                      "with ESGFResponseElementTree: %s", e)
+
+            return ElementTree.tostring(ESGFResponseElementTree.toXML(response))
+
+    @classmethod
+    def _serialise(cls, response):
+        """Write the response into the template raising _Fallback if it
+        contains content not covered
+        """
+        if (response.id is None or response.issueInstant is None or
+            response.inResponseTo is None or response.status is None):
+            raise _Fallback('Response ID, issue instant, in response to or '
+                            'status not set')
+
+        # Cache formatted times - an assertion's not before time is commonly
+        # the same as its and the response's issue instant
+        dateTimes = {}
+        def toString(dateTime):
+            dateTimeStr = dateTimes.get(dateTime)
+            if dateTimeStr is None:
+                if dateTime is None:
+                    raise _Fallback('Date time not set')
+
+                dateTimeStr = dateTimes[dateTime] = SAMLDateTime.toString(
+                                                                    dateTime)
+            return dateTimeStr
+
+        parts = []
+        useSamlNs = response.issuer is not None
+        useEsgNs = False
+
+        # Response content is written first so that the namespaces used are
+        # known for the root element declarations
+        if response.issuer is not None:
+            cls._serialiseIssuer(response.issuer, parts)
+
+        cls._serialiseStatus(response.status, parts)
+
+        for assertion in response.assertions:
+            useSamlNs = True
+            useEsgNs |= cls._serialiseAssertion(assertion, toString, parts)
+
+        prefixes = [cls.SAMLP_PREFIX]
+        if useSamlNs:
+            prefixes.append(cls.SAML_PREFIX)
+        if useEsgNs:
+            prefixes.append(cls.ESG_PREFIX)
+
+        head = [cls.RESPONSE_START]
+        head += [cls.NS_DECLARATIONS[prefix] for prefix in sorted(prefixes)]
+        head.append(cls.RESPONSE_ATTRIBS % (
+                                    _escapeAttrib(response.id),
+                                    _escapeAttrib(response.inResponseTo),
+                                    toString(response.issueInstant),
+                                    _escapeAttrib(str(response.version))))
+        parts.append(cls.RESPONSE_END)
+
+        return ''.join(head + parts)
+
+    @classmethod
+    def _serialiseIssuer(cls, issuer, parts):
+        parts.append(cls.ISSUER_START)
+        if issuer.format is not None:
+            parts.append(' Format="%s"' % _escapeAttrib(issuer.format))
+
+        if issuer.value:
+            parts += ('>', _escapeText(issuer.value), cls.ISSUER_END)
+        else:
+            parts.append(cls.EMPTY_ELEM_END)
+
+    @classmethod
+    def _serialiseStatus(cls, status, parts):
+        if status.statusDetail is not None:
+            raise _Fallback('Status detail is not supported')
+
+        statusCode = status.statusCode
+        if statusCode is None or statusCode.value is None:
+            raise _Fallback('Status code not set')
+
+        parts += (cls.STATUS_START, _escapeAttrib(statusCode.value),
+                  cls.STATUS_CODE_END)
+
+        statusMessage = status.statusMessage
+        if statusMessage is not None and statusMessage.value is not None:
+            if statusMessage.value:
+                parts += (cls.STATUS_MESSAGE_START,
+                          _escapeText(statusMessage.value),
+                          cls.STATUS_MESSAGE_END)
+            else:
+                raise _Fallback('Empty status message')
+
+        parts.append(cls.STATUS_END)
+
+    @classmethod
+    def _serialiseAssertion(cls, assertion, toString, parts):
+        """@rtype: bool
+        @return: True if the assertion includes ESGF Group/Role values
+        """
+        if (assertion.advice or assertion.statements or
+            assertion.authnStatements or assertion.authzDecisionStatements):
+            raise _Fallback('Assertion content other than attribute '
+                            'statements is not supported')
+
+        if assertion.id is None or assertion.issueInstant is None:
+            raise _Fallback('Assertion ID or issue instant not set')
+
+        parts += (cls.ASSERTION_START,
+                  cls.ASSERTION_ATTRIBS % (_escapeAttrib(assertion.id),
+                                           toString(assertion.issueInstant),
+                                           _escapeAttrib(str(assertion.version))),
+                  '>')
+        contentIdx = len(parts)
+
+        if assertion.issuer is not None:
+            cls._serialiseIssuer(assertion.issuer, parts)
+
+        subject = assertion.subject
+        if subject is not None:
+            nameID = subject.nameID
+            if nameID is None or nameID.format is None or not nameID.value:
+                raise _Fallback('Subject NameID format or value not set')
+
+            parts += (cls.SUBJECT_START, _escapeAttrib(nameID.format), '">',
+                      _escapeText(nameID.value), cls.SUBJECT_END)
+
+        conditions = assertion.conditions
+        if conditions is not None:
+            if conditions.conditions:
+                raise _Fallback('Conditions list is not supported')
+
+            parts.append(cls.CONDITIONS % (toString(conditions.notBefore),
+                                           toString(conditions.notOnOrAfter)))
+
+        useEsgNs = False
+        for attributeStatement in assertion.attributeStatements:
+            parts.append(cls.ATTRIBUTE_STATEMENT_START)
+            if len(attributeStatement.attributes) == 0:
+                parts.append(cls.EMPTY_ELEM_END)
+                continue
+
+            parts.append('>')
+            for attribute in attributeStatement.attributes:
+                useEsgNs |= cls._serialiseAttribute(attribute, parts)
+
+            parts.append(cls.ATTRIBUTE_STATEMENT_END)
+
+        if len(parts) == contentIdx:
+            parts[-1] = cls.EMPTY_ELEM_END
+        else:
+            parts.append(cls.ASSERTION_END)
+            
+        return useEsgNs
+
+    @classmethod
+    def _serialiseAttribute(cls, attribute, parts):
+        """@rtype: bool
+        @return: True if the attribute includes ESGF Group/Role values
+        """
+        parts.append(cls.ATTRIBUTE_START)
+        if attribute.friendlyName:
+            parts.append(' FriendlyName="%s"' %
+                         _escapeAttrib(attribute.friendlyName))
+        if attribute.name:
+            parts.append(' Name="%s"' % _escapeAttrib(attribute.name))
+        if attribute.nameFormat:
+            parts.append(' NameFormat="%s"' %
+                         _escapeAttrib(attribute.nameFormat))
+
+        if len(attribute.attributeValues) == 0:
+            parts.append(cls.EMPTY_ELEM_END)
+            return False
+
+        parts.append('>')
+        useEsgNs = False
+        for attributeValue in attribute.attributeValues:
+            valueType = type(attributeValue)
+            if valueType is XSStringAttributeValue:
+                parts.append(cls.XSSTRING_VALUE_START)
+                if attributeValue.value:
+                    parts += ('>', _escapeText(attributeValue.value),
+                              cls.XSSTRING_VALUE_END)
+                else:
+                    parts.append(cls.EMPTY_ELEM_END)
+
+            elif valueType in cls.GROUPROLE_VALUE_TYPES:
+                if (attributeValue.group is None or
+                    attributeValue.role is None or
+                    attributeValue.namespacePrefix != cls.ESG_PREFIX):
+                    raise _Fallback('Group/Role value is not supported')
+
+                parts.append(cls.GROUPROLE_VALUE % (
+                                            _escapeAttrib(attributeValue.group),
+                                            _escapeAttrib(attributeValue.role)))
+                useEsgNs = True
+            else:
+                raise _Fallback('Attribute value type %r is not supported' %
+                                valueType)
+
+        parts.append(cls.ATTRIBUTE_END)
+        return useEsgNs
+
+
+class ESGFAttributeQueryTemplate(object):
+    """Immutable template for ESGF Attribute Queries.  The issuer, subject ID
+    format and attributes to query are fixed when the template is created and
+    the XML for them is serialised once.  Only the subject ID, query ID and
+    issue instant are written for each query.  The output is the same as
+    serialising the equivalent query from makeQuery with 
+    AttributeQueryElementTree.toXML and ElementTree.tostring.
+    """
+    QUERY_ID_FIELD = '${queryId}'
+    ISSUE_INSTANT_FIELD = '${issueInstant}'
+    SUBJECT_ID_FIELD = '${subjectId}'
+    
+    __slots__ = (
+        '__issuerName', 
+        '__issuerFormat', 
+        '__subjectIdFormat', 
+        '__attributes',
+        '__fragments',
+        '__fields'
+    )
+    
+    def __init__(self, 
+                 issuerName, 
+                 issuerFormat=Issuer.X509_SUBJECT,
+                 subjectIdFormat=ESGFSamlNamespaces.NAMEID_FORMAT,
+                 attributes=None):
+        """@type issuerName: basestring
+        @param issuerName: issuer of queries
+        @type issuerFormat: basestring
+        @param issuerFormat: issuer name format
+        @type subjectIdFormat: basestring
+        @param subjectIdFormat: subject ID format
+        @type attributes: iterable / None type
+        @param attributes: attributes to query, defaults to 
+        ESGFDefaultQueryAttributes.ATTRIBUTES.  Read-only copies are taken so
+        that subsequent changes to them don't affect the template
+        """
+        if attributes is None:
+            attributes = ESGFDefaultQueryAttributes.ATTRIBUTES
+        else:
+            for attribute in attributes:
+                if not isinstance(attribute, Attribute):
+                    raise TypeError("Expecting %r type for attribute; got %r"
+                                    % (Attribute, type(attribute)))
+                    
+        self.__issuerName = issuerName
+        self.__issuerFormat = issuerFormat
+        self.__subjectIdFormat = subjectIdFormat
+        self.__attributes = tuple([
+            ESGFReadOnlyAttribute.fromAttribute(attribute)
+            for attribute in attributes])
+        self._compile()
+        
+    def _compile(self):
+        """Serialise a query with place holders for the fields set per query
+        and split it into the fixed fragments in between
+        """
+        query = self.makeQuery(self.__class__.SUBJECT_ID_FIELD,
+                               queryId=self.__class__.QUERY_ID_FIELD)
+        queryElem = AttributeQueryElementTree.toXML(query)
+        queryElem.set(query.ISSUE_INSTANT_ATTRIB_NAME, 
+                      self.__class__.ISSUE_INSTANT_FIELD)
+        xml = ElementTree.tostring(queryElem)
+        
+        fieldIndices = []
+        for field in (self.__class__.QUERY_ID_FIELD, 
+                      self.__class__.ISSUE_INSTANT_FIELD,
+                      self.__class__.SUBJECT_ID_FIELD):
+            if xml.count(field) != 1:
+                raise ValueError('Error creating attribute query template: '
+                                 'expecting one %r field in the serialised '
+                                 'query; found %d' % (field, xml.count(field)))
+            fieldIndices.append((xml.index(field), field))
+            
+        fieldIndices.sort()
+        fragments = []
+        start = 0
+        for i, field in fieldIndices:
+            fragments.append(xml[start:i])
+            start = i + len(field)
+        fragments.append(xml[start:])
+            
+        self.__fragments = tuple(fragments)
+        self.__fields = tuple([field for i, field in fieldIndices])
+        
+    def _getIssuerName(self):
+        return self.__issuerName
+    
+    issuerName = property(_getIssuerName, doc="Issuer of queries")
+    
+    def _getIssuerFormat(self):
+        return self.__issuerFormat
+    
+    issuerFormat = property(_getIssuerFormat, doc="Issuer name format")
+    
+    def _getSubjectIdFormat(self):
+        return self.__subjectIdFormat
+    
+    subjectIdFormat = property(_getSubjectIdFormat, doc="Subject ID format")
+    
+    def _getAttributes(self):
+        attributes = TypedList(Attribute)
+        attributes.extend([attribute.toAttribute() 
+                           for attribute in self.__attributes])
+        return attributes
+    
+    attributes = property(_getAttributes, 
+                          doc="Copy of the attributes to query")
+    
+    def makeQuery(self, subjectId, queryId=None, issueInstant=None):
+        """Make an attribute query from the template
+        
+        @type subjectId: basestring
+        @param subjectId: subject ID to query attributes for
+        @type queryId: basestring / None type
+        @param queryId: query ID, defaults to a new UUID
+        @type issueInstant: datetime / None type
+        @param issueInstant: query issue instant, defaults to the current time
+        @rtype: ndg.saml.saml2.core.AttributeQuery
+        @return: attribute query.  Its attributes are the template's 
+        read-only ones, shared between queries, except where they carry 
+        mutable attribute values in which case they are copies.  serialise
+        is faster where only the XML is needed
+        """
+        query = AttributeQuery()
+        query.version = SAMLVersion(SAMLVersion.VERSION_20)
+        query.id = queryId or str(uuid4())
+        query.issueInstant = issueInstant or datetime.utcnow()
+        
+        query.issuer = Issuer()
+        query.issuer.format = self.__issuerFormat
+        query.issuer.value = self.__issuerName
+                        
+        query.subject = Subject()  
+        query.subject.nameID = NameID()
+        query.subject.nameID.format = self.__subjectIdFormat
+        query.subject.nameID.value = subjectId
+        
+        query.attributes.extend([
+            attribute if attribute.hasImmutableValues() 
+            else copy.deepcopy(attribute)
+            for attribute in self.__attributes])
+        return query
+    
+    def serialise(self, subjectId, queryId=None, issueInstant=None):
+        """Serialise an attribute query from the template
+        
+        @type subjectId: basestring
+        @param subjectId: subject ID to query attributes for
+        @type queryId: basestring / None type
+        @param queryId: query ID, defaults to a new UUID
+        @type issueInstant: datetime / None type
+        @param issueInstant: query issue instant, defaults to the current time
+        @rtype: str
+        @return: XML serialisation of attribute query
+        """
+        values = {
+            self.__class__.QUERY_ID_FIELD: _escapeAttrib(queryId or 
+                                                         str(uuid4())),
+            self.__class__.ISSUE_INSTANT_FIELD: SAMLDateTime.toString(
+                                        issueInstant or datetime.utcnow()),
+            self.__class__.SUBJECT_ID_FIELD: _escapeText(subjectId)
+        }
+        
+        fragments = self.__fragments
+        parts = [fragments[0]]
+        for field, fragment in zip(self.__fields, fragments[1:]):
+            parts += (values[field], fragment)
+            
+        return ''.join(parts)
@@ -0,0 +1,13 @@
+"""NDG Security benchmark package
+
+Benchmarks are run from the command line rather than by the unit test runner,
+see the individual bench_* modules
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "17/10/26"
+__copyright__ = "(C) 2009 Science and Technology Facilities Council"
+__license__ = "BSD - see LICENSE file in top-level directory"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""Benchmark Attribute Value type dispatch when parsing ESGF assertions
+
+Compares resolving AttributeValue elements with the registry match function
+against probing with ESGFGroupRoleAttributeValueElementTree.factoryMatchFunc.
+Results are written as JSON:
+
+$ python bench_attributevalues.py -n 10000 -g 0.5
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "17/10/26"
+__copyright__ = "(C) 2009 Science and Technology Facilities Council"
+__license__ = "BSD - see LICENSE file in top-level directory"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import logging
+import sys
+import platform
+import optparse
+import random
+import json
+from timeit import default_timer
+
+from ndg.saml.saml2.core import XSStringAttributeValue
+from ndg.saml.xml.etree import (AttributeValueElementTreeFactory,
+                                XSStringAttributeValueElementTree)
+
+from ndg.security.common.config import importElementTree
+ElementTree = importElementTree()
+
+from ndg.security.common.saml_utils.esgf import ESGFGroupRoleAttributeValue
+from ndg.security.common.saml_utils.esgf.xml.etree import (
+                                ESGFGroupRoleAttributeValueElementTree,
+                                attributeValueElementTreeRegistry)
+
+
+def createAttributeValueElems(numValues, groupRoleFraction, seed=0):
+    """Create a mix of xs:string and ESGF Group/Role AttributeValue elements
+
+    @type numValues: int
+    @param numValues: number of elements to create
+    @type groupRoleFraction: float
+    @param groupRoleFraction: fraction of elements which are Group/Role type
+    @type seed: int
+    @param seed: seed for random number generator
+    @rtype: list
+    @return: ElementTree AttributeValue elements as parsed from XML
+    """
+    rand = random.Random(seed)
+    elems = []
+    for i in range(numValues):
+        if rand.random() < groupRoleFraction:
+            attributeValue = ESGFGroupRoleAttributeValue()
+            attributeValue.group = 'group%d' % i
+            attributeValue.role = 'default'
+            elem = ESGFGroupRoleAttributeValueElementTree.toXML(attributeValue)
+        else:
+            attributeValue = XSStringAttributeValue()
+            attributeValue.value = 'value%d' % i
+            elem = XSStringAttributeValueElementTree.toXML(attributeValue)
+
+        elems.append(ElementTree.fromstring(ElementTree.tostring(elem)))
+
+    return elems
+
+
+def timeParse(elems, matchFunc, repeat):
+    """Time resolving the parser class for and parsing each element
+
+    @rtype: dict
+    @return: number of operations, best time and operations per second
+    """
+    factory = AttributeValueElementTreeFactory(
+                                            customToSAMLTypeMap=[matchFunc])
+    best = None
+    for i in range(repeat):
+        start = default_timer()
+        for elem in elems:
+            factory(elem).fromXML(elem)
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return {
+        'ops': len(elems),
+        'seconds': best,
+        'opsPerSec': len(elems)/best if best else None
+    }
+
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(
+                usage="%prog [options]",
+                description="Benchmark Attribute Value type dispatch for "
+                            "ESGF attribute values")
+    parser.add_option("-n",
+                      "--num-values",
+                      dest="numValues",
+                      default=10000,
+                      type='int',
+                      help="number of AttributeValue elements to parse")
+
+    parser.add_option("-g",
+                      "--group-role-fraction",
+                      dest="groupRoleFraction",
+                      default=0.5,
+                      type='float',
+                      help="fraction of values which are Group/Role type, "
+                           "the remainder are xs:string")
+
+    parser.add_option("-r",
+                      "--repeat",
+                      dest="repeat",
+                      default=5,
+                      type='int',
+                      help="number of repeats for each timing - the best "
+                           "time is reported")
+
+    parser.add_option("-s",
+                      "--seed",
+                      dest="seed",
+                      default=0,
+                      type='int',
+                      help="random number generator seed")
+
+    parser.add_option("-o",
+                      "--output",
+                      dest="outputFilePath",
+                      help="file to write JSON results to, defaults to stdout")
+
+    opt = parser.parse_args(argv[1:])[0]
+    logging.getLogger().setLevel(logging.WARNING)
+
+    elems = createAttributeValueElems(opt.numValues, opt.groupRoleFraction,
+                                      seed=opt.seed)
+    report = {
+        'parameters': {
+            'numValues': opt.numValues,
+            'groupRoleFraction': opt.groupRoleFraction,
+            'repeat': opt.repeat,
+            'seed': opt.seed
+        },
+        'platform': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine()
+        },
+        'results': {
+            'Probe': timeParse(elems,
+                    ESGFGroupRoleAttributeValueElementTree.factoryMatchFunc,
+                    opt.repeat),
+            'Registry': timeParse(elems,
+                                  attributeValueElementTreeRegistry.matchFunc,
+                                  opt.repeat)
+        }
+    }
+
+    if opt.outputFilePath:
+        outputFile = open(opt.outputFilePath, 'w')
+    else:
+        outputFile = sys.stdout
+
+    try:
+        json.dump(report, outputFile, indent=4, sort_keys=True)
+        outputFile.write('\n')
+    finally:
+        if outputFile is not sys.stdout:
+            outputFile.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""Benchmark reading INI properties files with INIPropertyFile.read
+
+A synthetic INI file with a configurable number of sections and options of
+mixed types is read with the current single pass loader and with the
+previous loader which tried each ConfigParser conversion method in turn for
+every option.  Reads returning a copy of the properties from the property
+file cache are also timed.  Results are written as JSON:
+
+$ python bench_configfileparsers.py -s 20 -n 50
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "17/10/26"
+__copyright__ = "(C) 2009 Science and Technology Facilities Council"
+__license__ = "BSD - see LICENSE file in top-level directory"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import logging
+import os
+import sys
+import platform
+import optparse
+import tempfile
+import json
+from timeit import default_timer
+from ConfigParser import InterpolationMissingOptionError
+
+from ndg.security.common.utils import configfileparsers
+from ndg.security.common.utils.configfileparsers import (INIPropertyFile,
+                                                         expandEnvVars,
+                                                         propertyFileCache)
+
+
+def _legacyParseConfig(cfg, validKeys, section='DEFAULT', prefix=''):
+    """Previous implementation of configfileparsers._parseConfig for
+    comparison.  Prefix handling is omitted as it's not exercised here"""
+    propRoot = {}
+    if section == 'DEFAULT':
+        keys = cfg.defaults().keys()
+    else:
+        keys = cfg.options(section)
+        keys = filter(lambda x:x not in cfg.defaults().keys(), keys)
+
+    for key in keys:
+        try:
+            cfg.get(section, key)
+        except InterpolationMissingOptionError:
+            continue
+
+        keyLevels = key.split('.')
+        if len(keyLevels) > 1:
+            subSectionKey = keyLevels[0]
+            subKey = '_'.join(keyLevels[1:])
+            if subSectionKey in validKeys and \
+               isinstance(validKeys[subSectionKey], dict):
+                val = _legacyParseVal(cfg, section, key,
+                                      validKeys[subSectionKey], subKey=subKey)
+                propRoot.setdefault(subSectionKey, {})[subKey] = val
+        else:
+            propRoot[key] = _legacyParseVal(cfg, section, key, validKeys)
+
+    return propRoot
+
+
+def _legacyParseVal(cfg, section, option, validKeys, subKey=None):
+    """Previous implementation of configfileparsers._parseVal for comparison
+    """
+    key = subKey or option
+    for conversionFunc in (cfg.getint, cfg.getfloat, cfg.getboolean,
+                           cfg.get):
+        try:
+            val = conversionFunc(section, option)
+            if val == '':
+                val = None
+
+            elif isinstance(val, basestring):
+                val = expandEnvVars(val)
+                if key in validKeys and isinstance(validKeys[key], list):
+                    val = val.split()
+
+            return val
+        except ValueError:
+            continue
+
+
+def writeINIFile(fileObj, numSections, numOptions, numDefaults):
+    """Write a synthetic INI file.  Options cycle through int, float, bool,
+    string, list, interpolated and nested sub-section values
+
+    @rtype: dict
+    @return: validKeys for reading the file
+    """
+    fileObj.write('[DEFAULT]\n')
+    for i in range(numDefaults):
+        fileObj.write('default%d = /opt/ndg/default%d\n' % (i, i))
+
+    valueTmpls = (
+        ('int%d', '%d'),
+        ('float%d', '%d.5'),
+        ('bool%d', None),
+        ('str%d', 'https://localhost:%d/AttributeAuthority'),
+        ('list%d', 'ca/%d.0 ca/other.0'),
+        ('path%d', '%%(default0)s/file%d.txt'),
+        ('sub.option%d', '%d')
+    )
+    for i in range(numSections):
+        fileObj.write('\n[section%d]\n' % i)
+        for j in range(numOptions):
+            keyTmpl, valTmpl = valueTmpls[j % len(valueTmpls)]
+            if valTmpl is None:
+                val = ('True', 'off')[j % 2]
+            else:
+                val = valTmpl % j
+
+            fileObj.write('%s = %s\n' % (keyTmpl % j, val))
+
+    validKeys = {'sub': {}}
+    for j in range(numOptions):
+        keyTmpl = valueTmpls[j % len(valueTmpls)][0]
+        if keyTmpl.startswith('list'):
+            validKeys[keyTmpl % j] = []
+
+    return validKeys
+
+
+def timeRead(propFilePath, validKeys, repeat):
+    """Time reading the file
+
+    @rtype: tuple
+    @return: properties read and the best time
+    """
+    best = None
+    for i in range(repeat):
+        start = default_timer()
+        properties = INIPropertyFile().read(propFilePath, validKeys,
+                                            defaultItems={})
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return properties, best
+
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(
+                usage="%prog [options]",
+                description="Benchmark reading INI properties files")
+    parser.add_option("-s",
+                      "--num-sections",
+                      dest="numSections",
+                      default=20,
+                      type='int',
+                      help="number of sections in the file")
+
+    parser.add_option("-n",
+                      "--num-options",
+                      dest="numOptions",
+                      default=50,
+                      type='int',
+                      help="number of options in each section")
+
+    parser.add_option("-d",
+                      "--num-defaults",
+                      dest="numDefaults",
+                      default=10,
+                      type='int',
+                      help="number of options in the DEFAULT section")
+
+    parser.add_option("-r",
+                      "--repeat",
+                      dest="repeat",
+                      default=5,
+                      type='int',
+                      help="number of repeats for each timing - the best "
+                           "time is reported")
+
+    parser.add_option("-o",
+                      "--output",
+                      dest="outputFilePath",
+                      help="file to write JSON results to, defaults to stdout")
+
+    opt = parser.parse_args(argv[1:])[0]
+    logging.getLogger().setLevel(logging.WARNING)
+
+    fd, propFilePath = tempfile.mkstemp(suffix='.ini')
+    try:
+        propFile = os.fdopen(fd, 'w')
+        try:
+            validKeys = writeINIFile(propFile, opt.numSections,
+                                     opt.numOptions, opt.numDefaults)
+        finally:
+            propFile.close()
+
+        # Warm the property file cache
+        propertyFileCache.clear()
+        INIPropertyFile().read(propFilePath, validKeys, defaultItems={})
+        cachedProperties, cachedSeconds = timeRead(propFilePath, validKeys,
+                                                   opt.repeat)
+
+        # Parse the file for every read
+        maxEntries = propertyFileCache.maxEntries
+        propertyFileCache.maxEntries = 0
+        parseConfig = configfileparsers._parseConfig
+        try:
+            properties, seconds = timeRead(propFilePath, validKeys,
+                                           opt.repeat)
+
+            configfileparsers._parseConfig = _legacyParseConfig
+            legacyProperties, legacySeconds = timeRead(propFilePath,
+                                                       validKeys, opt.repeat)
+        finally:
+            configfileparsers._parseConfig = parseConfig
+            propertyFileCache.maxEntries = maxEntries
+    finally:
+        os.remove(propFilePath)
+
+    if properties != legacyProperties or properties != cachedProperties:
+        raise AssertionError('Properties read differ from those read with '
+                             'the previous implementation or from the '
+                             'cache')
+
+    numOptions = opt.numSections * opt.numOptions + opt.numDefaults
+    report = {
+        'parameters': {
+            'numSections': opt.numSections,
+            'numOptions': opt.numOptions,
+            'numDefaults': opt.numDefaults,
+            'repeat': opt.repeat
+        },
+        'platform': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine()
+        },
+        'results': {
+            'INIPropertyFile.read': {
+                'ops': numOptions,
+                'seconds': seconds,
+                'opsPerSec': numOptions/seconds if seconds else None
+            },
+            'CachedINIPropertyFile.read': {
+                'ops': numOptions,
+                'seconds': cachedSeconds,
+                'opsPerSec': (numOptions/cachedSeconds
+                              if cachedSeconds else None)
+            },
+            'LegacyINIPropertyFile.read': {
+                'ops': numOptions,
+                'seconds': legacySeconds,
+                'opsPerSec': (numOptions/legacySeconds
+                              if legacySeconds else None)
+            }
+        }
+    }
+
+    if opt.outputFilePath:
+        outputFile = open(opt.outputFilePath, 'w')
+    else:
+        outputFile = sys.stdout
+
+    try:
+        json.dump(report, outputFile, indent=4, sort_keys=True)
+        outputFile.write('\n')
+    finally:
+        if outputFile is not sys.stdout:
+            outputFile.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""Benchmark sending SAML attribute queries over pooled persistent connections
+
+Compares the SAML SOAP binding sending each query over a new connection with
+sending them over connections from an HTTPConnectionPool.  Queries are sent
+to a local HTTPS test server using the test PKI.  Results are written as JSON:
+
+$ python bench_connectionpool.py -n 200
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "17/10/26"
+__copyright__ = "(C) 2009 Science and Technology Facilities Council"
+__license__ = "BSD - see LICENSE file in top-level directory"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import logging
+import sys
+import platform
+import optparse
+import urllib2
+import json
+from timeit import default_timer
+
+from ndg.saml.xml.etree import AttributeQueryElementTree
+from ndg.saml.saml2.binding.soap.client import SOAPBinding
+
+from ndg.security.common.saml_utils.esgf.xml.etree import \
+    ESGFResponseElementTree
+from ndg.security.common.saml_utils.esgf.xml.template import \
+    ESGFAttributeQueryTemplate
+from ndg.security.common.utils.connectionpool import (HTTPConnectionPool,
+                                                      PooledHTTPHandler,
+                                                      PooledHTTPSHandler)
+from ndg.security.common.test.unit.saml_utils.test_esgf_etree import \
+    ESGFResponseTestCaseBase
+from ndg.security.common.test.unit.connectionpool.test_connectionpool import (
+                                                    KeepAliveTestServer,
+                                                    makeServerSSLContext,
+                                                    makeClientSSLContext)
+
+
+class _ResponseFactory(ESGFResponseTestCaseBase):
+    """Create attribute query responses for the test server to return"""
+    def __init__(self):
+        ESGFResponseTestCaseBase.__init__(self, 'run')
+
+    def run(self):
+        pass
+
+
+def makeBinding(clientSSLContext, connectionPool=None):
+    """Make a SOAP binding sending queries over new connections or
+    connections from a pool"""
+    binding = SOAPBinding()
+    binding.serialise = AttributeQueryElementTree.toXML
+    binding.deserialise = ESGFResponseElementTree.fromXML
+    openerDirector = binding.client.openerDirector
+    if connectionPool is None:
+        openerDirector.add_handler(
+                            urllib2.HTTPSHandler(context=clientSSLContext))
+    else:
+        openerDirector.add_handler(PooledHTTPHandler(connectionPool))
+        openerDirector.add_handler(
+                            PooledHTTPSHandler(connectionPool,
+                                               sslContext=clientSSLContext))
+    return binding
+
+
+def timeQueries(binding, template, uri, numQueries, repeat):
+    """Time sending queries with a binding
+
+    @rtype: dict
+    @return: number of operations, best time and operations per second
+    """
+    best = None
+    for i in range(repeat):
+        start = default_timer()
+        for j in range(numQueries):
+            binding.send(template.makeQuery(ESGFResponseTestCaseBase.SUBJECT),
+                         uri=uri)
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return {
+        'ops': numQueries,
+        'seconds': best,
+        'opsPerSec': numQueries/best if best else None
+    }
+
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(
+                usage="%prog [options]",
+                description="Benchmark SAML attribute queries sent over new "
+                            "and pooled connections")
+    parser.add_option("-n",
+                      "--num-queries",
+                      dest="numQueries",
+                      default=200,
+                      type='int',
+                      help="number of attribute queries to send")
+
+    parser.add_option("-a",
+                      "--num-assertions",
+                      dest="numAssertions",
+                      default=2,
+                      type='int',
+                      help="number of assertions in each response")
+
+    parser.add_option("-r",
+                      "--repeat",
+                      dest="repeat",
+                      default=3,
+                      type='int',
+                      help="number of repeats for each timing - the best "
+                           "time is reported")
+
+    parser.add_option("-p",
+                      "--plain-http",
+                      dest="plainHttp",
+                      action="store_true",
+                      default=False,
+                      help="use plain HTTP rather than HTTPS")
+
+    parser.add_option("-o",
+                      "--output",
+                      dest="outputFilePath",
+                      help="file to write JSON results to, defaults to stdout")
+
+    opt = parser.parse_args(argv[1:])[0]
+    logging.getLogger().setLevel(logging.WARNING)
+
+    responseFactory = _ResponseFactory()
+    responseBody = (ESGFResponseTestCaseBase.SOAP_ENVELOPE_TMPL %
+                    responseFactory._serialise(
+                        responseFactory._createResponse(
+                                        numAssertions=opt.numAssertions)))
+    if opt.plainHttp:
+        server = KeepAliveTestServer(responseBody)
+    else:
+        server = KeepAliveTestServer(responseBody,
+                                     sslContext=makeServerSSLContext())
+
+    try:
+        template = ESGFAttributeQueryTemplate(
+                                        ESGFResponseTestCaseBase.ISSUER_NAME)
+        clientSSLContext = makeClientSSLContext()
+
+        newConnectionResults = timeQueries(makeBinding(clientSSLContext),
+                                           template, server.uri,
+                                           opt.numQueries, opt.repeat)
+
+        connectionPool = HTTPConnectionPool()
+        pooledResults = timeQueries(makeBinding(clientSSLContext,
+                                                connectionPool=connectionPool),
+                                    template, server.uri, opt.numQueries,
+                                    opt.repeat)
+        pooledResults['connectionsCreated'] = connectionPool.nCreated
+        connectionPool.closeAll()
+    finally:
+        server.stop()
+
+    report = {
+        'parameters': {
+            'numQueries': opt.numQueries,
+            'numAssertions': opt.numAssertions,
+            'repeat': opt.repeat,
+            'scheme': 'http' if opt.plainHttp else 'https'
+        },
+        'platform': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine()
+        },
+        'results': {
+            'NewConnection': newConnectionResults,
+            'Pooled': pooledResults
+        }
+    }
+
+    if opt.outputFilePath:
+        outputFile = open(opt.outputFilePath, 'w')
+    else:
+        outputFile = sys.stdout
+
+    try:
+        json.dump(report, outputFile, indent=4, sort_keys=True)
+        outputFile.write('\n')
+    finally:
+        if outputFile is not sys.stdout:
+            outputFile.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+"""Benchmarks for the SAML Assertion Credential Wallet
+
+Synthetic assertions are generated with a configurable number of issuers,
+attributes and expiry distribution, and the main wallet operations timed.
+Results are written as JSON so that they can be compared between releases:
+
+$ python bench_credentialwallet.py -n 1000 -o results.json
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "17/10/26"
+__copyright__ = "(C) 2009 Science and Technology Facilities Council"
+__license__ = "BSD - see LICENSE file in top-level directory"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import logging
+import sys
+import platform
+import optparse
+import random
+import json
+import cPickle as pickle
+from timeit import default_timer
+from datetime import datetime, timedelta
+from uuid import UUID
+
+from ndg.saml.common import SAMLVersion
+from ndg.saml.common.xml import SAMLConstants
+from ndg.saml.saml2.core import (Assertion, Issuer, Subject, NameID,
+                                 Conditions, AttributeStatement, Attribute,
+                                 XSStringAttributeValue)
+
+from ndg.security.common.credentialwallet import (SAMLAssertionWallet,
+                                                  _getDeepSize)
+
+
+class SyntheticAssertionFactory(object):
+    """Generate SAML Attribute assertions for benchmarking.  A random number
+    generator with a fixed seed is used so that runs are repeatable
+    """
+    FIXED_EXPIRY, UNIFORM_EXPIRY = 'fixed', 'uniform'
+    EXPIRY_DISTRIBUTIONS = (FIXED_EXPIRY, UNIFORM_EXPIRY)
+
+    ISSUER_NAME_TMPL = "/O=Site %d/CN=Attribute Authority"
+    SUBJECT_TMPL = "https://openid.site%d.ac.uk/openid/user%d"
+    ATTRIBUTE_NAME_TMPL = "urn:esg:benchmark:attribute%d"
+    XS_STRING_NS = SAMLConstants.XSD_NS + "#" + \
+                                        XSStringAttributeValue.TYPE_LOCAL_NAME
+
+    def __init__(self,
+                 numIssuers=4,
+                 numAttributes=3,
+                 validity=timedelta(hours=8),
+                 expiry=FIXED_EXPIRY,
+                 expiredFraction=0.,
+                 seed=0):
+        """
+        @type numIssuers: int
+        @param numIssuers: number of distinct issuers to spread assertions
+        over
+        @type numAttributes: int
+        @param numAttributes: number of attributes in each assertion
+        @type validity: datetime.timedelta
+        @param validity: validity period for assertions
+        @type expiry: basestring
+        @param expiry: expiry distribution - 'fixed' sets all assertions to
+        expire after the given validity period, 'uniform' distributes expiry
+        evenly between now and the end of the validity period
+        @type expiredFraction: float
+        @param expiredFraction: fraction of assertions generated which have
+        already expired
+        @type seed: int
+        @param seed: seed for random number generator
+        """
+        if expiry not in self.__class__.EXPIRY_DISTRIBUTIONS:
+            raise ValueError('Expecting one of %r for expiry distribution; '
+                             'got %r' %
+                             (self.__class__.EXPIRY_DISTRIBUTIONS, expiry))
+
+        if not 0. <= expiredFraction <= 1.:
+            raise ValueError('Expecting expired fraction in the range 0-1; '
+                             'got %r' % expiredFraction)
+
+        self.numIssuers = numIssuers
+        self.numAttributes = numAttributes
+        self.validity = validity
+        self.validitySecs = int(validity.total_seconds())
+        self.expiry = expiry
+        self.expiredFraction = expiredFraction
+        self.random = random.Random(seed)
+
+    def createAssertion(self, subject, issuerIdx, utcNow=None):
+        """Create a single assertion
+
+        @type subject: basestring
+        @param subject: subject name for the assertion
+        @type issuerIdx: int
+        @param issuerIdx: index to issuer name
+        @type utcNow: datetime / None type
+        @param utcNow: time of issue, defaults to current time
+        @rtype: ndg.saml.saml2.core.Assertion
+        @return: new assertion
+        """
+        if utcNow is None:
+            utcNow = datetime.utcnow()
+
+        if self.random.random() < self.expiredFraction:
+            # Issued and expired in the past
+            notOnOrAfter = utcNow - timedelta(
+                            seconds=self.random.randint(1, self.validitySecs))
+        elif self.expiry == self.__class__.UNIFORM_EXPIRY:
+            notOnOrAfter = utcNow + timedelta(
+                            seconds=self.random.randint(1, self.validitySecs))
+        else:
+            notOnOrAfter = utcNow + self.validity
+
+        assertion = Assertion()
+        assertion.version = SAMLVersion(SAMLVersion.VERSION_20)
+        assertion.id = str(UUID(int=self.random.getrandbits(128)))
+        assertion.issueInstant = notOnOrAfter - self.validity
+
+        assertion.issuer = Issuer()
+        assertion.issuer.format = Issuer.X509_SUBJECT
+        assertion.issuer.value = self.__class__.ISSUER_NAME_TMPL % issuerIdx
+
+        assertion.subject = Subject()
+        assertion.subject.nameID = NameID()
+        assertion.subject.nameID.format = "urn:esg:openid"
+        assertion.subject.nameID.value = subject
+
+        assertion.conditions = Conditions()
+        assertion.conditions.notBefore = assertion.issueInstant
+        assertion.conditions.notOnOrAfter = notOnOrAfter
+
+        attributeStatement = AttributeStatement()
+        for i in range(self.numAttributes):
+            attribute = Attribute()
+            attribute.name = self.__class__.ATTRIBUTE_NAME_TMPL % i
+            attribute.nameFormat = self.__class__.XS_STRING_NS
+
+            attributeValue = XSStringAttributeValue()
+            attributeValue.value = "value %d for %s" % (i, subject)
+            attribute.attributeValues.append(attributeValue)
+
+            attributeStatement.attributes.append(attribute)
+
+        assertion.attributeStatements.append(attributeStatement)
+        return assertion
+
+    def createAssertionsMap(self, numAssertions, subject=None):
+        """Create assertions keyed by issuer name in the same form as a
+        wallet holds them
+
+        @type numAssertions: int
+        @param numAssertions: total number of assertions to create
+        @type subject: basestring / None type
+        @param subject: subject for assertions, defaults to a generated name
+        @rtype: dict
+        @return: issuer name keyed lists of assertions
+        """
+        if subject is None:
+            subject = self.__class__.SUBJECT_TMPL % (0, 0)
+
+        utcNow = datetime.utcnow()
+        assertionsMap = {}
+        for i in range(numAssertions):
+            issuerIdx = i % self.numIssuers
+            key = self.__class__.ISSUER_NAME_TMPL % issuerIdx
+            assertionsMap.setdefault(key, []).append(
+                        self.createAssertion(subject, issuerIdx, utcNow=utcNow))
+
+        return assertionsMap
+
+
+class CredentialWalletBenchmark(object):
+    """Time SAMLAssertionWallet operations against a set of synthetic
+    assertions"""
+    SESSION_KEY = 'credentialWallet'
+
+    def __init__(self, assertionsMap, repeat=5, clockSkewTolerance=0.):
+        """
+        @type assertionsMap: dict
+        @param assertionsMap: key to lists of assertions to add to wallets
+        @type repeat: int
+        @param repeat: number of times to repeat each timing.  The best time
+        is reported
+        @type clockSkewTolerance: float
+        @param clockSkewTolerance: clock skew tolerance for wallets
+        """
+        self.assertionsMap = assertionsMap
+        self.repeat = repeat
+        self.clockSkewTolerance = clockSkewTolerance
+        self.numAssertions = sum([len(v) for v in assertionsMap.values()])
+
+    def _newWallet(self):
+        wallet = SAMLAssertionWallet()
+        wallet.clockSkewTolerance = self.clockSkewTolerance
+        return wallet
+
+    def _populatedWallet(self):
+        wallet = self._newWallet()
+        for key, assertions in self.assertionsMap.items():
+            wallet.addCredentials(key, assertions, verifyCredentials=False)
+        return wallet
+
+    def _time(self, setUp, func, numOps):
+        """Time func, calling setUp outside of the timing before each repeat
+
+        @rtype: dict
+        @return: number of operations, best time and operations per second
+        """
+        best = None
+        for i in range(self.repeat):
+            arg = setUp()
+            start = default_timer()
+            func(arg)
+            elapsed = default_timer() - start
+            if best is None or elapsed < best:
+                best = elapsed
+
+        return {
+            'ops': numOps,
+            'seconds': best,
+            'opsPerSec': numOps/best if best else None
+        }
+
+    def benchAddCredentials(self):
+        # Each assertion is added under its own key so that the wallet grows
+        # to hold all of them
+        items = [('%s#%d' % (key, i), [assertion])
+                 for key, assertions in self.assertionsMap.items()
+                 for i, assertion in enumerate(assertions)]
+        def addCredentials(wallet):
+            for key, assertions in items:
+                wallet.addCredentials(key, assertions,
+                                      verifyCredentials=False)
+
+        return self._time(self._newWallet, addCredentials, self.numAssertions)
+
+    def benchRetrieveCredentials(self):
+        keys = self.assertionsMap.keys()
+        def retrieveCredentials(wallet):
+            for key in keys:
+                wallet.retrieveCredentials(key)
+
+        return self._time(self._populatedWallet, retrieveCredentials,
+                          len(keys))
+
+    def benchAudit(self):
+        def audit(wallet):
+            wallet.audit()
+
+        return self._time(self._populatedWallet, audit, self.numAssertions)
+
+    def benchPickle(self):
+        def dumps(wallet):
+            pickle.dumps(wallet, pickle.HIGHEST_PROTOCOL)
+
+        return self._time(self._populatedWallet, dumps, 1)
+
+    def benchUnpickle(self):
+        def setUp():
+            return pickle.dumps(self._populatedWallet(),
+                                pickle.HIGHEST_PROTOCOL)
+        return self._time(setUp, pickle.loads, 1)
+
+    def benchUnpickleAndRetrieve(self):
+        """Unpickle then retrieve all credentials to include the cost of
+        rebuilding assertions deferred from unpickling"""
+        keys = self.assertionsMap.keys()
+        def setUp():
+            return pickle.dumps(self._populatedWallet(),
+                                pickle.HIGHEST_PROTOCOL)
+
+        def unpickleAndRetrieve(data):
+            wallet = pickle.loads(data)
+            for key in keys:
+                wallet.retrieveCredentials(key)
+
+        return self._time(setUp, unpickleAndRetrieve, 1)
+
+    def benchSessionRoundTrip(self):
+        """Serialise a session-like dictionary holding the wallet as Beaker
+        does when persisting a session"""
+        def roundTrip(wallet):
+            session = {self.__class__.SESSION_KEY: wallet}
+            pickle.loads(pickle.dumps(session, pickle.HIGHEST_PROTOCOL))
+
+        return self._time(self._populatedWallet, roundTrip, 1)
+
+    def sizes(self):
+        """Bytes for a populated wallet
+
+        @rtype: dict
+        @return: pickled, session and in memory sizes in bytes
+        """
+        wallet = self._populatedWallet()
+        session = {self.__class__.SESSION_KEY: wallet}
+        return {
+            'pickled': len(pickle.dumps(wallet, pickle.HIGHEST_PROTOCOL)),
+            'session': len(pickle.dumps(session, pickle.HIGHEST_PROTOCOL)),
+            'inMemory': _getDeepSize(wallet)
+        }
+
+    def run(self):
+        """Run all benchmarks
+
+        @rtype: dict
+        @return: results keyed by benchmark name
+        """
+        results = {}
+        for name in dir(self):
+            if name.startswith('bench'):
+                results[name[len('bench'):]] = getattr(self, name)()
+
+        return results
+
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(
+                usage="%prog [options]",
+                description="Benchmark SAML Assertion Credential Wallet "
+                            "operations with synthetic assertions")
+    parser.add_option("-n",
+                      "--num-assertions",
+                      dest="numAssertions",
+                      default=100,
+                      type='int',
+                      help="number of assertions to add to each wallet")
+
+    parser.add_option("-i",
+                      "--num-issuers",
+                      dest="numIssuers",
+                      default=4,
+                      type='int',
+                      help="number of distinct issuers")
+
+    parser.add_option("-a",
+                      "--num-attributes",
+                      dest="numAttributes",
+                      default=3,
+                      type='int',
+                      help="number of attributes per assertion")
+
+    parser.add_option("-e",
+                      "--expiry",
+                      dest="expiry",
+                      default=SyntheticAssertionFactory.FIXED_EXPIRY,
+                      choices=SyntheticAssertionFactory.EXPIRY_DISTRIBUTIONS,
+                      help="expiry distribution for assertions, one of %s" %
+                        ', '.join(SyntheticAssertionFactory.EXPIRY_DISTRIBUTIONS))
+
+    parser.add_option("-x",
+                      "--expired-fraction",
+                      dest="expiredFraction",
+                      default=0.,
+                      type='float',
+                      help="fraction of assertions which have already "
+                           "expired")
+
+    parser.add_option("-r",
+                      "--repeat",
+                      dest="repeat",
+                      default=5,
+                      type='int',
+                      help="number of repeats for each timing - the best "
+                           "time is reported")
+
+    parser.add_option("-s",
+                      "--seed",
+                      dest="seed",
+                      default=0,
+                      type='int',
+                      help="random number generator seed")
+
+    parser.add_option("-o",
+                      "--output",
+                      dest="outputFilePath",
+                      help="file to write JSON results to, defaults to stdout")
+
+    parser.add_option("-v",
+                      "--verbose",
+                      dest="verbose",
+                      action="store_true",
+                      default=False,
+                      help="include debug log messages - these will be "
+                           "included in timings")
+
+    opt = parser.parse_args(argv[1:])[0]
+
+    if not opt.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    factory = SyntheticAssertionFactory(numIssuers=opt.numIssuers,
+                                        numAttributes=opt.numAttributes,
+                                        expiry=opt.expiry,
+                                        expiredFraction=opt.expiredFraction,
+                                        seed=opt.seed)
+    benchmark = CredentialWalletBenchmark(
+                            factory.createAssertionsMap(opt.numAssertions),
+                            repeat=opt.repeat)
+
+    report = {
+        'parameters': {
+            'numAssertions': opt.numAssertions,
+            'numIssuers': opt.numIssuers,
+            'numAttributes': opt.numAttributes,
+            'expiry': opt.expiry,
+            'expiredFraction': opt.expiredFraction,
+            'repeat': opt.repeat,
+            'seed': opt.seed
+        },
+        'platform': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine()
+        },
+        'results': benchmark.run(),
+        'bytesPerWallet': benchmark.sizes()
+    }
+
+    if opt.outputFilePath:
+        outputFile = open(opt.outputFilePath, 'w')
+    else:
+        outputFile = sys.stdout
+
+    try:
+        json.dump(report, outputFile, indent=4, sort_keys=True)
+        outputFile.write('\n')
+    finally:
+        if outputFile is not sys.stdout:
+            outputFile.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -258,7 +258,7 @@ class AttributeAuthoritySAMLInterfaceTestCase(BaseTestCase):
             str(AttributeAuthoritySAMLInterfaceTestCase.VALID_REQUESTOR_IDS[0])
         binding.issuerFormat = Issuer.X509_SUBJECT
         
-        binding.queryAttributes = ESGFDefaultQueryAttributes.ATTRIBUTES
+        binding.queryAttributes = ESGFDefaultQueryAttributes.getAttributes()
 
         query = binding.makeQuery()
         binding.setQuerySubjectId(query,
@@ -13,9 +13,12 @@ __revision__ = '$Id$'
 import unittest
 import os, sys, getpass, re
 import traceback
+import tempfile
+import shutil
 
 from ndg.security.common.utils.configfileparsers import \
-    CaseSensitiveConfigParser, INIPropertyFile, readAndValidateProperties
+    CaseSensitiveConfigParser, INIPropertyFile, readAndValidateProperties, \
+    readINIPropertyFile, PropertyFileCache, propertyFileCache
 from ConfigParser import SafeConfigParser
 
 from os.path import expandvars as xpdVars
@@ -111,6 +114,81 @@ class ConfigFileParsersTestCase(unittest.TestCase):
         # set to its default value
         assert(prop['test3ReadAndValidateProperties']
             ['credentialWallet']['attributeAuthorityURI']=='A DEFAULT VALUE')
+
+    def test4TypeInference(self):
+        cfgFile = INIPropertyFile()
+        prop = cfgFile(self.configFilePath, {'aList': []},
+                       sections=('test4TypeInference',))
+        prop = prop['test4TypeInference']
+        
+        assert(prop['anInt'] == 12 and isinstance(prop['anInt'], int))
+        assert(prop['aFloat'] == 1500. and isinstance(prop['aFloat'], float))
+        assert(prop['anInfinity'] == float('-inf'))
+        assert(prop['aBool'] is False)
+        
+        # Integers take precedence over booleans
+        assert(prop['aZero'] == 0 and isinstance(prop['aZero'], int))
+        assert(prop['aString'] == '12 Monkeys')
+        assert(prop['anEmptyValue'] is None)
+        assert(prop['aList'] == ['ca/d573507a.0', 'ca/other.0'])
+        
+        # DEFAULT section items are not repeated in other sections
+        assert('here' not in prop)
+
+    def test5PropertyFileCache(self):
+        # Read a copy of the test file so that it can be modified
+        tmpDir = tempfile.mkdtemp()
+        propFilePath = jnPath(tmpDir, 'test.cfg')
+        shutil.copy(self.configFilePath, propFilePath)
+        propertyFileCache.clear()
+        try:
+            sections = ('test4TypeInference',)
+            prop = readINIPropertyFile(propFilePath, {'aList': []},
+                                       sections=sections)
+            self.assert_(propertyFileCache.nMisses == 1)
+            self.assert_(len(propertyFileCache) == 1)
+            
+            # Changing the result doesn't affect the cached copy
+            prop['test4TypeInference']['aList'].append('changed')
+            prop2 = readINIPropertyFile(propFilePath, {'aList': []},
+                                        sections=sections)
+            self.assert_(propertyFileCache.nHits == 1)
+            self.assert_(prop2['test4TypeInference']['aList'] ==
+                         ['ca/d573507a.0', 'ca/other.0'])
+            
+            # The config object is available following a cache hit
+            cfgFile = INIPropertyFile()
+            cfgFile.read(propFilePath, {'aList': []}, sections=sections)
+            self.assert_(propertyFileCache.nHits == 2)
+            self.assert_(cfgFile.cfg.has_section('test4TypeInference'))
+            self.assert_(cfgFile.cfg.get('DEFAULT', 'here') == tmpDir)
+            
+            # Reading with different settings parses the file again
+            readINIPropertyFile(propFilePath, {}, sections=sections)
+            self.assert_(propertyFileCache.nMisses == 2)
+            self.assert_(len(propertyFileCache) == 2)
+            
+            # A changed file is re-read and replaces previous versions
+            propFile = open(propFilePath, 'a')
+            propFile.write('anotherInt = 3\n')
+            propFile.close()
+            prop3 = readINIPropertyFile(propFilePath, {'aList': []},
+                                        sections=sections)
+            self.assert_(prop3['test4TypeInference']['anotherInt'] == 3)
+            self.assert_(len(propertyFileCache) == 1)
+            
+            propertyFileCache.invalidate(propFilePath)
+            self.assert_(len(propertyFileCache) == 0)
+            
+            propertyFileCache.maxEntries = 0
+            readINIPropertyFile(propFilePath, {'aList': []}, 
+                                sections=sections)
+            self.assert_(len(propertyFileCache) == 0)
+        finally:
+            propertyFileCache.maxEntries = \
+                PropertyFileCache.DEFAULT_MAX_ENTRIES
+            propertyFileCache.clear()
+            shutil.rmtree(tmpDir)
         
 if __name__ == "__main__":
     unittest.main()        
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+"""Unit tests for HTTP(S) connection pooling
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "17/10/26"
+__copyright__ = "(C) 2009 Science and Technology Facilities Council"
+__license__ = "BSD - see LICENSE file in top-level directory"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import unittest
+import os
+import ssl
+import threading
+import urllib2
+import cookielib
+from time import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from ndg.saml.xml.etree import AttributeQueryElementTree
+from ndg.saml.saml2.binding.soap.client import SOAPBinding
+
+from ndg.security.common.config import importElementTree
+ElementTree = importElementTree()
+
+from ndg.security.common.saml_utils.esgf.xml.etree import \
+    ESGFResponseElementTree
+from ndg.security.common.saml_utils.esgf.xml.template import \
+    ESGFAttributeQueryTemplate
+from ndg.security.common.utils.connectionpool import (HTTPConnectionPool,
+                                                      PooledHTTPHandler,
+                                                      PooledHTTPSHandler)
+from ndg.security.common.test.unit.base import BaseTestCase
+from ndg.security.common.test.unit.saml_utils.test_esgf_etree import \
+    ESGFResponseTestCaseBase
+
+THIS_DIR = os.path.dirname(__file__)
+PKI_DIR = os.path.join(THIS_DIR, '..', '..', 'config', 'pki')
+CERT_FILEPATH = os.path.join(PKI_DIR, 'localhost.crt')
+PRIKEY_FILEPATH = os.path.join(PKI_DIR, 'localhost.key')
+
+
+def makeServerSSLContext(certFilePath=CERT_FILEPATH,
+                         priKeyFilePath=PRIKEY_FILEPATH):
+    """SSL context for a test server.  The test PKI uses MD5 signatures so
+    lower the OpenSSL security level if necessary to load it"""
+    sslContext = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    try:
+        sslContext.load_cert_chain(certFilePath, priKeyFilePath)
+    except ssl.SSLError:
+        sslContext.set_ciphers('DEFAULT:@SECLEVEL=0')
+        sslContext.load_cert_chain(certFilePath, priKeyFilePath)
+
+    return sslContext
+
+
+def makeClientSSLContext():
+    """SSL context for clients of a test server.  The test PKI certificates
+    have expired so peer verification is disabled"""
+    sslContext = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    sslContext.check_hostname = False
+    sslContext.verify_mode = ssl.CERT_NONE
+    return sslContext
+
+
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+    """Respond to POST requests with the server's response body keeping the
+    connection open"""
+    protocol_version = 'HTTP/1.1'
+
+    # Buffer writes so that headers and body are sent together - unbuffered
+    # header writes interact badly with Nagle's algorithm on persistent
+    # connections.  The buffer is flushed after each request
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.countConnection()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-length']))
+        self.server.cookies.append(self.headers.get('Cookie'))
+
+        self.send_response(200)
+        self.send_header('Content-type', 'text/xml')
+        self.send_header('Content-length', str(len(self.server.responseBody)))
+        self.send_header('Set-Cookie', 'session=%d; Path=/' %
+                         len(self.server.cookies))
+        self.end_headers()
+        self.wfile.write(self.server.responseBody)
+
+        # Close without telling the client to simulate a server closing an
+        # idle connection
+        self.close_connection = self.server.closeAfterResponse
+
+    do_PUT = do_POST
+
+    def log_message(self, *arg):
+        pass
+
+
+class KeepAliveTestServer(ThreadingMixIn, HTTPServer):
+    """HTTP/1.1 test server supporting persistent connections over HTTP or
+    HTTPS"""
+    daemon_threads = True
+
+    def __init__(self, responseBody, sslContext=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _KeepAliveHandler)
+        self.responseBody = responseBody
+        self.closeAfterResponse = False
+        self.cookies = []
+        self.sslContext = sslContext
+        if sslContext is not None:
+            self.socket = sslContext.wrap_socket(self.socket,
+                                                 server_side=True)
+        self.__nConnections = 0
+        self.__nClosed = 0
+        self.__lock = threading.Lock()
+        self.__closed = threading.Condition(self.__lock)
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def countConnection(self):
+        self.__lock.acquire()
+        try:
+            self.__nConnections += 1
+        finally:
+            self.__lock.release()
+
+    @property
+    def nConnections(self):
+        return self.__nConnections
+
+    def shutdown_request(self, request):
+        HTTPServer.shutdown_request(self, request)
+        self.__closed.acquire()
+        try:
+            self.__nClosed += 1
+            self.__closed.notifyAll()
+        finally:
+            self.__closed.release()
+
+    def waitForClose(self, nClosed, timeout=5.):
+        """Wait until the server has closed nClosed connections in total"""
+        deadline = time() + timeout
+        self.__closed.acquire()
+        try:
+            while self.__nClosed < nClosed and time() < deadline:
+                self.__closed.wait(deadline - time())
+        finally:
+            self.__closed.release()
+
+    @property
+    def uri(self):
+        return '%s://localhost:%d/AttributeAuthority' % (
+                            'http' if self.sslContext is None else 'https',
+                            self.server_port)
+
+    def handle_error(self, request, clientAddress):
+        pass
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _UncheckedHTTPConnectionPool(HTTPConnectionPool):
+    """Reuse idle connections without checking whether the server has closed
+    them"""
+
+    @staticmethod
+    def _isConnectionAlive(connection):
+        return connection.sock is not None
+
+
+class HTTPConnectionPoolTestCase(BaseTestCase):
+    """Test persistent connection pooling"""
+    RESPONSE_BODY = '<response/>'
+
+    def setUp(self):
+        self.server = KeepAliveTestServer(self.__class__.RESPONSE_BODY)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test01ReuseConnection(self):
+        pool = HTTPConnectionPool()
+        for i in range(5):
+            response = pool.request(self.server.uri, body='<request/>',
+                                    headers={'Content-type': 'text/xml'},
+                                    timeout=5.)
+            self.assert_(response.status == 200)
+            self.assert_(response.body == self.__class__.RESPONSE_BODY)
+
+        self.assert_(pool.nCreated == 1)
+        self.assert_(pool.nReused == 4)
+        self.assert_(pool.nIdle == 1)
+        self.assert_(self.server.nConnections == 1)
+
+        pool.closeAll()
+        self.assert_(pool.nIdle == 0)
+
+    def test02IdleTimeout(self):
+        pool = HTTPConnectionPool(idleTimeout=0.)
+        for i in range(2):
+            pool.request(self.server.uri, body='<request/>', timeout=5.)
+
+        self.assert_(pool.nCreated == 2)
+        self.assert_(pool.nReused == 0)
+
+    def test03ServerClosedConnection(self):
+        self.server.closeAfterResponse = True
+        pool = HTTPConnectionPool()
+        for i in range(3):
+            response = pool.request(self.server.uri, body='<request/>',
+                                    timeout=5.)
+            self.assert_(response.body == self.__class__.RESPONSE_BODY)
+            self.server.waitForClose(i + 1)
+
+        self.assert_(pool.nCreated == 3)
+
+    def test04MaxSize(self):
+        pool = HTTPConnectionPool(maxSize=0)
+        for i in range(2):
+            pool.request(self.server.uri, body='<request/>', timeout=5.)
+
+        self.assert_(pool.nCreated == 2)
+        self.assert_(pool.nIdle == 0)
+
+    def test05Cookies(self):
+        pool = HTTPConnectionPool(cookieJar=cookielib.CookieJar())
+        for i in range(2):
+            pool.request(self.server.uri, body='<request/>', timeout=5.)
+
+        self.assert_(self.server.cookies == [None, 'session=1'])
+
+    def test06RetryIdempotentOnly(self):
+        self.server.closeAfterResponse = True
+        pool = _UncheckedHTTPConnectionPool()
+        pool.request(self.server.uri, body='<request/>', timeout=5.)
+        self.server.waitForClose(1)
+
+        # A POST sent on a connection the server has closed isn't repeated
+        self.assertRaises(HTTPConnectionPool.STALE_CONNECTION_EXCEPTIONS,
+                          pool.request, self.server.uri, body='<request/>',
+                          timeout=5.)
+        self.assert_(pool.nCreated == 1)
+
+        pool.request(self.server.uri, body='<request/>', timeout=5.)
+        self.assert_(pool.nCreated == 2)
+        self.server.waitForClose(2)
+        response = pool.request(self.server.uri, body='<request/>',
+                                method='PUT', timeout=5.)
+        self.assert_(response.body == self.__class__.RESPONSE_BODY)
+        self.assert_(pool.nCreated == 3)
+
+    def test07Urllib2Handler(self):
+        pool = HTTPConnectionPool()
+        opener = urllib2.build_opener(PooledHTTPHandler(pool))
+        for i in range(2):
+            response = opener.open(self.server.uri, '<request/>', 5.)
+            self.assert_(response.code == 200)
+            self.assert_(response.read() == self.__class__.RESPONSE_BODY)
+            self.assert_(response.info().typeheader == 'text/xml')
+
+        self.assert_(pool.nReused == 1)
+
+
+class PooledSOAPBindingTestCase(ESGFResponseTestCaseBase):
+    """Test the SAML SOAP binding with a pooled HTTPS transport"""
+
+    def setUp(self):
+        responseBody = (self.__class__.SOAP_ENVELOPE_TMPL %
+                        self._serialise(self._createResponse()))
+        self.server = KeepAliveTestServer(responseBody,
+                                          sslContext=makeServerSSLContext())
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test01SendAttributeQueries(self):
+        pool = HTTPConnectionPool()
+        binding = SOAPBinding()
+        binding.serialise = AttributeQueryElementTree.toXML
+        binding.deserialise = ESGFResponseElementTree.fromXML
+        binding.client.openerDirector.add_handler(
+                PooledHTTPSHandler(pool, sslContext=makeClientSSLContext()))
+
+        template = ESGFAttributeQueryTemplate(self.__class__.ISSUER_NAME)
+        for i in range(3):
+            response = binding.send(
+                                template.makeQuery(self.__class__.SUBJECT),
+                                uri=self.server.uri)
+            self.assert_(len(response.assertions) == 2)
+
+        self.assert_(pool.nCreated == 1)
+        self.assert_(self.server.nConnections == 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
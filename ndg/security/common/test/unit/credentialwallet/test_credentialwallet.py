@@ -14,6 +14,9 @@ logging.basicConfig(level=logging.DEBUG)
 
 import unittest
 import os
+import threading
+import hashlib
+import sqlite3
 
 from string import Template
 from cStringIO import StringIO
@@ -25,11 +28,27 @@ from time import sleep
 from datetime import datetime, timedelta
 
 from ndg.saml.utils import SAMLDateTime
+from ndg.saml.saml2.core import Attribute, Assertion
 from ndg.saml.xml.etree import AssertionElementTree
 
 from ndg.security.common.test.unit.base import BaseTestCase
-from ndg.security.common.utils.etree import prettyPrint
-from ndg.security.common.credentialwallet import SAMLAssertionWallet
+from ndg.security.common.utils.etree import (prettyPrint, canonicalize,
+                                             C14N_BACKENDS)
+from ndg.security.common.utils.configfileparsers import \
+    CaseSensitiveConfigParser
+from ndg.security.common.saml_utils.esgf.xml.etree import \
+    ESGFAssertionElementTree
+from ndg.security.common import credentialwallet
+from ndg.security.common.saml_utils.esgf import ESGFGroupRoleAttributeValue
+from ndg.security.common.credentialwallet import (
+                                                SAMLAssertionWallet, 
+                                                SAMLAssertionCache,
+                                                AttributeAuthorityFailureCache,
+                                                SAMLAssertionDigestCache,
+                                                SQLiteCredentialRepository,
+                                                WriteBehindCredentialRepository,
+                                                CredentialWalletError,
+                                                CredentialRepositoryError)
 
 
 class CredentialWalletBaseTestCase(BaseTestCase):
@@ -122,7 +141,17 @@ class SAMLAttributeWalletTestCase(CredentialWalletBaseTestCase):
                                 timeNow=datetime.utcnow() + timedelta(hours=24))
 
         self.assert_(not wallet.isValidCredential(futureAssertion))
-        
+
+        for assertion in expiredAssertion, futureAssertion:
+            self.assertRaises(CredentialWalletError, wallet.addCredentials,
+                              'a', [self.assertion, assertion])
+        self.assert_(wallet.retrieveCredentials('a') is None)
+
+        # Within the clock skew tolerance
+        wallet.clockSkewTolerance = 25*60*60
+        wallet.addCredentials('a', [expiredAssertion, futureAssertion])
+        self.assert_(len(wallet.retrieveCredentials('a')) == 2)
+
     def test03AuditCredentials(self):
         # Add a short lived credential and ensure it's removed when an audit
         # is carried to prune expired credentials
@@ -194,7 +223,1006 @@ class SAMLAttributeWalletTestCase(CredentialWalletBaseTestCase):
                                 self.__class__.CONFIG_FILEPATH)
         self.assert_(wallet.clockSkewTolerance == timedelta(seconds=0.01))
         self.assert_(wallet.userId == 'https://openid.localhost/philip.kershaw')
+
+    def test09NextExpiry(self):
+        wallet = SAMLAssertionWallet()
+        self.assert_(wallet.nextExpiry is None)
+        self.assert_(not wallet.hasExpiredCredentials())
+
+        timeNow = datetime.utcnow()
+        shortExpiryAssertion = self._createAssertion(timeNow=timeNow,
+                                                     validityDuration=60)
+        wallet.addCredentials('a', [self.assertion])
+        wallet.addCredentials('b', [shortExpiryAssertion])
+        self.assert_(wallet.nextExpiry ==
+                     shortExpiryAssertion.conditions.notOnOrAfter)
+
+        self.assert_(not wallet.hasExpiredCredentials())
+        self.assert_(wallet.hasExpiredCredentials(
+                                    utcNow=timeNow + timedelta(seconds=61)))
+
+        # Replacing credentials supersedes the earlier expiry
+        wallet.addCredentials('b', [self._createAssertion()])
+        self.assert_(wallet.nextExpiry ==
+                     self.assertion.conditions.notOnOrAfter)
+
+        wallet.clockSkewTolerance = 30
+        self.assert_(wallet.nextExpiry ==
+                     self.assertion.conditions.notOnOrAfter +
+                     timedelta(seconds=30))
+
+    def test10AuditRemovesExpiredOnly(self):
+        wallet = SAMLAssertionWallet()
+        shortExpiryAssertion = self._createAssertion(validityDuration=1)
+        wallet.addCredentials('a', [self.assertion, shortExpiryAssertion])
+        wallet.addCredentials('b', [self._createAssertion(validityDuration=1)])
+        wallet.addCredentials('c', [self._createAssertion()])
+
+        sleep(2)
+        self.assert_(wallet.hasExpiredCredentials())
+        wallet.audit()
+
+        self.assert_(wallet.retrieveCredentials('a') == [self.assertion])
+        self.assert_(wallet.retrieveCredentials('b') is None)
+        self.assert_(len(wallet.retrieveCredentials('c')) == 1)
+        self.assert_(not wallet.hasExpiredCredentials())
+
+    def test11AuditRemovesNotYetValid(self):
+        wallet = SAMLAssertionWallet()
+        futureAssertion = self._createAssertion(
+                                timeNow=datetime.utcnow() + timedelta(hours=1))
+        wallet.addCredentials('a', [futureAssertion], verifyCredentials=False)
+        wallet.audit()
+        self.assert_(wallet.retrieveCredentials('a') is None)
+
+    def test12UnpickledWalletAudit(self):
+        wallet = SAMLAssertionWallet()
+        wallet.addCredentials('a', [self._createAssertion(validityDuration=1)])
+
+        unpickledWallet = pickle.loads(pickle.dumps(wallet))
+        self.assert_(unpickledWallet.nextExpiry == wallet.nextExpiry)
+
+        sleep(2)
+        unpickledWallet.audit()
+        self.assert_(unpickledWallet.retrieveCredentials('a') is None)
+
+    def test13AuditOnRetrieve(self):
+        wallet = SAMLAssertionWallet()
+        self.assert_(not wallet.auditOnRetrieve)
+
+        expiredAssertion = self._createAssertion(
+                                timeNow=datetime.utcnow() - timedelta(hours=24))
+        wallet.addCredentials('a', [self.assertion, expiredAssertion],
+                              verifyCredentials=False)
+        wallet.addCredentials('b', [expiredAssertion],
+                              verifyCredentials=False)
+
+        # Default behaviour returns the credentials as stored
+        self.assert_(len(wallet.retrieveCredentials('a')) == 2)
+
+        wallet.auditOnRetrieve = 'True'
+        self.assert_(wallet.auditOnRetrieve)
+        self.assert_(wallet.retrieveCredentials('a') == [self.assertion])
+        self.assert_(wallet.retrieveCredentials('b') is None)
+
+        # Remaining assertion is still indexed
+        self.assert_(wallet.nextExpiry ==
+                     self.assertion.conditions.notOnOrAfter)
+        wallet.audit()
+        self.assert_(wallet.retrieveCredentials('a') == [self.assertion])
+
+    def test14AuditOnRetrieveFromConfig(self):
+        wallet = SAMLAssertionWallet.fromConfig(
+                                self.__class__.CONFIG_FILEPATH)
+        self.assert_(wallet.auditOnRetrieve)
+
+        unpickledWallet = pickle.loads(pickle.dumps(wallet))
+        self.assert_(unpickledWallet.auditOnRetrieve)
+
+    def test15CompactPickle(self):
+        wallet = SAMLAssertionWallet()
+        groupRoleAttribute = Attribute()
+        groupRoleAttribute.name = 'urn:esg:group:role'
+        groupRoleValue = ESGFGroupRoleAttributeValue()
+        groupRoleValue.group = 'CMIP5 Research'
+        groupRoleValue.role = 'default'
+        groupRoleAttribute.attributeValues.append(groupRoleValue)
+        self.assertion.attributeStatements[0].attributes.append(
+                                                            groupRoleAttribute)
+        wallet.addCredentials('a', [self.assertion])
+
+        # Compare against the earlier format pickling the assertions in full
+        legacyState = dict(wallet.__getstate__())
+        self.assert_(legacyState.pop('stateVersion') == 2)
+        del legacyState['packedAssertions']
+        legacyState['_SAMLAssertionWallet__assertionsMap'
+                    ] = {'a': [self.assertion]}
+
+        pickledWallet = pickle.dumps(wallet, pickle.HIGHEST_PROTOCOL)
+        pickledLegacyState = pickle.dumps(legacyState, pickle.HIGHEST_PROTOCOL)
+        self.assert_(len(pickledWallet) < len(pickledLegacyState))
+
+        unpickledWallet = pickle.loads(pickledWallet)
+        assertion = unpickledWallet.retrieveCredentials('a')[0]
+        self.assert_(assertion.id == self.assertion.id)
+        self.assert_(assertion.issuer.value == self.assertion.issuer.value)
+        self.assert_(assertion.conditions.notOnOrAfter ==
+                     self.assertion.conditions.notOnOrAfter)
+
+        attributes = assertion.attributeStatements[0].attributes
+        self.assert_(attributes[0].attributeValues[0].value == 'Test')
+        self.assert_(attributes[-1].attributeValues[0].group ==
+                     'CMIP5 Research')
+
+        # Re-pickle after access
+        unpickledWallet = pickle.loads(pickle.dumps(unpickledWallet))
+        self.assert_(unpickledWallet.retrieveCredentials('a')[0].id ==
+                     self.assertion.id)
+
+        # Changes made in place to the assertions retrieved are pickled
+        assertions = unpickledWallet.retrieveCredentials('a')
+        assertions[0] = self._createAssertion()
+        assertions[0].id = 'replaced'
+        unpickledWallet = pickle.loads(pickle.dumps(unpickledWallet))
+        self.assert_(unpickledWallet.retrieveCredentials('a')[0].id ==
+                     'replaced')
+        
+        assertions = unpickledWallet.retrieveCredentials('a')
+        assertions[0].issuer.value = 'changed'
+        unpickledWallet = pickle.loads(pickle.dumps(unpickledWallet))
+        self.assert_(unpickledWallet.retrieveCredentials('a')[0].issuer.value
+                     == 'changed')
+
+    def test16LegacyPickleState(self):
+        legacyState = {
+            '_CredentialWalletBase__userId': 'https://openid.localhost/a',
+            '_SAMLAssertionWallet__clockSkewTolerance': timedelta(seconds=1.),
+            '_SAMLAssertionWallet__assertionsMap': {'a': [self.assertion]}
+        }
+        wallet = SAMLAssertionWallet.__new__(SAMLAssertionWallet)
+        wallet.__setstate__(legacyState)
+
+        self.assert_(wallet.userId == 'https://openid.localhost/a')
+        self.assert_(wallet.clockSkewTolerance == timedelta(seconds=1.))
+        self.assert_(wallet.retrieveCredentials('a') == [self.assertion])
+        self.assert_(wallet.nextExpiry ==
+                     self.assertion.conditions.notOnOrAfter +
+                     timedelta(seconds=1.))
+
+    def test17AuditPackedAssertions(self):
+        wallet = SAMLAssertionWallet()
+        expiredAssertion = self._createAssertion(
+                                timeNow=datetime.utcnow() - timedelta(hours=24))
+        wallet.addCredentials('a', [self.assertion, expiredAssertion],
+                              verifyCredentials=False)
+        wallet.addCredentials('b', [expiredAssertion],
+                              verifyCredentials=False)
+
+        unpickledWallet = pickle.loads(pickle.dumps(wallet))
+        unpickledWallet.audit()
+
+        self.assert_(unpickledWallet.retrieveCredentials('b') is None)
+        assertions = unpickledWallet.retrieveCredentials('a')
+        self.assert_(len(assertions) == 1)
+        self.assert_(assertions[0].conditions.notOnOrAfter ==
+                     self.assertion.conditions.notOnOrAfter)
+
+    def test18DirtyTracking(self):
+        wallet = SAMLAssertionWallet()
+        self.assert_(not wallet.isDirty())
+        self.assert_(wallet.generation == 0)
+
+        wallet.addCredentials('a', [self.assertion])
+        self.assert_(wallet.isDirty())
+        generation = wallet.generation
+        self.assert_(generation > 0)
+
+        wallet.markClean()
+        self.assert_(not wallet.isDirty())
+
+        # Read only access and an audit removing nothing leave the wallet
+        # clean
+        wallet.retrieveCredentials('a')
+        wallet.audit()
+        self.assert_(not wallet.isDirty())
+        self.assert_(wallet.generation == generation)
+
+        # The generation is preserved on pickling and the unpickled copy is
+        # clean
+        unpickledWallet = pickle.loads(pickle.dumps(wallet))
+        self.assert_(unpickledWallet.generation == generation)
+        self.assert_(not unpickledWallet.isDirty())
+        unpickledWallet.retrieveCredentials('a')
+        self.assert_(not unpickledWallet.isDirty())
+
+        expiredAssertion = self._createAssertion(
+                                timeNow=datetime.utcnow() - timedelta(hours=24))
+        unpickledWallet.addCredentials('b', [expiredAssertion],
+                                       verifyCredentials=False)
+        unpickledWallet.markClean()
+        unpickledWallet.audit()
+        self.assert_(unpickledWallet.isDirty())
+        self.assert_(unpickledWallet.generation > generation)
+
+        unpickledWallet.markClean()
+        unpickledWallet.clockSkewTolerance = 1
+        self.assert_(unpickledWallet.isDirty())
+
+    def test19AddCredentialsBatch(self):
+        wallet = SAMLAssertionWallet()
+        wallet.addCredentials('c', [self.assertion])
+
+        expiredAssertion = self._createAssertion(
+                                timeNow=datetime.utcnow() - timedelta(hours=24))
+        futureAssertion = self._createAssertion(
+                                timeNow=datetime.utcnow() + timedelta(hours=24))
+        rejected = wallet.addCredentialsBatch({
+            'a': [self.assertion, expiredAssertion],
+            'b': [futureAssertion, None],
+            'c': [expiredAssertion]
+        })
+
+        self.assert_(rejected['a'] == [
+                        (expiredAssertion, SAMLAssertionWallet.EXPIRED_REASON)])
+        self.assert_(rejected['b'] == [
+                    (futureAssertion, SAMLAssertionWallet.NOT_YET_VALID_REASON),
+                    (None, SAMLAssertionWallet.INVALID_TYPE_REASON)])
+        self.assert_(wallet.retrieveCredentials('a') == [self.assertion])
+        self.assert_(wallet.retrieveCredentials('b') is None)
+
+        # Keys with no valid assertions retain any existing ones
+        self.assert_(wallet.retrieveCredentials('c') == [self.assertion])
+
+        # Clock skew tolerance is allowed for
+        wallet.clockSkewTolerance = timedelta(hours=25)
+        rejected = wallet.addCredentialsBatch([('d', [futureAssertion])])
+        self.assert_(not rejected)
+        self.assert_(wallet.retrieveCredentials('d') == [futureAssertion])
+
+    def test20ValidityBoundsFollowClockSkew(self):
+        # Assertion issued 8 hours ago with 8 hours validity + 2 seconds
+        # lapsed
+        recentlyExpiredAssertion = self._createAssertion(
+                timeNow=datetime.utcnow() - timedelta(hours=8, seconds=2))
+
+        wallet = SAMLAssertionWallet()
+        wallet.auditOnRetrieve = True
+        wallet.clockSkewTolerance = timedelta(hours=1)
+        wallet.addCredentials('a', [self.assertion, recentlyExpiredAssertion],
+                              verifyCredentials=False)
+        wallet.audit()
+        self.assert_(wallet.retrieveCredentials('a') == [
+                                self.assertion, recentlyExpiredAssertion])
+
+        # Narrowing the tolerance shifts the cached bounds
+        wallet.clockSkewTolerance = 0.
+        self.assert_(wallet.retrieveCredentials('a') == [self.assertion])
+
+        wallet.addCredentials('b', [recentlyExpiredAssertion],
+                              verifyCredentials=False)
+        wallet.clockSkewTolerance = 60.
+        wallet.audit()
+        self.assert_(wallet.retrieveCredentials('b') == [
+                                                    recentlyExpiredAssertion])
+
+        wallet.clockSkewTolerance = 1.
+        wallet.audit()
+        self.assert_(wallet.retrieveCredentials('b') is None)
+
+    def _addGroupRole(self, assertion, group, role):
+        attribute = Attribute()
+        attribute.name = 'urn:esg:group:role'
+        attributeValue = ESGFGroupRoleAttributeValue()
+        attributeValue.value = group, role
+        attribute.attributeValues.append(attributeValue)
+        assertion.attributeStatements[0].attributes.append(attribute)
+        
+    def test21AttributeIndex(self):
+        self._addGroupRole(self.assertion, 'siteagroup', 'admin')
+        wallet = self._addCredentials()
+        self.assert_(wallet.hasAttribute('urn:esg:first:name', 'Test'))
+        self.assert_(not wallet.hasAttribute('urn:esg:first:name', 'User'))
+        self.assert_(wallet.hasGroupRole('siteagroup', 'admin'))
+        self.assert_(not wallet.hasGroupRole('siteagroup', 'user'))
+        
+        # The default role matches any role held for the group
+        self.assert_(wallet.hasGroupRole('siteagroup'))
+        self.assert_(not wallet.hasGroupRole('sitebgroup'))
+        self.assert_(wallet.attributeIndex.getGroupRoleAssertions(
+                                            'siteagroup') == [self.assertion])
+        
+        # Assertions for a new key are added to the current index
+        attributeIndex = wallet.attributeIndex
+        expiringAssertion = self._createAssertion(validityDuration=1)
+        self._addGroupRole(expiringAssertion, 'sitebgroup', 'default')
+        wallet.addCredentials('b', [expiringAssertion])
+        self.assert_(wallet.attributeIndex is attributeIndex)
+        self.assert_(wallet.hasGroupRole('sitebgroup'))
+        
+        # Settings changes leave the index in place
+        wallet.clockSkewTolerance = 0.
+        wallet.auditOnRetrieve = False
+        self.assert_(wallet.attributeIndex is attributeIndex)
+        
+        # Expired assertions are ignored before they're removed by audit
+        sleep(1)
+        self.assert_(not wallet.hasGroupRole('sitebgroup'))
+        self.assert_(attributeIndex.hasGroupRole('sitebgroup'))
+        
+        # Removal by audit updates the index
+        wallet.audit()
+        self.assert_(wallet.retrieveCredentials('b') is None)
+        self.assert_(not attributeIndex.hasGroupRole('sitebgroup'))
+        self.assert_(wallet.hasGroupRole('siteagroup', 'admin'))
+        
+        # Replacing the assertions for a key replaces their index entries
+        newAssertion = self._createAssertion()
+        self._addGroupRole(newAssertion, 'siteagroup', 'user')
+        wallet.addCredentials(self.__class__.SITEA_ATTRIBUTEAUTHORITY_URI,
+                              [newAssertion])
+        self.assert_(wallet.attributeIndex is attributeIndex)
+        self.assert_(wallet.hasGroupRole('siteagroup', 'user'))
+        self.assert_(not wallet.hasGroupRole('siteagroup', 'admin'))
+        self.assert_(attributeIndex.getGroupRoleAssertions('siteagroup') == 
+                     [newAssertion])
+        
+        # The index is rebuilt following unpickling
+        wallet = pickle.loads(pickle.dumps(wallet))
+        self.assert_(wallet.hasGroupRole('siteagroup', 'user'))
+        self.assert_(not wallet.hasGroupRole('siteagroup', 'admin'))
+
+
+class SAMLAssertionCacheTestCase(CredentialWalletBaseTestCase):
+    """Test shared cache of SAML Attribute assertions"""
+    CACHE_CONFIG_FILENAME = 'test_samlassertioncache.cfg'
+    CACHE_CONFIG_FILEPATH = os.path.join(CredentialWalletBaseTestCase.THIS_DIR, 
+                                         CACHE_CONFIG_FILENAME)
+    SUBJECT = 'https://esg.prototype.ucar.edu/myopenid/testUser'
+    ATTRIBUTE_NAMES = ('urn:esg:first:name', 'urn:esg:last:name')
+    
+    ASSERTION_STR = SAMLAttributeWalletTestCase.ASSERTION_STR
+    _createAssertion = SAMLAttributeWalletTestCase.__dict__['_createAssertion']
+    
+    def _makeKey(self, issuer=BaseTestCase.SITEA_SAML_ISSUER_NAME):
+        return SAMLAssertionCache.makeKey(self.__class__.SUBJECT, issuer,
+                                          self.__class__.ATTRIBUTE_NAMES)
+        
+    def test01AddAndRetrieve(self):
+        cache = SAMLAssertionCache()
+        assertion = self._createAssertion()
+        cache.addCredentials(self._makeKey(), [assertion])
+        
+        # Key is independent of the order of attribute names
+        key = SAMLAssertionCache.makeKey(
+                                    self.__class__.SUBJECT,
+                                    BaseTestCase.SITEA_SAML_ISSUER_NAME,
+                                    reversed(self.__class__.ATTRIBUTE_NAMES))
+        self.assert_(cache.retrieveCredentials(key) == [assertion])
+        self.assert_(cache.retrieveCredentials(self._makeKey('MySite')) is None)
+        self.assert_(cache.size > 0)
+    
+    def test02ExpiredEntries(self):
+        cache = SAMLAssertionCache()
+        expiredAssertion = self._createAssertion(
+                                timeNow=datetime.utcnow() - timedelta(hours=24))
+        self.assertRaises(CredentialWalletError, cache.addCredentials, 
+                          self._makeKey(), [expiredAssertion])
+        
+        cache.addCredentials(self._makeKey(), [expiredAssertion], 
+                             verifyCredentials=False)
+        cache.addCredentials(self._makeKey('MySite'), 
+                             [self._createAssertion(issuerName='MySite')])
+        self.assert_(len(cache) == 2)
+        
+        self.assert_(cache.retrieveCredentials(self._makeKey()) is None)
+        self.assert_(len(cache) == 1)
+        
+        cache.addCredentials(self._makeKey(), [expiredAssertion], 
+                             verifyCredentials=False)
+        cache.audit()
+        self.assert_(len(cache) == 1)
+        self.assert_(cache.retrieveCredentials(self._makeKey('MySite')))
+        
+    def test03LRUEviction(self):
+        cache = SAMLAssertionCache()
+        cache.maxEntries = 2
+        for issuer in ('a', 'b'):
+            cache.addCredentials(self._makeKey(issuer), 
+                                 [self._createAssertion(issuerName=issuer)])
         
+        # Make 'a' the most recently used so that 'b' is evicted
+        self.assert_(cache.retrieveCredentials(self._makeKey('a')))
+        cache.addCredentials(self._makeKey('c'), 
+                             [self._createAssertion(issuerName='c')])
+        
+        self.assert_(len(cache) == 2)
+        self.assert_(cache.retrieveCredentials(self._makeKey('b')) is None)
+        self.assert_(cache.retrieveCredentials(self._makeKey('a')))
+        self.assert_(cache.retrieveCredentials(self._makeKey('c')))
+        
+    def test04ExpiredEvictedFirst(self):
+        cache = SAMLAssertionCache()
+        cache.maxEntries = 2
+        cache.addCredentials(self._makeKey('a'), [self._createAssertion()])
+        cache.addCredentials(self._makeKey('b'), 
+                             [self._createAssertion(
+                                timeNow=datetime.utcnow()-timedelta(hours=24))],
+                             verifyCredentials=False)
+        cache.addCredentials(self._makeKey('c'), [self._createAssertion()])
+
+        self.assert_(cache.retrieveCredentials(self._makeKey('a')))
+        self.assert_(cache.retrieveCredentials(self._makeKey('c')))
+        
+    def test05MaxSize(self):
+        cache = SAMLAssertionCache()
+        cache.addCredentials(self._makeKey('a'), [self._createAssertion()])
+        entrySize = cache.size
+        
+        cache.maxSize = entrySize * 2 + entrySize // 2
+        for issuer in ('b', 'c'):
+            cache.addCredentials(self._makeKey(issuer), 
+                                 [self._createAssertion()])
+        self.assert_(len(cache) == 2)
+        self.assert_(cache.size <= cache.maxSize)
+        self.assert_(cache.retrieveCredentials(self._makeKey('a')) is None)
+        
+        # Entries larger than the cache are not held
+        cache.maxSize = entrySize // 2
+        self.assert_(len(cache) == 0)
+        cache.addCredentials(self._makeKey('a'), [self._createAssertion()])
+        self.assert_(len(cache) == 0)
+        
+    def test06CreateFromConfig(self):
+        cache = SAMLAssertionCache.fromConfig(
+                                self.__class__.CACHE_CONFIG_FILEPATH)
+        self.assert_(cache.clockSkewTolerance == timedelta(seconds=0.01))
+        self.assert_(cache.maxEntries == 100)
+        self.assert_(cache.maxSize == 1048576)
+    
+    def test07Pickle(self):
+        cache = SAMLAssertionCache()
+        cache.maxEntries = 10
+        cache.addCredentials(self._makeKey(), [self._createAssertion()])
+        
+        unpickledCache = pickle.loads(pickle.dumps(cache))
+        self.assert_(unpickledCache.maxEntries == 10)
+        self.assert_(unpickledCache.size == cache.size)
+        self.assert_(unpickledCache.retrieveCredentials(self._makeKey()))
+        
+    def test08Threads(self):
+        cache = SAMLAssertionCache()
+        cache.maxEntries = 5
+        assertion = self._createAssertion()
+        errors = []
+        
+        def worker(i):
+            try:
+                for j in range(50):
+                    key = self._makeKey(str((i + j) % 8))
+                    if cache.retrieveCredentials(key) is None:
+                        cache.addCredentials(key, [assertion])
+            except Exception, e:
+                errors.append(e)
+                
+        threads = [threading.Thread(target=worker, args=(i,)) 
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+            
+        self.assert_(not errors)
+        self.assert_(len(cache) <= 5)
+
+    def test09Generation(self):
+        cache = SAMLAssertionCache()
+        cache.addCredentials(self._makeKey(), [self._createAssertion()])
+        generation = cache.generation
+        self.assert_(cache.isDirty())
+        
+        cache.markClean()
+        self.assert_(cache.retrieveCredentials(self._makeKey()))
+        self.assert_(not cache.isDirty())
+        
+        cache.clear()
+        self.assert_(cache.generation > generation)
+
+
+class AttributeAuthorityFailureCacheTestCase(CredentialWalletBaseTestCase):
+    """Test negative result caching and circuit breaking for attribute 
+    authority lookups"""
+    FAILURE_CACHE_CONFIG_FILENAME = 'test_attributeauthorityfailurecache.cfg'
+    FAILURE_CACHE_CONFIG_FILEPATH = os.path.join(
+                                        CredentialWalletBaseTestCase.THIS_DIR, 
+                                        FAILURE_CACHE_CONFIG_FILENAME)
+    SUBJECT = 'https://esg.prototype.ucar.edu/myopenid/testUser'
+    ATTRIBUTE_AUTHORITY_URI = 'https://localhost:5443/AttributeAuthority'
+    
+    def test01NegativeEntries(self):
+        failureCache = AttributeAuthorityFailureCache()
+        failureCache.negativeTTL = 0.1
+        subject = self.__class__.SUBJECT
+        uri = self.__class__.ATTRIBUTE_AUTHORITY_URI
+        
+        failureCache.addNegative(subject, uri)
+        self.assert_(failureCache.isNegative(subject, uri))
+        self.assert_(not failureCache.isNegative('anotherUser', uri))
+        self.assert_(not failureCache.isNegative(subject, 'anotherURI'))
+        
+        sleep(0.2)
+        self.assert_(not failureCache.isNegative(subject, uri))
+        
+        failureCache.addNegative(subject, uri)
+        failureCache.removeNegative(subject, uri)
+        self.assert_(not failureCache.isNegative(subject, uri))
+        
+    def test02CircuitBreaker(self):
+        failureCache = AttributeAuthorityFailureCache()
+        failureCache.failureThreshold = 2
+        failureCache.errorTTL = 0.1
+        uri = self.__class__.ATTRIBUTE_AUTHORITY_URI
+        
+        failureCache.recordFailure(uri)
+        self.assert_(not failureCache.isCircuitOpen(uri))
+        
+        # A success resets the count of consecutive failures
+        failureCache.recordSuccess(uri)
+        failureCache.recordFailure(uri)
+        self.assert_(not failureCache.isCircuitOpen(uri))
+        failureCache.recordFailure(uri)
+        self.assert_(failureCache.isCircuitOpen(uri))
+        
+        # Once errorTTL has elapsed only one trial query is allowed
+        sleep(0.2)
+        self.assert_(not failureCache.isCircuitOpen(uri))
+        self.assert_(failureCache.isCircuitOpen(uri))
+        
+        # A failed trial reopens the circuit and a successful one closes it
+        failureCache.recordFailure(uri)
+        self.assert_(failureCache.isCircuitOpen(uri))
+        sleep(0.2)
+        self.assert_(not failureCache.isCircuitOpen(uri))
+        failureCache.recordSuccess(uri)
+        self.assert_(not failureCache.isCircuitOpen(uri))
+        self.assert_(not failureCache.isCircuitOpen(uri))
+        
+    def test03CreateFromConfig(self):
+        failureCache = AttributeAuthorityFailureCache.fromConfig(
+                            self.__class__.FAILURE_CACHE_CONFIG_FILEPATH)
+        self.assert_(failureCache.negativeTTL == 120.)
+        self.assert_(failureCache.errorTTL == 15.5)
+        self.assert_(failureCache.failureThreshold == 5)
+        
+        self.assertRaises(ValueError, setattr, failureCache, 'negativeTTL', 
+                          -1)
+        self.assertRaises(ValueError, setattr, failureCache, 
+                          'failureThreshold', 0)
+        
+
+class SAMLAssertionDigestCacheTestCase(CredentialWalletBaseTestCase):
+    """Test cache of digests of canonicalised assertions"""
+    ASSERTION_STR = SAMLAttributeWalletTestCase.ASSERTION_STR
+    _createAssertion = SAMLAttributeWalletTestCase.__dict__['_createAssertion']
+    
+    def setUp(self):
+        # Count canonicalizations made by the cache
+        self.nCanonicalizations = 0
+        
+        def countingCanonicalize(*arg, **kw):
+            self.nCanonicalizations += 1
+            return canonicalize(*arg, **kw)
+        
+        credentialwallet.canonicalize = countingCanonicalize
+        
+    def tearDown(self):
+        credentialwallet.canonicalize = canonicalize
+        
+    @unittest.skipIf(len(C14N_BACKENDS) == 0, 
+                     "No canonicalization backend is installed")
+    def test01GetDigest(self):
+        digestCache = SAMLAssertionDigestCache()
+        assertion = self._createAssertion()
+        canonicalXML = canonicalize(ESGFAssertionElementTree.toXML(assertion), 
+                                    exclusive=True)
+        expectedDigest = (hashlib.sha1(canonicalXML).digest(), 
+                          len(canonicalXML))
+        
+        for i in range(2):
+            self.assert_(digestCache.getDigest(assertion) == expectedDigest)
+            
+        self.assert_(self.nCanonicalizations == 1)
+        self.assert_(digestCache.checkDigest(assertion, expectedDigest[0]))
+        self.assert_(not digestCache.checkDigest(assertion, 'x'))
+        
+        # Changing settings clears the cache
+        digestCache.digestAlgorithm = 'sha256'
+        self.assert_(len(digestCache) == 0)
+        self.assert_(digestCache.getDigest(assertion)[0] == 
+                     hashlib.sha256(canonicalXML).digest())
+        
+    @unittest.skipIf(len(C14N_BACKENDS) == 0, 
+                     "No canonicalization backend is installed")
+    def test02ExpiredEntries(self):
+        digestCache = SAMLAssertionDigestCache()
+        expiredAssertion = self._createAssertion(
+                                timeNow=datetime.utcnow() - timedelta(hours=24))
+        for i in range(2):
+            digestCache.getDigest(expiredAssertion)
+            
+        self.assert_(self.nCanonicalizations == 2)
+        digestCache.audit()
+        self.assert_(len(digestCache) == 0)
+        
+    @unittest.skipIf(len(C14N_BACKENDS) == 0, 
+                     "No canonicalization backend is installed")
+    def test03LRUEviction(self):
+        digestCache = SAMLAssertionDigestCache()
+        digestCache.maxEntries = 2
+        assertions = dict([(issuer, self._createAssertion(issuerName=issuer))
+                           for issuer in ('a', 'b', 'c')])
+        digestCache.getDigest(assertions['a'])
+        digestCache.getDigest(assertions['b'])
+        
+        # Make 'a' the most recently used so that 'b' is evicted
+        digestCache.getDigest(assertions['a'])
+        digestCache.getDigest(assertions['c'])
+        self.assert_(len(digestCache) == 2)
+        self.assert_(self.nCanonicalizations == 3)
+        
+        digestCache.getDigest(assertions['a'])
+        self.assert_(self.nCanonicalizations == 3)
+        digestCache.getDigest(assertions['b'])
+        self.assert_(self.nCanonicalizations == 4)
+        
+    @unittest.skipIf(len(C14N_BACKENDS) == 0, 
+                     "No canonicalization backend is installed")
+    def test04WalletDigests(self):
+        wallet = SAMLAssertionWallet()
+        self.assert_(wallet.digestCache is 
+                     SAMLAssertionWallet.DEFAULT_DIGEST_CACHE)
+        wallet.digestCache = SAMLAssertionDigestCache()
+        
+        assertion = self._createAssertion()
+        key = BaseTestCase.SITEA_ATTRIBUTEAUTHORITY_URI
+        wallet.addCredentials(key, [assertion])
+        digests = wallet.getCredentialDigests(key)
+        self.assert_(digests == [wallet.digestCache.getDigest(assertion)])
+        self.assert_(self.nCanonicalizations == 1)
+        self.assert_(wallet.getCredentialDigests('unknown') is None)
+        
+        # The digest cache isn't pickled
+        unpickledWallet = pickle.loads(pickle.dumps(wallet))
+        self.assert_(unpickledWallet.digestCache is 
+                     SAMLAssertionWallet.DEFAULT_DIGEST_CACHE)
+        
+    def test05ParseConfig(self):
+        cfg = CaseSensitiveConfigParser()
+        cfg.readfp(StringIO("""[DEFAULT]
+digestCache.maxEntries = 10
+digestCache.digestAlgorithm = sha256
+digestCache.exclusive = False
+"""))
+        digestCache = SAMLAssertionDigestCache.fromConfig(cfg, 
+                                                    prefix='digestCache.')
+        self.assert_(digestCache.maxEntries == 10)
+        self.assert_(digestCache.digestAlgorithm == 'sha256')
+        self.assert_(digestCache.exclusive is False)
+        self.assertRaises(ValueError, setattr, digestCache, 
+                          'digestAlgorithm', 'unknown')
+        
+    def test06CheckDigestAlteredAssertion(self):
+        # Stand in for canonicalization so that no backend is needed
+        def stubCanonicalize(elem, sink=None, exclusive=False):
+            self.nCanonicalizations += 1
+            sink.write(ElementTree.tostring(elem))
+            
+        credentialwallet.canonicalize = stubCanonicalize
+        
+        digestCache = SAMLAssertionDigestCache()
+        assertion = self._createAssertion()
+        digest = digestCache.getDigest(assertion)[0]
+        self.assert_(digestCache.checkDigest(assertion, digest))
+        
+        # Same ID and issuer as the cached entry but altered content
+        alteredAssertion = self._createAssertion()
+        alteredAssertion.attributeStatements[0].attributes[0
+                                    ].attributeValues[0].value = 'Altered'
+        self.assert_(not digestCache.checkDigest(alteredAssertion, digest))
+        self.assert_(self.nCanonicalizations == 3)
+
+
+class SQLiteCredentialRepositoryTestCase(CredentialWalletBaseTestCase):
+    """Test SQLite based credential repository"""
+    DB_FILENAME = 'credentialrepository.db'
+    DB_FILEPATH = os.path.join(CredentialWalletBaseTestCase.THIS_DIR, 
+                               DB_FILENAME)
+    USER_ID = 'https://openid.localhost/philip.kershaw'
+    
+    ASSERTION_STR = SAMLAttributeWalletTestCase.ASSERTION_STR
+    _createAssertion = SAMLAttributeWalletTestCase.__dict__['_createAssertion']
+    
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            filePath = self.__class__.DB_FILEPATH + suffix
+            if os.path.exists(filePath):
+                os.remove(filePath)
+                
+    def test01AddAndRetrieve(self):
+        repository = SQLiteCredentialRepository()
+        assertion = self._createAssertion()
+        
+        # User must be registered first
+        self.assertRaises(CredentialRepositoryError,
+                          repository.addCredentials, 
+                          self.__class__.USER_ID, [('a', assertion)])
+        
+        repository.addUser(self.__class__.USER_ID)
+        self.assertRaises(CredentialRepositoryError, 
+                          repository.addUser, self.__class__.USER_ID)
+        
+        repository.addCredentials(self.__class__.USER_ID, 
+                                  [('a', assertion), 
+                                   ('b', self._createAssertion())])
+        credentialsMap = repository.retrieveCredentialsMap(
+                                                    self.__class__.USER_ID)
+        self.assert_(sorted(credentialsMap.keys()) == ['a', 'b'])
+        self.assert_(credentialsMap['a'][0].id == assertion.id)
+        self.assert_(credentialsMap['a'][0].conditions.notOnOrAfter ==
+                     assertion.conditions.notOnOrAfter)
+        self.assert_(
+            len(repository.retrieveCredentials(self.__class__.USER_ID)) == 2)
+        self.assert_(repository.retrieveCredentials('unknown') == [])
+        
+    def test02AuditCredentials(self):
+        repository = SQLiteCredentialRepository(
+                                            dbFilePath=self.__class__.DB_FILEPATH)
+        repository.addUser(self.__class__.USER_ID)
+        repository.addUser('otherUser')
+        expiredAssertion = self._createAssertion(
+                                timeNow=datetime.utcnow() - timedelta(hours=24))
+        for userId in (self.__class__.USER_ID, 'otherUser'):
+            repository.addCredentials(userId, 
+                                      [('a', self._createAssertion()),
+                                       ('b', expiredAssertion)])
+        
+        self.assert_(repository.auditCredentials(
+                                    userId=self.__class__.USER_ID) == 1)
+        self.assert_(repository.retrieveCredentialsMap(
+                                    self.__class__.USER_ID).keys() == ['a'])
+        self.assert_(
+            len(repository.retrieveCredentials('otherUser')) == 2)
+        
+        self.assert_(repository.auditCredentials() == 1)
+        self.assert_(len(repository.retrieveCredentials('otherUser')) == 1)
+        repository.close()
+        
+        # Credentials persist
+        repository = SQLiteCredentialRepository(
+                                            dbFilePath=self.__class__.DB_FILEPATH)
+        self.assert_(
+            len(repository.retrieveCredentials(self.__class__.USER_ID)) == 1)
+        repository.close()
+        
+    def test03UpdateFromWallet(self):
+        repository = SQLiteCredentialRepository()
+        wallet = SAMLAssertionWallet()
+        wallet.userId = self.__class__.USER_ID
+        wallet.credentialRepository = repository
+        
+        wallet.addCredentials('a', [self._createAssertion()])
+        wallet.addCredentials('b', [self._createAssertion(), 
+                                    self._createAssertion()])
+        wallet.updateCredentialRepository()
+        
+        credentialsMap = repository.retrieveCredentialsMap(
+                                                    self.__class__.USER_ID)
+        self.assert_(len(credentialsMap['a']) == 1)
+        self.assert_(len(credentialsMap['b']) == 1)
+        
+        # Replacing credentials in the wallet replaces those in the 
+        # repository
+        newAssertion = self._createAssertion()
+        newAssertion.id = 'new-assertion-id'
+        wallet.addCredentials('a', [newAssertion])
+        wallet.updateCredentialRepository()
+        
+        credentialsMap = repository.retrieveCredentialsMap(
+                                                    self.__class__.USER_ID)
+        self.assert_(len(credentialsMap['a']) == 1)
+        self.assert_(credentialsMap['a'][0].id == 'new-assertion-id')
+        
+        # Repository isn't pickled with the wallet
+        unpickledWallet = pickle.loads(pickle.dumps(wallet))
+        self.assert_(unpickledWallet.credentialRepository is None)
+
+    def test04RejectNonXMLFormats(self):
+        repository = SQLiteCredentialRepository(
+                                            dbFilePath=self.__class__.DB_FILEPATH)
+        repository.addUser(self.__class__.USER_ID)
+        
+        # Assertions are only stored as XML
+        self.assertRaises(CredentialRepositoryError,
+                          repository.addCredentials, 
+                          self.__class__.USER_ID, [('a', Assertion())])
+        
+        # Rows in any other format e.g. pickled data written to the database
+        # by another party are never loaded
+        connection = sqlite3.connect(self.__class__.DB_FILEPATH)
+        with connection:
+            connection.execute(
+                "INSERT INTO credentials (userId, credentialKey, assertionId,"
+                " notBefore, notOnOrAfter, format, assertion) VALUES "
+                "(?, 'b', 'id', NULL, NULL, 1, ?)", 
+                (self.__class__.USER_ID, 
+                 sqlite3.Binary(pickle.dumps(self._createAssertion()))))
+        connection.close()
+        
+        self.assertRaises(CredentialRepositoryError,
+                          repository.retrieveCredentialsMap, 
+                          self.__class__.USER_ID)
+        repository.close()
+
+
+class _BlockingCredentialRepository(SQLiteCredentialRepository):
+    """SQLite repository whose writes block until released by the test"""
+    def __init__(self, blockUserIds=None, **kw):
+        super(_BlockingCredentialRepository, self).__init__(**kw)
+        self.release = threading.Event()
+        self.blockUserIds = blockUserIds
+        self.writes = []
+        self.closed = False
+        
+    def auditCredentials(self, userId=None, **assertionValidKeys):
+        self.writes.append((userId, 'audit', 
+                            threading.currentThread().name))
+        super(_BlockingCredentialRepository, self).auditCredentials(
+                                        userId=userId, **assertionValidKeys)
+        
+    def close(self):
+        self.closed = True
+        super(_BlockingCredentialRepository, self).close()
+        
+    def replaceCredentials(self, userId, credentialsMap):
+        if self.blockUserIds is None or userId in self.blockUserIds:
+            self.release.wait()
+        self.writes.append((userId, sorted(credentialsMap.keys()),
+                            threading.currentThread().name))
+        super(_BlockingCredentialRepository, self).replaceCredentials(
+                                                    userId, credentialsMap)
+        
+
+class WriteBehindCredentialRepositoryTestCase(CredentialWalletBaseTestCase):
+    """Test asynchronous writes to a credential repository"""
+    ASSERTION_STR = SAMLAttributeWalletTestCase.ASSERTION_STR
+    _createAssertion = SAMLAttributeWalletTestCase.__dict__['_createAssertion']
+    
+    def test01WriteBehind(self):
+        repository = WriteBehindCredentialRepository(
+                            credentialRepository=SQLiteCredentialRepository())
+        wallet = SAMLAssertionWallet()
+        wallet.userId = 'user'
+        wallet.credentialRepository = repository
+        wallet.addCredentials('a', [self._createAssertion()])
+        wallet.updateCredentialRepository()
+        
+        # Reads wait for pending writes
+        self.assert_(repository.retrieveCredentialsMap('user').keys() == ['a'])
+        self.assert_(repository.numPending == 0)
+        repository.close()
+        self.assertRaises(CredentialRepositoryError, 
+                          repository.replaceCredentials, 'user', {})
+        
+    def test02Coalesce(self):
+        blockingRepository = _BlockingCredentialRepository()
+        repository = WriteBehindCredentialRepository(
+                                    credentialRepository=blockingRepository)
+        assertion = self._createAssertion()
+        
+        # First update is taken by the worker and blocks; the following ones
+        # for the same user are merged
+        repository.replaceCredentials('user', {'a': [assertion]})
+        self.assert_(not repository.flush(timeout=0.2))
+        repository.replaceCredentials('user', {'b': [assertion]})
+        repository.replaceCredentials('user', {'c': [assertion]})
+        
+        blockingRepository.release.set()
+        self.assert_(repository.flush(timeout=5))
+        self.assert_([write[:2] for write in blockingRepository.writes] == 
+                     [('user', ['a']), ('user', ['b', 'c'])])
+        repository.close()
+        
+    def test03QueueFull(self):
+        blockingRepository = _BlockingCredentialRepository()
+        repository = WriteBehindCredentialRepository(
+                                    credentialRepository=blockingRepository,
+                                    maxPending=1)
+        assertion = self._createAssertion()
+        repository.replaceCredentials('user1', {'a': [assertion]})
+        repository.flush(timeout=0.2)
+        repository.replaceCredentials('user2', {'a': [assertion]})
+        
+        self.assertRaises(CredentialRepositoryError,
+                          repository.replaceCredentials, 
+                          'user3', {'a': [assertion]})
+        
+        # Updates for users already queued are still accepted
+        repository.replaceCredentials('user2', {'b': [assertion]})
+        
+        blockingRepository.release.set()
+        repository.close(timeout=5)
+        self.assert_(len(blockingRepository.writes) == 2)
+        
+    def test04SyncFallback(self):
+        blockingRepository = _BlockingCredentialRepository(
+                                                    blockUserIds=('user1',))
+        repository = WriteBehindCredentialRepository(
+                                    credentialRepository=blockingRepository,
+                                    maxPending=1,
+                                    syncFallback='True')
+        assertion = self._createAssertion()
+        repository.replaceCredentials('user1', {'a': [assertion]})
+        repository.flush(timeout=0.2)
+        repository.replaceCredentials('user2', {'a': [assertion]})
+        
+        # Queue is full so user3's update is written in this thread
+        repository.replaceCredentials('user3', {'a': [assertion]})
+        self.assert_(blockingRepository.writes == 
+                     [('user3', ['a'], threading.currentThread().name)])
+        
+        blockingRepository.release.set()        
+        repository.close(timeout=5)
+        self.assert_(len(blockingRepository.writes) == 3)
+        
+    def test05CloseTimeout(self):
+        blockingRepository = _BlockingCredentialRepository()
+        repository = WriteBehindCredentialRepository(
+                                    credentialRepository=blockingRepository)
+        assertion = self._createAssertion()
+        repository.replaceCredentials('user1', {'a': [assertion]})
+        repository.replaceCredentials('user2', {'a': [assertion]})
+        
+        # The wrapped repository is left open while the worker is writing
+        self.assertRaises(CredentialRepositoryError, repository.close, 
+                          timeout=0.2)
+        self.assert_(not blockingRepository.closed)
+        self.assertRaises(CredentialRepositoryError,
+                          repository.replaceCredentials, 
+                          'user3', {'a': [assertion]})
+        
+        # Pending updates are still written and a further call closes it
+        blockingRepository.release.set()
+        repository.close(timeout=5)
+        self.assert_(blockingRepository.closed)
+        self.assert_([write[:2] for write in blockingRepository.writes] == 
+                     [('user1', ['a']), ('user2', ['a'])])
+        repository.close()
+        
+    def test06AuditOrder(self):
+        blockingRepository = _BlockingCredentialRepository(
+                                                    blockUserIds=('user1',))
+        repository = WriteBehindCredentialRepository(
+                                    credentialRepository=blockingRepository)
+        assertion = self._createAssertion()
+        
+        # Hold up the worker so that the following updates are merged
+        repository.replaceCredentials('user1', {'a': [assertion]})
+        self.assert_(not repository.flush(timeout=0.2))
+        
+        # An audit queued before a replacement is carried out before it
+        repository.auditCredentials('user2')
+        repository.replaceCredentials('user2', {'a': [assertion]})
+        
+        # ... and one queued after a replacement is carried out after it
+        repository.replaceCredentials('user3', {'a': [assertion]})
+        repository.auditCredentials('user3')
+        
+        blockingRepository.release.set()
+        repository.close(timeout=5)
+        self.assert_([write[:2] for write in blockingRepository.writes] == 
+                     [('user1', ['a']), 
+                      ('user2', 'audit'), ('user2', ['a']), 
+                      ('user3', ['a']), ('user3', 'audit')])
+
 
 class SAMLAuthzDecisionWalletTestCase(CredentialWalletBaseTestCase):
     """Test wallet for caching Authorisation Decision statements"""
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+"""Unit tests for ElementTree utilities
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "17/10/26"
+__copyright__ = "(C) 2009 Science and Technology Facilities Council"
+__license__ = "BSD - see LICENSE file in top-level directory"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import unittest
+import os
+from cStringIO import StringIO
+from xml.etree import ElementTree as PyElementTree
+try:
+    from lxml import etree as lxmlElementTree
+except ImportError:
+    lxmlElementTree = None
+
+from ndg.security.common.config import importElementTree
+ElementTree = importElementTree()
+
+from ndg.security.common.utils.etree import (prettyPrint, iterPrettyPrint,
+                                             writePrettyPrint,
+                                             registerNamespace,
+                                             canonicalize, C14N_BACKENDS,
+                                             _getDefaultC14NBackend)
+from ndg.security.common.saml_utils.esgf.xml.etree import \
+    ESGFResponseElementTree
+from ndg.security.common.test.unit.base import BaseTestCase
+from ndg.security.common.test.unit.saml_utils.test_esgf_etree import \
+    ESGFResponseTestCaseBase
+
+
+class PrettyPrintTestCase(BaseTestCase):
+    """Test lightweight pretty printing of ElementTree elements"""
+    NS_A = 'urn:ndg:security:test:a'
+    NS_B = 'urn:ndg:security:test:b'
+    NS_C = 'urn:ndg:security:test:c'
+    
+    EXPECTED_OUTPUT = """\
+<a:root xmlns:a="urn:ndg:security:test:a" xmlns:b="urn:ndg:security:test:b" \
+b:attr="x">text
+    <b:child xmlns:c="urn:ndg:security:test:c" c:q="1">
+        <c:grandChild>value</c:grandChild>
+    </b:child>
+    <c:child xmlns:c="urn:ndg:security:test:c">
+        <b:leaf></b:leaf>
+        <a:leaf></a:leaf>
+    </c:child>
+</a:root>"""
+
+    def setUp(self):
+        cls = self.__class__
+        for nsURI, nsPrefix in ((cls.NS_A, 'a'), (cls.NS_B, 'b'), 
+                                (cls.NS_C, 'c')):
+            registerNamespace(nsURI, nsPrefix)
+        
+    def _createTree(self):
+        # Parse so that prefixes are the same whichever ElementTree 
+        # implementation is in use.  Namespace c is out of scope following 
+        # the first child so it's declared again
+        cls = self.__class__
+        return ElementTree.fromstring(
+            '<a:root xmlns:a="%s" xmlns:b="%s" b:attr="x"> text '
+            '<b:child xmlns:c="%s" c:q="1"><c:grandChild>value</c:grandChild>'
+            '</b:child>'
+            '<c:child xmlns:c="%s"><b:leaf/><a:leaf/></c:child>'
+            '</a:root>' % (cls.NS_A, cls.NS_B, cls.NS_C, cls.NS_C))
+        
+    def test01PrettyPrint(self):
+        self.assert_(prettyPrint(self._createTree()) == 
+                     self.__class__.EXPECTED_OUTPUT)
+        
+    def test02Sinks(self):
+        tree = self._createTree()
+        expectedOutput = self.__class__.EXPECTED_OUTPUT
+        
+        self.assert_(''.join(iterPrettyPrint(tree)) == expectedOutput)
+        
+        stream = StringIO()
+        writePrettyPrint(tree, stream)
+        self.assert_(stream.getvalue() == expectedOutput)
+        
+        fragments = []
+        writePrettyPrint(tree, fragments)
+        self.assert_(len(fragments) > 1)
+        self.assert_(''.join(fragments) == expectedOutput)
+        
+    def test03DeepTree(self):
+        # Deeper than the recursion limit
+        nsA = self.__class__.NS_A
+        root = ElementTree.Element('{%s}elem' % nsA)
+        elem = root
+        for i in range(5000):
+            elem = ElementTree.SubElement(elem, '{%s}elem' % nsA)
+            
+        lines = prettyPrint(root, space=' ').split('\n')
+        self.assert_(len(lines) == 5001 * 2 - 1)
+        innermost = lines[5000]
+        self.assert_(innermost.startswith(' ' * 5000 + '<'))
+        self.assert_(innermost.endswith(':elem>'))
+        self.assert_(not innermost.startswith(' ' * 5001))
+        self.assert_(lines[-1].startswith('</'))
+
+
+
+class CanonicalizeTestCase(ESGFResponseTestCaseBase):
+    """Differential tests for the canonicalization backends: each available
+    backend must produce the expected output byte for byte.  The expected
+    output for the SAML response fixture is held in files so that backends 
+    are checked against it even when only one is installed.  Tests are
+    skipped for backends which aren't installed.  Set the environment
+    variable NDGSEC_C14N_BACKENDS to a comma separated list of backend names
+    e.g. "lxml,ElementC14N" to fail instead if any of them is missing"""
+    REQUIRED_BACKENDS_ENVVARNAME = 'NDGSEC_C14N_BACKENDS'
+    THIS_DIR = os.path.dirname(__file__)
+    RESPONSE_FILEPATH = os.path.join(THIS_DIR, 'test_etree_response.xml')
+    RESPONSE_C14N_FILEPATH = os.path.join(THIS_DIR, 
+                                          'test_etree_response_c14n.xml')
+    RESPONSE_EXC_C14N_FILEPATH = os.path.join(THIS_DIR, 
+                                          'test_etree_response_exc_c14n.xml')
+    NS_A = PrettyPrintTestCase.NS_A
+    NS_B = PrettyPrintTestCase.NS_B
+    
+    # Namespaces are all declared on the root element and used so that
+    # serialisation by any ElementTree implementation gives the same scope
+    XML = (
+        '<a:root xmlns:a="%s" xmlns:b="%s" z="1" b:y="2" a:x="3">'
+        '<b:child  attr=\'v"\'><a:leaf/>text &amp; more</b:child>'
+        '<!-- comment -->'
+        '</a:root>' % (NS_A, NS_B)
+    )
+    CANONICAL_XML = (
+        '<a:root xmlns:a="%s" xmlns:b="%s" z="1" a:x="3" b:y="2">'
+        '<b:child attr="v&quot;"><a:leaf></a:leaf>text &amp; more</b:child>'
+        '</a:root>' % (NS_A, NS_B)
+    )
+    EXCLUSIVE_CANONICAL_CHILD_XML = (
+        '<b:child xmlns:b="%s" attr="v&quot;">'
+        '<a:leaf xmlns:a="%s"></a:leaf>text &amp; more</b:child>' % 
+        (NS_B, NS_A)
+    )
+    EXCLUSIVE_CANONICAL_CHILD_INCLUSIVE_NS_XML = (
+        '<b:child xmlns:a="%s" xmlns:b="%s" attr="v&quot;">'
+        '<a:leaf></a:leaf>text &amp; more</b:child>' % (NS_A, NS_B)
+    )
+    
+    def setUp(self):
+        registerNamespace(self.__class__.NS_A, 'a')
+        registerNamespace(self.__class__.NS_B, 'b')
+        
+    def _canonicalizeWithBackends(self, elem, **kw):
+        return [(backend, canonicalize(elem, backend=backend, **kw)) 
+                for backend, _ in C14N_BACKENDS]
+    
+    @unittest.skipIf(len(C14N_BACKENDS) == 0, 
+                     "No canonicalization backend is installed")
+    def test01Canonicalize(self):
+        cls = self.__class__
+        elem = ElementTree.fromstring(cls.XML)
+        for backend, xml in self._canonicalizeWithBackends(elem):
+            self.assert_(xml == cls.CANONICAL_XML, backend)
+            
+        for backend, xml in self._canonicalizeWithBackends(elem, 
+                                                           exclusive=True):
+            self.assert_(xml == cls.CANONICAL_XML, backend)
+            
+    @unittest.skipIf(len(C14N_BACKENDS) == 0, 
+                     "No canonicalization backend is installed")
+    def test02ExclusiveCanonicalize(self):
+        cls = self.__class__
+        child = ElementTree.fromstring(cls.XML)[0]
+        for backend, xml in self._canonicalizeWithBackends(child, 
+                                                           exclusive=True):
+            self.assert_(xml == cls.EXCLUSIVE_CANONICAL_CHILD_XML, backend)
+            
+        for backend, xml in self._canonicalizeWithBackends(child, 
+                                                exclusive=True,
+                                                inclusiveNamespaces=['a']):
+            self.assert_(xml == cls.EXCLUSIVE_CANONICAL_CHILD_INCLUSIVE_NS_XML,
+                         backend)
+            
+    @unittest.skipIf(len(C14N_BACKENDS) == 0, 
+                     "No canonicalization backend is installed")
+    def test03Sink(self):
+        elem = ElementTree.fromstring(self.__class__.XML)
+        for backend, _ in C14N_BACKENDS:
+            sink = StringIO()
+            self.assert_(canonicalize(elem, sink=sink, backend=backend) is 
+                         None)
+            self.assert_(sink.getvalue() == self.__class__.CANONICAL_XML)
+            
+    @unittest.skipIf(len(C14N_BACKENDS) < 2, 
+                     "Fewer than two canonicalization backends are installed")
+    def test04BackendsAgree(self):
+        elem = ESGFResponseElementTree.toXML(
+                                    self._createResponse(numAssertions=2))
+        for kw in {}, {'exclusive': True}:
+            outputs = self._canonicalizeWithBackends(elem, **kw)
+            for backend, xml in outputs[1:]:
+                self.assert_(xml == outputs[0][1], 
+                             "%s and %s output differs" % (outputs[0][0], 
+                                                           backend))
+                
+    def test05UnknownBackend(self):
+        self.assertRaises(NotImplementedError, canonicalize, 
+                          ElementTree.fromstring(self.__class__.XML), 
+                          backend='unknown')
+        
+    @unittest.skipIf('lxml' not in dict(C14N_BACKENDS), 
+                     "lxml is not installed")
+    def test06UnsupportedKeyword(self):
+        self.assertRaises(NotImplementedError, canonicalize, 
+                          ElementTree.fromstring(self.__class__.XML), 
+                          backend='lxml', 
+                          with_comments=True)
+        
+    def test07RequiredBackends(self):
+        requiredBackends = os.environ.get(
+                        self.__class__.REQUIRED_BACKENDS_ENVVARNAME, '')
+        for backend in requiredBackends.split(','):
+            backend = backend.strip()
+            if backend:
+                self.assert_(backend in dict(C14N_BACKENDS), 
+                             "Canonicalization backend %r is not installed" %
+                             backend)
+                
+    @unittest.skipIf(len(C14N_BACKENDS) == 0, 
+                     "No canonicalization backend is installed")
+    def test08ResponseFixture(self):
+        cls = self.__class__
+        elem = ElementTree.parse(cls.RESPONSE_FILEPATH).getroot()
+        for filePath, kw in ((cls.RESPONSE_C14N_FILEPATH, {}), 
+                             (cls.RESPONSE_EXC_C14N_FILEPATH, 
+                              {'exclusive': True})):
+            expectedXml = open(filePath, 'rb').read()
+            for backend, xml in self._canonicalizeWithBackends(elem, **kw):
+                self.assert_(xml == expectedXml, 
+                             "%s output differs from %s" % (backend, 
+                                                            filePath))
+                
+    @unittest.skipIf(len(C14N_BACKENDS) == 0, 
+                     "No canonicalization backend is installed")
+    def test09DefaultBackend(self):
+        backends = dict(C14N_BACKENDS)
+        
+        # lxml would have to re-parse standard library elements.  Their
+        # prefixes are set from the Standard Library namespace map
+        PyElementTree.register_namespace('a', self.__class__.NS_A)
+        PyElementTree.register_namespace('b', self.__class__.NS_B)
+        elem = PyElementTree.fromstring(self.__class__.XML)
+        if 'ElementC14N' in backends:
+            self.assert_(_getDefaultC14NBackend(elem) == 'ElementC14N')
+        else:
+            self.assert_(_getDefaultC14NBackend(elem) == 'lxml')
+        self.assert_(canonicalize(elem) == self.__class__.CANONICAL_XML)
+            
+        if 'lxml' in backends:
+            elem = lxmlElementTree.fromstring(self.__class__.XML)
+            self.assert_(_getDefaultC14NBackend(elem) == 'lxml')
+            self.assert_(canonicalize(elem) == self.__class__.CANONICAL_XML)
+        
+        
+if __name__ == "__main__":
+    unittest.main()
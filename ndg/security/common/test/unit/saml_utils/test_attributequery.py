@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+"""Unit tests for the concurrent attribute query client
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "17/10/26"
+__copyright__ = "(C) 2009 Science and Technology Facilities Council"
+__license__ = "BSD - see LICENSE file in top-level directory"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import unittest
+import os
+import threading
+from time import sleep, time
+from datetime import timedelta
+from cStringIO import StringIO
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from ndg.saml.saml2.core import StatusCode
+from ndg.saml.xml.etree import AttributeQueryElementTree
+
+from ndg.security.common.config import importElementTree
+ElementTree = importElementTree()
+
+from ndg.security.common.credentialwallet import (SAMLAssertionWallet,
+                                            AttributeAuthorityFailureCache,
+                                            CredentialWalletError)
+from ndg.security.common.utils.connectionpool import HTTPConnectionPool
+from ndg.security.common.saml_utils.esgf.xml.etree import \
+    ESGFResponseElementTree
+from ndg.security.common.saml_utils.attributequery import (
+                                            AttributeAuthorityMapping,
+                                            AttributeQueryFanOutClient,
+                                            AttributeQueryTimeoutError,
+                                            AttributeAuthorityUnavailableError,
+                                            AttributeQueryNegativeResultError)
+from ndg.security.common.test.unit.saml_utils.test_esgf_etree import \
+    ESGFResponseTestCaseBase
+
+
+class _StubAttributeAuthorityHandler(BaseHTTPRequestHandler):
+    """Respond to SOAP attribute queries with a response containing a single
+    assertion after the server's delay"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        request = self.rfile.read(int(self.headers['Content-length']))
+        self.server.requests.append(request)
+        queryElem = ElementTree.fromstring(request)[-1][0]
+        query = AttributeQueryElementTree.fromXML(queryElem)
+        self.server.queries.append(query)
+
+        sleep(self.server.delay)
+
+        response = self.server.createResponse(
+                                    numAssertions=self.server.numAssertions)
+        response.inResponseTo = query.id
+        response.status.statusCode.value = self.server.statusCode
+        responseXML = (ESGFResponseTestCaseBase.SOAP_ENVELOPE_TMPL %
+                       ElementTree.tostring(
+                            self.server.serialise(response)))
+
+        self.send_response(200)
+        self.send_header('Content-type', 'text/xml')
+        self.send_header('Content-length', str(len(responseXML)))
+        self.end_headers()
+        self.wfile.write(responseXML)
+
+    def log_message(self, *arg):
+        pass
+
+
+class _StubAttributeAuthority(ThreadingMixIn, HTTPServer):
+    """Local stand in for an attribute authority"""
+    daemon_threads = True
+
+    def __init__(self, createResponse, serialise, delay=0.):
+        HTTPServer.__init__(self, ('127.0.0.1', 0),
+                            _StubAttributeAuthorityHandler)
+        self.createResponse = createResponse
+        self.serialise = serialise
+        self.delay = delay
+        self.numAssertions = 1
+        self.statusCode = StatusCode.SUCCESS_URI
+        self.queries = []
+        self.requests = []
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def uri(self):
+        return 'http://127.0.0.1:%d/AttributeAuthority' % self.server_port
+
+    def handle_error(self, request, clientAddress):
+        # Clients time out waiting for slow responses
+        pass
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class AttributeQueryFanOutClientTestCase(ESGFResponseTestCaseBase):
+    """Test concurrent querying of attribute authorities"""
+    THIS_DIR = os.path.dirname(__file__)
+    PIP_MAPPING_FILEPATH = os.path.join(THIS_DIR, '..', '..', 'config',
+                                        'authorisationservice',
+                                        'pip-mapping.txt')
+    ATTRIBUTE_IDS = ('urn:siteA:security:authz:1.0:attr',
+                     'urn:esg:sitea:grouprole',
+                     'urn:siteB:security:authz:1.0:attr')
+
+    def setUp(self):
+        self.authorities = [
+            _StubAttributeAuthority(self._createResponse,
+                                    ESGFResponseElementTree.toXML,
+                                    delay=delay)
+            for delay in (0., 0.5, 3.)
+        ]
+
+    def tearDown(self):
+        for authority in self.authorities:
+            authority.stop()
+
+    def _createMapping(self):
+        siteA, siteB, slowSite = [authority.uri
+                                  for authority in self.authorities]
+        attrA, groupRole, attrB = self.__class__.ATTRIBUTE_IDS
+        mapping = AttributeAuthorityMapping()
+        mapping.parse(StringIO("""
+# Comment
+%s %s
+%s %s
+%s %s
+%s %s
+""" % (attrA, siteA, groupRole, siteA, attrB, siteB, attrB, slowSite)))
+        return mapping
+
+    def _createExpiredResponse(self, numAssertions=2):
+        response = self._createResponse(numAssertions=numAssertions)
+        for assertion in response.assertions:
+            assertion.conditions.notBefore -= timedelta(hours=9)
+            assertion.conditions.notOnOrAfter -= timedelta(hours=9)
+
+        return response
+
+    def test01ParseMappingFile(self):
+        mapping = AttributeAuthorityMapping.fromFile(
+                                    self.__class__.PIP_MAPPING_FILEPATH)
+        self.assert_(len(mapping) == 4)
+        self.assert_(mapping.getAttributeAuthorities(
+                                    'urn:esg:sitea:grouprole') ==
+                     ['https://localhost:5443/AttributeAuthority'])
+
+        attributeIdsByAuthority = mapping.groupByAuthority(
+                    ['urn:siteA:security:authz:1.0:attr',
+                     'urn:esg:sitea:grouprole', 'myattributeid', 'unknown'])
+        self.assert_(attributeIdsByAuthority.items() == [
+                ('https://localhost:5443/AttributeAuthority',
+                 ['urn:siteA:security:authz:1.0:attr',
+                  'urn:esg:sitea:grouprole']),
+                ('https://myattributeauthority.ac.uk/', ['myattributeid'])])
+
+        self.assertRaises(ValueError, mapping.parse, ['attrid'])
+
+    def test02QueryConcurrently(self):
+        siteA, siteB, slowSite = self.authorities
+        client = AttributeQueryFanOutClient(self._createMapping(),
+                                            self.__class__.ISSUER_NAME,
+                                            timeout=5.)
+        client.setTimeout(slowSite.uri, 1.)
+        wallet = SAMLAssertionWallet()
+
+        start = time()
+        results = client.query(self.__class__.SUBJECT,
+                               self.__class__.ATTRIBUTE_IDS,
+                               wallet=wallet)
+        elapsed = time() - start
+
+        # Bounded by the slow authority's timeout rather than the sum of the
+        # delays
+        self.assert_(elapsed < 2., elapsed)
+        self.assert_(results.keys() == [siteA.uri, siteB.uri, slowSite.uri])
+
+        # Each authority is sent a single query for the attributes it holds
+        self.assert_([attribute.name for attribute in
+                      siteA.queries[0].attributes] ==
+                     list(self.__class__.ATTRIBUTE_IDS[:2]))
+        self.assert_(siteA.queries[0].subject.nameID.value ==
+                     self.__class__.SUBJECT)
+
+        for authority in siteA, siteB:
+            response = results[authority.uri]
+            self.assert_(response.status.statusCode.value ==
+                         StatusCode.SUCCESS_URI)
+            self.assert_(response.inResponseTo == authority.queries[0].id)
+            self.assert_(wallet.retrieveCredentials(authority.uri) ==
+                         response.assertions)
+
+        self.assert_(isinstance(results[slowSite.uri],
+                                AttributeQueryTimeoutError))
+        self.assert_(wallet.retrieveCredentials(slowSite.uri) is None)
+        self.assert_(wallet.hasGroupRole('siteagroup2', 'admin'))
+
+    def test03ConnectionError(self):
+        mapping = AttributeAuthorityMapping()
+        mapping.add('urn:siteA:security:authz:1.0:attr',
+                    self.authorities[0].uri)
+
+        # Nothing listening
+        self.authorities[1].stop()
+        self.authorities.pop(1)
+        closedURI = 'http://127.0.0.1:1/AttributeAuthority'
+        mapping.add('urn:siteA:security:authz:1.0:attr', closedURI)
+
+        client = AttributeQueryFanOutClient(mapping,
+                                            self.__class__.ISSUER_NAME,
+                                            timeout=5.)
+        wallet = SAMLAssertionWallet()
+        results = client.query(self.__class__.SUBJECT,
+                               ['urn:siteA:security:authz:1.0:attr'],
+                               wallet=wallet)
+        self.assert_(isinstance(results[closedURI], Exception))
+        self.assert_(wallet.retrieveCredentials(self.authorities[0].uri))
+
+        self.assert_(len(client.query(self.__class__.SUBJECT,
+                                      ['unknown'])) == 0)
+
+    def test04ConnectionPool(self):
+        mapping = AttributeAuthorityMapping()
+        mapping.add('urn:siteA:security:authz:1.0:attr',
+                    self.authorities[0].uri)
+        connectionPool = HTTPConnectionPool()
+        client = AttributeQueryFanOutClient(mapping,
+                                            self.__class__.ISSUER_NAME,
+                                            timeout=5.,
+                                            connectionPool=connectionPool)
+        for i in range(2):
+            wallet = SAMLAssertionWallet()
+            results = client.query(self.__class__.SUBJECT,
+                                   ['urn:siteA:security:authz:1.0:attr'],
+                                   wallet=wallet)
+            self.assert_(wallet.retrieveCredentials(self.authorities[0].uri)
+                         == results[self.authorities[0].uri].assertions)
+
+        self.assert_(connectionPool.nCreated == 1)
+        self.assert_(connectionPool.nReused == 1)
+
+    def test05FailureCache(self):
+        # Authority with no attributes for the subject
+        unknownSubjectSite = self.authorities[0]
+        unknownSubjectSite.numAssertions = 0
+        closedURI = 'http://127.0.0.1:1/AttributeAuthority'
+        mapping = AttributeAuthorityMapping()
+        mapping.add('urn:siteA:security:authz:1.0:attr',
+                    unknownSubjectSite.uri)
+        mapping.add('urn:siteA:security:authz:1.0:attr', closedURI)
+
+        failureCache = AttributeAuthorityFailureCache()
+        failureCache.failureThreshold = 1
+        client = AttributeQueryFanOutClient(mapping,
+                                            self.__class__.ISSUER_NAME,
+                                            timeout=5.,
+                                            failureCache=failureCache)
+        results = client.query(self.__class__.SUBJECT,
+                               ['urn:siteA:security:authz:1.0:attr'])
+        self.assert_(len(results[unknownSubjectSite.uri].assertions) == 0)
+        self.assert_(isinstance(results[closedURI], Exception))
+        self.assert_(not isinstance(results[closedURI],
+                                    AttributeAuthorityUnavailableError))
+
+        # Neither authority is queried again
+        results = client.query(self.__class__.SUBJECT,
+                               ['urn:siteA:security:authz:1.0:attr'])
+        self.assert_(isinstance(results[unknownSubjectSite.uri],
+                                AttributeQueryNegativeResultError))
+        self.assert_(isinstance(results[closedURI],
+                                AttributeAuthorityUnavailableError))
+        self.assert_(len(unknownSubjectSite.queries) == 1)
+
+        # Negative results are per subject
+        results = client.query('https://openid.localhost/another.user',
+                               ['urn:siteA:security:authz:1.0:attr'])
+        self.assert_(len(unknownSubjectSite.queries) == 2)
+
+    def test06ExpiredAssertions(self):
+        siteA = self.authorities[0]
+        expiredSite = self.authorities[1]
+        expiredSite.createResponse = self._createExpiredResponse
+        mapping = AttributeAuthorityMapping()
+        mapping.add('urn:siteA:security:authz:1.0:attr', siteA.uri)
+        mapping.add('urn:siteA:security:authz:1.0:attr', expiredSite.uri)
+
+        failureCache = AttributeAuthorityFailureCache()
+        failureCache.failureThreshold = 1
+        client = AttributeQueryFanOutClient(mapping,
+                                            self.__class__.ISSUER_NAME,
+                                            timeout=5.,
+                                            failureCache=failureCache)
+        wallet = SAMLAssertionWallet()
+        results = client.query(self.__class__.SUBJECT,
+                               ['urn:siteA:security:authz:1.0:attr'],
+                               wallet=wallet)
+
+        # Assertions rejected by the wallet don't affect other authorities
+        self.assert_(isinstance(results[expiredSite.uri],
+                                CredentialWalletError))
+        self.assert_(wallet.retrieveCredentials(expiredSite.uri) is None)
+        self.assert_(wallet.retrieveCredentials(siteA.uri) ==
+                     results[siteA.uri].assertions)
+        self.assert_(failureCache.isCircuitOpen(expiredSite.uri))
+        self.assert_(not failureCache.isCircuitOpen(siteA.uri))
+
+    def test07FailureStatus(self):
+        unknownPrincipalSite, failingSite = self.authorities[:2]
+        unknownPrincipalSite.numAssertions = 0
+        unknownPrincipalSite.statusCode = StatusCode.UNKNOWN_PRINCIPAL_URI
+        failingSite.numAssertions = 0
+        failingSite.statusCode = StatusCode.RESPONDER_URI
+        mapping = AttributeAuthorityMapping()
+        mapping.add('urn:siteA:security:authz:1.0:attr',
+                    unknownPrincipalSite.uri)
+        mapping.add('urn:siteA:security:authz:1.0:attr', failingSite.uri)
+
+        failureCache = AttributeAuthorityFailureCache()
+        failureCache.failureThreshold = 2
+        client = AttributeQueryFanOutClient(mapping,
+                                            self.__class__.ISSUER_NAME,
+                                            timeout=5.,
+                                            failureCache=failureCache)
+        client.query(self.__class__.SUBJECT,
+                     ['urn:siteA:security:authz:1.0:attr'])
+
+        # An unknown principal is a negative result for the subject but an
+        # error status is a failure of the authority
+        self.assert_(failureCache.isNegative(self.__class__.SUBJECT,
+                                             unknownPrincipalSite.uri))
+        self.assert_(not failureCache.isNegative(self.__class__.SUBJECT,
+                                                 failingSite.uri))
+
+        results = client.query(self.__class__.SUBJECT,
+                               ['urn:siteA:security:authz:1.0:attr'])
+        self.assert_(isinstance(results[unknownPrincipalSite.uri],
+                                AttributeQueryNegativeResultError))
+        self.assert_(results[failingSite.uri].status.statusCode.value ==
+                     StatusCode.RESPONDER_URI)
+        self.assert_(failureCache.isCircuitOpen(failingSite.uri))
+        self.assert_(not failureCache.isCircuitOpen(unknownPrincipalSite.uri))
+        self.assert_(len(failingSite.queries) == 2)
+
+    def test08QuerySerialisedFromTemplate(self):
+        site = self.authorities[0]
+        mapping = AttributeAuthorityMapping()
+        mapping.add('urn:siteA:security:authz:1.0:attr', site.uri)
+        client = AttributeQueryFanOutClient(mapping,
+                                            self.__class__.ISSUER_NAME,
+                                            timeout=5.)
+        results = client.query(self.__class__.SUBJECT,
+                               ['urn:siteA:security:authz:1.0:attr'])
+        self.assert_(results[site.uri].inResponseTo == site.queries[0].id)
+
+        # The SOAP body holds the query exactly as serialised by the
+        # template
+        query = site.queries[0]
+        template = client._getTemplate(['urn:siteA:security:authz:1.0:attr'])
+        queryXML = template.serialise(self.__class__.SUBJECT,
+                                      queryId=query.id,
+                                      issueInstant=query.issueInstant)
+        self.assert_(queryXML in site.requests[0], site.requests[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,541 @@
+#!/usr/bin/env python
+"""Unit tests for ESGF SAML ElementTree representations
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "17/10/26"
+__copyright__ = "(C) 2009 Science and Technology Facilities Council"
+__license__ = "BSD - see LICENSE file in top-level directory"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import unittest
+from uuid import uuid4
+from datetime import datetime, timedelta
+from cStringIO import StringIO
+import cPickle as pickle
+
+from ndg.saml.common import SAMLVersion
+from ndg.saml.common.xml import SAMLConstants
+from ndg.saml.saml2.core import (Response, Assertion, Attribute,
+                                 AttributeStatement, Issuer, Subject, NameID,
+                                 Conditions, Status, StatusCode,
+                                 StatusMessage, XSStringAttributeValue)
+from ndg.saml.xml import XMLTypeParseError
+from ndg.saml.xml.etree import AttributeQueryElementTree
+
+from ndg.security.common.config import Config, importElementTree
+ElementTree = importElementTree()
+
+from ndg.security.common.test.unit.base import BaseTestCase
+from ndg.security.common.utils.etree import (prettyPrint, 
+                                             registerNamespace)
+from ndg.security.common.saml_utils.esgf import (
+                                        ESGFSamlNamespaces,
+                                        ESGFDefaultQueryAttributes,
+                                        ESGFGroupRoleAttributeValueBase,
+                                        ESGFGroupRoleAttributeValue,
+                                        ESGFInternedGroupRoleAttributeValue)
+from ndg.security.common.saml_utils.esgf.xml.etree import (
+                                ESGFResponseElementTree,
+                                ESGFGroupRoleAttributeValueElementTree,
+                                AttributeValueElementTreeRegistry,
+                                attributeValueElementTreeRegistry)
+from ndg.security.common.saml_utils.esgf.xml.template import (
+                                        ESGFResponseTemplateSerialiser,
+                                        ESGFAttributeQueryTemplate)
+
+
+class ESGFResponseTestCaseBase(BaseTestCase):
+    """Base class for ESGF Attribute Query Response tests"""
+    SUBJECT = 'https://esg.prototype.ucar.edu/myopenid/testUser'
+    ISSUER_NAME = '/O=Site A/CN=Attribute Authority'
+    GROUP_ROLES = (('siteagroup', 'default'), ('siteagroup2', 'admin'))
+    SOAP_ENVELOPE_TMPL = (
+        '<SOAP-ENV:Envelope '
+        'xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">'
+        '<SOAP-ENV:Body>%s</SOAP-ENV:Body></SOAP-ENV:Envelope>')
+
+    def _createAssertion(self, utcNow):
+        assertion = Assertion()
+        assertion.version = SAMLVersion(SAMLVersion.VERSION_20)
+        assertion.id = str(uuid4())
+        assertion.issueInstant = utcNow
+
+        assertion.issuer = Issuer()
+        assertion.issuer.format = Issuer.X509_SUBJECT
+        assertion.issuer.value = self.__class__.ISSUER_NAME
+
+        assertion.subject = Subject()
+        assertion.subject.nameID = NameID()
+        assertion.subject.nameID.format = ESGFSamlNamespaces.NAMEID_FORMAT
+        assertion.subject.nameID.value = self.__class__.SUBJECT
+
+        assertion.conditions = Conditions()
+        assertion.conditions.notBefore = utcNow
+        assertion.conditions.notOnOrAfter = utcNow + timedelta(hours=8)
+
+        attributeStatement = AttributeStatement()
+
+        fnAttribute = Attribute()
+        fnAttribute.name = ESGFSamlNamespaces.FIRSTNAME_ATTRNAME
+        fnAttribute.nameFormat = (SAMLConstants.XSD_NS + "#" +
+                                  XSStringAttributeValue.TYPE_LOCAL_NAME)
+        fnAttribute.friendlyName = ESGFSamlNamespaces.FIRSTNAME_FRIENDLYNAME
+        fnAttribute.attributeValues.append(XSStringAttributeValue())
+        fnAttribute.attributeValues[-1].value = 'Test'
+        attributeStatement.attributes.append(fnAttribute)
+
+        groupRoleAttribute = Attribute()
+        groupRoleAttribute.name = 'urn:esg:sitea:grouprole'
+        groupRoleAttribute.nameFormat = 'groupRole'
+        for group, role in self.__class__.GROUP_ROLES:
+            groupRoleAttribute.attributeValues.append(
+                                                ESGFGroupRoleAttributeValue())
+            groupRoleAttribute.attributeValues[-1].group = group
+            groupRoleAttribute.attributeValues[-1].role = role
+
+        attributeStatement.attributes.append(groupRoleAttribute)
+
+        assertion.attributeStatements.append(attributeStatement)
+        return assertion
+
+    def _createResponse(self, numAssertions=2):
+        utcNow = datetime.utcnow()
+        response = Response()
+        response.version = SAMLVersion(SAMLVersion.VERSION_20)
+        response.id = str(uuid4())
+        response.issueInstant = utcNow
+        response.inResponseTo = str(uuid4())
+
+        response.issuer = Issuer()
+        response.issuer.format = Issuer.X509_SUBJECT
+        response.issuer.value = self.__class__.ISSUER_NAME
+
+        response.status = Status()
+        response.status.statusCode = StatusCode()
+        response.status.statusCode.value = StatusCode.SUCCESS_URI
+
+        for i in range(numAssertions):
+            response.assertions.append(self._createAssertion(utcNow))
+
+        return response
+
+    def _serialise(self, response):
+        return ElementTree.tostring(ESGFResponseElementTree.toXML(response))
+    
+    def _canonicalise(self, xml):
+        if Config.use_lxml:
+            return ElementTree.tostring(ElementTree.fromstring(xml), 
+                                        method='c14n')
+        else:
+            return xml
+
+
+class ESGFResponseElementTreeTestCase(ESGFResponseTestCaseBase):
+    """Test ESGF extensions to SAML Response ElementTree representation"""
+
+    def test01FromXMLStream(self):
+        xml = self._serialise(self._createResponse())
+
+        response = ESGFResponseElementTree.fromXML(
+                                                ElementTree.fromstring(xml))
+        streamedResponse = ESGFResponseElementTree.fromXMLStream(xml)
+
+        self.assert_(len(streamedResponse.assertions) == 2)
+        self.assert_(self._serialise(streamedResponse) ==
+                     self._serialise(response))
+
+        groupRoleValues = streamedResponse.assertions[0
+                                    ].attributeStatements[0
+                                    ].attributes[1].attributeValues
+        self.assert_(isinstance(groupRoleValues[0],
+                                ESGFGroupRoleAttributeValue))
+        self.assert_([(value.group, value.role) for value in groupRoleValues]
+                     == list(self.__class__.GROUP_ROLES))
+
+    def test02FromXMLStreamInSOAPEnvelope(self):
+        xml = self._serialise(self._createResponse(numAssertions=3))
+
+        response = ESGFResponseElementTree.fromXML(
+                                                ElementTree.fromstring(xml))
+        streamedResponse = ESGFResponseElementTree.fromXMLStream(
+                        StringIO(self.__class__.SOAP_ENVELOPE_TMPL % xml))
+
+        self.assert_(len(streamedResponse.assertions) == 3)
+        self.assert_(self._serialise(streamedResponse) ==
+                     self._serialise(response))
+
+    def test03FromXMLStreamWithNoResponse(self):
+        self.assertRaises(XMLTypeParseError,
+                          ESGFResponseElementTree.fromXMLStream,
+                          self.__class__.SOAP_ENVELOPE_TMPL % '')
+
+    def test04RegistryMatchFunc(self):
+        groupRoleValue = ESGFGroupRoleAttributeValue()
+        groupRoleValue.group = 'siteagroup'
+        elem = ESGFGroupRoleAttributeValueElementTree.toXML(groupRoleValue)
+        self.assert_(attributeValueElementTreeRegistry.matchFunc(elem) is
+                     ESGFGroupRoleAttributeValueElementTree)
+        
+        # Unregistered types including xs:string are not matched
+        xsStringElem = ElementTree.Element('AttributeValue')
+        xsStringElem.set(AttributeValueElementTreeRegistry.XSI_TYPE_ATTRIB_NAME,
+                         'xs:string')
+        self.assert_(attributeValueElementTreeRegistry.matchFunc(xsStringElem) 
+                     is None)
+        
+        unknownElem = ElementTree.Element('AttributeValue')
+        ElementTree.SubElement(unknownElem, '{urn:unknown}value')
+        self.assert_(attributeValueElementTreeRegistry.matchFunc(unknownElem)
+                     is None)
+        
+    def test05RegisterXsiType(self):
+        registry = AttributeValueElementTreeRegistry()
+        registry.register(ESGFGroupRoleAttributeValue,
+                          ESGFGroupRoleAttributeValueElementTree,
+                          xsiType='{%s}groupRole' % 
+                                  ESGFGroupRoleAttributeValue.DEFAULT_NS)
+        
+        elem = ElementTree.Element('AttributeValue')
+        elem.set(AttributeValueElementTreeRegistry.XSI_TYPE_ATTRIB_NAME,
+                 'esg:groupRole')
+        self.assert_(registry.matchFunc(elem) is
+                     ESGFGroupRoleAttributeValueElementTree)
+        self.assert_(registry.toXMLTypeMap == {
+            ESGFGroupRoleAttributeValue: ESGFGroupRoleAttributeValueElementTree
+        })
+        
+        kw = {'customToSAMLTypeMap': []}
+        registry.updateKeywords(kw)
+        self.assert_(kw['customToSAMLTypeMap'] == [registry.matchFunc])
+        
+        registry.unregister(ESGFGroupRoleAttributeValue)
+        self.assert_(registry.matchFunc(elem) is None)
+        self.assert_(not registry.toXMLTypeMap)
+        self.assertRaises(TypeError, registry.register, Response,
+                          ESGFResponseElementTree, xsiType='Response')
+        
+    def test06PrettyPrintLeavesNamespaceMap(self):
+        response = self._createResponse(numAssertions=1)
+        elem = ESGFResponseElementTree.toXML(response)
+        ElementTree.SubElement(elem, '{urn:unregistered:ns}extension')
+        
+        namespaceMap = getattr(ElementTree, '_namespace_map', {}).copy()
+        xml = prettyPrint(elem)
+        self.assert_('<ns0:extension xmlns:ns0="urn:unregistered:ns">' in xml)
+        self.assert_('<esg:groupRole' in xml)
+        self.assert_(getattr(ElementTree, '_namespace_map', {}) == 
+                     namespaceMap)
+        
+    def test07RegisterXsiTypeCollision(self):
+        # Types with the same local name in different namespaces
+        class _SiteAAttributeValue(XSStringAttributeValue):
+            pass
+        
+        class _SiteBAttributeValue(XSStringAttributeValue):
+            pass
+        
+        nsA = 'urn:siteA:security:authz:1.0:types'
+        nsB = 'urn:siteB:security:authz:1.0:types'
+        registry = AttributeValueElementTreeRegistry()
+        registry.register(_SiteAAttributeValue, _SiteAAttributeValue, 
+                          xsiType='{%s}attr' % nsA)
+        registry.register(_SiteBAttributeValue, _SiteBAttributeValue, 
+                          xsiType='{%s}attr' % nsB)
+        
+        # Standard Library elements don't hold their namespace declarations
+        # so the prefixes must also be registered for serialisation
+        registerNamespace(nsA, 'sitea')
+        registerNamespace(nsB, 'siteb')
+        xml = ('<saml:AttributeValue xmlns:saml="%s" xmlns:sitea="%s" '
+               'xmlns:siteb="%s" '
+               'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+               'xsi:type="%%s">x</saml:AttributeValue>' % 
+               (SAMLConstants.SAML20_NS, nsA, nsB))
+        self.assert_(registry.matchFunc(
+                ElementTree.fromstring(xml % 'sitea:attr')) is 
+                _SiteAAttributeValue)
+        self.assert_(registry.matchFunc(
+                ElementTree.fromstring(xml % 'siteb:attr')) is 
+                _SiteBAttributeValue)
+        
+        # Undeclared prefixes and other namespaces aren't matched
+        self.assert_(registry.matchFunc(
+                ElementTree.fromstring(xml % 'undeclared:attr')) is None)
+        self.assert_(registry.matchFunc(
+                ElementTree.fromstring(xml % 'saml:attr')) is None)
+        self.assert_(registry.matchFunc(
+                ElementTree.fromstring(xml % 'attr')) is None)
+        
+        registry.unregister(_SiteAAttributeValue)
+        self.assert_(registry.matchFunc(
+                ElementTree.fromstring(xml % 'sitea:attr')) is None)
+        self.assert_(registry.matchFunc(
+                ElementTree.fromstring(xml % 'siteb:attr')) is 
+                _SiteBAttributeValue)
+
+
+class ESGFResponseTemplateSerialiserTestCase(ESGFResponseTestCaseBase):
+    """Differential tests of template based serialisation against 
+    ESGFResponseElementTree"""
+    
+    def _assertSameSerialisation(self, response):
+        xml = ESGFResponseTemplateSerialiser.serialise(response)
+        self.assert_(self._canonicalise(xml) == 
+                     self._canonicalise(self._serialise(response)), xml)
+        return xml
+        
+    def test01Serialise(self):
+        for numAssertions in range(3):
+            self._assertSameSerialisation(
+                            self._createResponse(numAssertions=numAssertions))
+        
+    def test02Escaping(self):
+        response = self._createResponse(numAssertions=1)
+        response.inResponseTo = 'id"<&>\n'
+        attributes = response.assertions[0].attributeStatements[0].attributes
+        attributes[0].attributeValues[0].value = u'a<b&"c\u00e9>'
+        attributes[0].friendlyName = 'First "Name"'
+        attributes[1].attributeValues[0].group = 'group&"<1>'
+        
+        xml = self._assertSameSerialisation(response)
+        parsedResponse = ESGFResponseElementTree.fromXML(
+                                                ElementTree.fromstring(xml))
+        self.assert_(parsedResponse.inResponseTo == response.inResponseTo)
+        
+    def test03OptionalContent(self):
+        response = self._createResponse(numAssertions=2)
+        response.issuer = Issuer()
+        response.issuer.value = self.__class__.ISSUER_NAME
+        response.status.statusMessage = StatusMessage()
+        response.status.statusMessage.value = 'Attributes & roles'
+        
+        # Assertion with no issuer, subject or conditions
+        bareAssertion = Assertion()
+        bareAssertion.version = SAMLVersion(SAMLVersion.VERSION_20)
+        bareAssertion.id = str(uuid4())
+        bareAssertion.issueInstant = response.issueInstant
+        response.assertions.append(bareAssertion)
+        
+        assertion = response.assertions[0]
+        assertion.attributeStatements[0].attributes[0].attributeValues = []
+        assertion.attributeStatements[0].attributes[1].friendlyName = 'GR'
+        assertion.attributeStatements.append(AttributeStatement())
+        
+        # No ESGF Group/Role values
+        response.assertions[1].attributeStatements[0].attributes.pop()
+        self._assertSameSerialisation(response)
+        
+    def test04Fallback(self):
+        # Not covered by the template - serialised via ElementTree
+        response = self._createResponse(numAssertions=1)
+        response.status.statusMessage = StatusMessage()
+        response.status.statusMessage.value = ''
+        self._assertSameSerialisation(response)
+
+
+
+class ESGFInternedGroupRoleAttributeValueTestCase(ESGFResponseTestCaseBase):
+    """Test immutable, interned Group/Role attribute values"""
+    
+    def test01Interning(self):
+        attributeValue = ESGFInternedGroupRoleAttributeValue('siteagroup')
+        self.assert_(attributeValue.role == 
+                     ESGFGroupRoleAttributeValue.DEFAULT_ROLE_NAME)
+        self.assert_(ESGFInternedGroupRoleAttributeValue('siteagroup', 
+                                                         'default') 
+                     is attributeValue)
+        self.assert_(ESGFInternedGroupRoleAttributeValue('siteagroup', 
+                                                         'admin') 
+                     is not attributeValue)
+        
+        mutableValue = ESGFGroupRoleAttributeValue()
+        mutableValue.value = ('siteagroup', 'default')
+        self.assert_(ESGFInternedGroupRoleAttributeValue.fromValue(
+                                            mutableValue) is attributeValue)
+        
+        # The mutable class still allows ad hoc attributes
+        mutableValue.note = 'note'
+        self.assert_(mutableValue.note == 'note')
+        
+    def test02Immutable(self):
+        attributeValue = ESGFInternedGroupRoleAttributeValue('siteagroup')
+        for attrName, value in (('group', 'x'), 
+                                ('role', 'x'), 
+                                ('value', ('x', 'x')),
+                                ('namespacePrefix', 'x')):
+            self.assertRaises(AttributeError, setattr, attributeValue, 
+                              attrName, value)
+            
+        # No instance dictionary to add attributes to or update via
+        self.assert_(not hasattr(attributeValue, '__dict__'))
+        self.assertRaises(AttributeError, setattr, attributeValue, 'note', 
+                          'note')
+        self.assertRaises(AttributeError, setattr, attributeValue, 
+                          '_ESGFInternedGroupRoleAttributeValue__group', 'x')
+        self.assertRaises(AttributeError, delattr, attributeValue, 'group')
+        self.assert_(attributeValue.value == ('siteagroup', 'default'))
+        self.assert_(ESGFInternedGroupRoleAttributeValue('siteagroup') is 
+                     attributeValue)
+        self.assert_(hash(attributeValue) == hash(('siteagroup', 'default')))
+        
+        # Still matched as a Group/Role value
+        self.assert_(isinstance(attributeValue, 
+                                ESGFGroupRoleAttributeValueBase))
+        self.assertRaises(TypeError, ESGFInternedGroupRoleAttributeValue, 
+                          None)
+            
+    def test03HashAndEquality(self):
+        mutableValue = ESGFGroupRoleAttributeValue()
+        mutableValue.value = ('siteagroup', 'admin')
+        
+        attributeValues = set([
+            ESGFInternedGroupRoleAttributeValue('siteagroup', 'admin'),
+            ESGFInternedGroupRoleAttributeValue('siteagroup'),
+            ESGFInternedGroupRoleAttributeValue('siteagroup', 'admin')
+        ])
+        self.assert_(len(attributeValues) == 2)
+        
+        # Mutable values hash by identity so they never compare equal to
+        # interned ones
+        self.assert_(mutableValue not in list(attributeValues))
+        self.assert_(mutableValue != 
+                ESGFInternedGroupRoleAttributeValue('siteagroup', 'admin'))
+        self.assert_(ESGFInternedGroupRoleAttributeValue('siteagroup', 
+                                                         'admin') != 
+                     mutableValue)
+        self.assert_(ESGFInternedGroupRoleAttributeValue.fromValue(
+                                                    mutableValue) in 
+                     attributeValues)
+        
+    def test04Pickle(self):
+        attributeValue = ESGFInternedGroupRoleAttributeValue('siteagroup')
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            self.assert_(pickle.loads(pickle.dumps(attributeValue, protocol))
+                         is attributeValue)
+        
+        mutableValue = ESGFGroupRoleAttributeValue()
+        mutableValue.value = ('siteagroup', 'admin')
+        self.assert_(pickle.loads(pickle.dumps(mutableValue)).value == 
+                     mutableValue.value)
+        
+    def test05LegacyPickle(self):
+        # Earlier versions pickled an empty state.  Unset attributes take the
+        # class defaults
+        for pickled in (
+            "ccopy_reg\n_reconstructor\np0\n(cndg.security.common.saml_utils."
+            "esgf\nESGFGroupRoleAttributeValue\np1\nc__builtin__\nobject\n"
+            "p2\nNtp3\nRp4\n.",
+            "\x80\x02cndg.security.common.saml_utils.esgf\n"
+            "ESGFGroupRoleAttributeValue\nq\x00)\x81q\x01}q\x02b."):
+            attributeValue = pickle.loads(pickled)
+            self.assert_(attributeValue.value == (None, None))
+            self.assert_(attributeValue.namespaceURI == 
+                         ESGFGroupRoleAttributeValue.DEFAULT_NS)
+            attributeValue.value = ('siteagroup', 'admin')
+            
+        # Instance dictionary state
+        attributeValue = ESGFGroupRoleAttributeValue.__new__(
+                                                ESGFGroupRoleAttributeValue)
+        attributeValue.__setstate__({
+            '_ESGFGroupRoleAttributeValue__group': 'siteagroup',
+            '_ESGFGroupRoleAttributeValue__role': 'admin',
+            'note': 'note'
+        })
+        self.assert_(attributeValue.value == ('siteagroup', 'admin'))
+        self.assert_(attributeValue.elementLocalName == 
+                     ESGFGroupRoleAttributeValue.TYPE_LOCAL_NAME)
+        self.assert_(attributeValue.note == 'note')
+        
+    def test06Serialise(self):
+        response = self._createResponse(numAssertions=1)
+        attribute = response.assertions[0].attributeStatements[0].attributes[1]
+        xml = self._serialise(response)
+        
+        attribute.attributeValues = [
+            ESGFInternedGroupRoleAttributeValue.fromValue(attributeValue)
+            for attributeValue in attribute.attributeValues
+        ]
+        self.assert_(self._serialise(response) == xml)
+        self.assert_(self._canonicalise(
+                        ESGFResponseTemplateSerialiser.serialise(response)) == 
+                     self._canonicalise(xml))
+
+
+class ESGFAttributeQueryTemplateTestCase(BaseTestCase):
+    """Test attribute queries serialised from a template"""
+    ISSUER_NAME = "/O=Site A/CN=Authorisation Service"
+    
+    def _assertSameSerialisation(self, template, subjectId):
+        queryId = str(uuid4())
+        issueInstant = datetime.utcnow()
+        xml = template.serialise(subjectId, queryId=queryId, 
+                                 issueInstant=issueInstant)
+        query = template.makeQuery(subjectId, queryId=queryId,
+                                   issueInstant=issueInstant)
+        self.assert_(xml == ElementTree.tostring(
+                                    AttributeQueryElementTree.toXML(query)), 
+                     xml)
+        return xml
+        
+    def test01Serialise(self):
+        template = ESGFAttributeQueryTemplate(self.__class__.ISSUER_NAME)
+        self._assertSameSerialisation(template, self.__class__.OPENID_URI)
+        
+        xml = self._assertSameSerialisation(template, 
+                                            'https://a/openid?b=1&c=<"d">')
+        query = AttributeQueryElementTree.fromXML(ElementTree.fromstring(xml))
+        self.assert_(query.subject.nameID.value == 
+                     'https://a/openid?b=1&c=<"d">')
+        self.assert_(query.issuer.value == self.__class__.ISSUER_NAME)
+        self.assert_([attribute.name for attribute in query.attributes] ==
+                     [name for name, friendlyName in 
+                      ESGFDefaultQueryAttributes.ATTRIBUTE_NAMES])
+        
+    def test02AttributesAreCopied(self):
+        self.assert_(ESGFDefaultQueryAttributes().ATTRIBUTES is 
+                     ESGFDefaultQueryAttributes.ATTRIBUTES)
+        
+        # The shared defaults are read-only
+        self.assert_(isinstance(ESGFDefaultQueryAttributes.ATTRIBUTES, 
+                                tuple))
+        defaultAttribute = ESGFDefaultQueryAttributes.ATTRIBUTES[0]
+        self.assertRaises(AttributeError, setattr, defaultAttribute, 
+                          'name', 'urn:siteA:security:authz:1.0:attr')
+        self.assertRaises(AttributeError, setattr, defaultAttribute, 
+                          '_Attribute__name', 
+                          'urn:siteA:security:authz:1.0:attr')
+        self.assert_(isinstance(defaultAttribute.attributeValues, tuple))
+        self.assert_(pickle.loads(pickle.dumps(defaultAttribute)).name ==
+                     ESGFSamlNamespaces.FIRSTNAME_ATTRNAME)
+        
+        attributes = ESGFDefaultQueryAttributes.getAttributes()
+        attributes[0].name = 'urn:siteA:security:authz:1.0:attr'
+        self.assert_(ESGFDefaultQueryAttributes.ATTRIBUTES[0].name ==
+                     ESGFSamlNamespaces.FIRSTNAME_ATTRNAME)
+        self.assert_(ESGFDefaultQueryAttributes.getAttributes()[0].name ==
+                     ESGFSamlNamespaces.FIRSTNAME_ATTRNAME)
+        
+        template = ESGFAttributeQueryTemplate(self.__class__.ISSUER_NAME,
+                                              attributes=attributes)
+        attributes[0].name = ESGFSamlNamespaces.FIRSTNAME_ATTRNAME
+        template.attributes[0].name = ESGFSamlNamespaces.FIRSTNAME_ATTRNAME
+        query = template.makeQuery(self.__class__.OPENID_URI)
+        self.assert_(query.attributes[0].name == 
+                     'urn:siteA:security:authz:1.0:attr')
+        self.assert_('urn:siteA:security:authz:1.0:attr' in 
+                     template.serialise(self.__class__.OPENID_URI))
+        
+        # Read-only attributes are shared between queries rather than copied
+        query2 = template.makeQuery(self.__class__.OPENID_URI)
+        self.assert_(query2.attributes[0] is query.attributes[0])
+        self.assertRaises(AttributeError, setattr, query.attributes[0], 
+                          'name', ESGFSamlNamespaces.FIRSTNAME_ATTRNAME)
+
+
+if __name__ == "__main__":
+    unittest.main()
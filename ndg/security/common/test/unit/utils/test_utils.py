@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Unit tests for the utilities package
+
+NERC Data Grid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "17/10/26"
+__copyright__ = "(C) 2009 Science and Technology Facilities Council"
+__license__ = "BSD - see LICENSE file in top-level directory"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import unittest
+from urlparse import urlparse
+
+from ndg.security.common.utils import FakeUrllib2HTTPRequest
+
+
+class FakeUrllib2HTTPRequestTestCase(unittest.TestCase):
+    """Test the urllib2 request substitute used for cookie handling"""
+    URI = 'https://localhost:5443/AttributeAuthority?a=1'
+    
+    def test01GetHost(self):
+        request = FakeUrllib2HTTPRequest(self.__class__.URI)
+        
+        # Host name alone without the port - not the scheme
+        self.assert_(request.get_host() == 'localhost')
+        self.assert_(request.get_origin_req_host() == 'localhost')
+        self.assert_(request.get_type() == 'https')
+        self.assert_(request.get_full_url() == self.__class__.URI)
+        
+        request = FakeUrllib2HTTPRequest(urlparse('http://ndg.nerc.ac.uk/'))
+        self.assert_(request.get_host() == 'ndg.nerc.ac.uk')
+        
+    def test02Headers(self):
+        request = FakeUrllib2HTTPRequest(self.__class__.URI, 
+                                         headers={'content-type': 'text/xml'})
+        self.assert_(request.has_header('Content-type'))
+        request.add_unredirected_header('cookie', 'a=b')
+        self.assert_(request.get_header('Cookie') == 'a=b')
+        self.assert_(request.get_headers() == {'Content-type': 'text/xml',
+                                               'Cookie': 'a=b'})
+        
+    def test03InvalidURI(self):
+        self.assertRaises(TypeError, FakeUrllib2HTTPRequest, None)
+        
+        
+if __name__ == "__main__":
+    unittest.main()
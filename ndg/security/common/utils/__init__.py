@@ -295,7 +295,7 @@ class FakeUrllib2HTTPRequest(object):
         '''@return: host name
         @rtype: basestring
         '''
-        return self._parsed_uri.scheme.split(':', 1)[0]
+        return self._parsed_uri.netloc.split(':', 1)[0]
 
     get_origin_req_host = get_host
 
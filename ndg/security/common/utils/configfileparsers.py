@@ -11,6 +11,9 @@ __revision__ = '$Id$'
 
 from ConfigParser import SafeConfigParser, InterpolationMissingOptionError, \
     NoOptionError
+import re
+import threading
+from collections import OrderedDict
 
 # For parsing of properties file
 try: # python 2.5
@@ -26,6 +29,16 @@ log = logging.getLogger(__name__)
 expandEnvVars = lambda x: isinstance(x, basestring) and \
                     os.path.expandvars(x).strip() or x
 
+# Patterns for values accepted by int() and float() - used to infer the type 
+# of option values in the same way as trying ConfigParser getint and getfloat
+# in turn
+_INT_PAT = re.compile(r'\s*[-+]?\d+\s*\Z')
+_FLOAT_PAT = re.compile(r'\s*[-+]?((\d+\.?\d*|\.\d+)([eE][-+]?\d+)?|'
+                        r'inf(inity)?|nan)\s*\Z', re.I)
+
+# Values accepted by ConfigParser getboolean
+_BOOLEAN_STATES = SafeConfigParser._boolean_states
+
 
 class CaseSensitiveConfigParser(SafeConfigParser):
     '''
@@ -40,6 +53,220 @@ class CaseSensitiveConfigParser(SafeConfigParser):
 class ConfigFileParseError(Exception):
     """Raise for errors in configuration file formatting"""
 
+
+def _fingerprint(obj):
+    '''Make a hashable fingerprint of the settings passed to the property
+    file readers e.g. validKeys.  Values which aren't hashable such as
+    NotImplemented are represented by their repr
+
+    @param obj: settings to fingerprint
+    @rtype: tuple
+    @return: hashable fingerprint
+    '''
+    if isinstance(obj, dict):
+        return ('dict', tuple(sorted([(key, _fingerprint(val))
+                                      for key, val in obj.items()])))
+
+    elif isinstance(obj, (list, tuple)):
+        return (type(obj).__name__, tuple([_fingerprint(i) for i in obj]))
+
+    elif isinstance(obj, (basestring, int, long, float, bool, type(None))):
+        return obj
+
+    return repr(obj)
+
+
+def _copyProperties(properties):
+    '''Copy a properties dict returned by the property file readers.  Values
+    are either immutable or nested dicts and lists so only these need to be
+    copied
+
+    @type properties: dict
+    @param properties: properties to copy
+    @rtype: dict
+    @return: copy of properties
+    '''
+    if isinstance(properties, dict):
+        return dict([(key, _copyProperties(val))
+                     for key, val in properties.iteritems()])
+
+    elif isinstance(properties, list):
+        return [_copyProperties(i) for i in properties]
+
+    return properties
+
+
+class PropertyFileCache(object):
+    '''Process wide cache of properties parsed from INI and XML files so that
+    components reading the same file need only parse it once.  Entries are
+    keyed by the absolute file path, its modification time and size, the
+    environment - values may include environment variables - and the
+    settings the file is read with.  A changed file is re-read.  A file
+    rewritten with the same size within the file system's timestamp
+    resolution isn't detected - call invalidate after changing files
+    programmatically.
+
+    Callers are given their own copy of the cached properties so that they
+    can't alter the cached copy.  The least recently used entries are evicted
+    when the number of entries exceeds maxEntries.  Setting maxEntries to zero
+    disables caching.
+    '''
+    DEFAULT_MAX_ENTRIES = 128
+
+    # Fields of each cache key
+    PATH_IDX, MTIME_IDX, SIZE_IDX = range(3)
+
+    __slots__ = ('__maxEntries', '__entries', '__lock', '__nHits',
+                 '__nMisses')
+
+    def __init__(self, maxEntries=DEFAULT_MAX_ENTRIES):
+        self.__maxEntries = maxEntries
+        self.__lock = threading.RLock()
+        self.clear()
+        self.maxEntries = maxEntries
+
+    def _getMaxEntries(self):
+        return self.__maxEntries
+
+    def _setMaxEntries(self, value):
+        if isinstance(value, basestring):
+            value = int(value)
+
+        elif not isinstance(value, (int, long)):
+            raise TypeError('Expecting int, long or string type for '
+                            '"maxEntries"; got %r' % type(value))
+
+        if value < 0:
+            raise ValueError('"maxEntries" must be zero or greater; got %r' %
+                             value)
+        with self.__lock:
+            self.__maxEntries = value
+            self._evict()
+
+    maxEntries = property(_getMaxEntries, _setMaxEntries,
+                          doc="Maximum number of parsed files held.  Zero "
+                              "disables caching")
+
+    def _getNHits(self):
+        return self.__nHits
+
+    nHits = property(_getNHits, doc="Number of reads returned from the cache")
+
+    def _getNMisses(self):
+        return self.__nMisses
+
+    nMisses = property(_getNMisses,
+                       doc="Number of cacheable reads for which the file was "
+                           "parsed")
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def makeKey(self, propFilePath, *readSettings):
+        '''Make a cache key for reading a file
+
+        @type propFilePath: basestring
+        @param propFilePath: file path to properties file
+        @param readSettings: settings the file is to be read with e.g.
+        validKeys and sections
+        @rtype: tuple / None
+        @return: cache key or None if caching is disabled or the file can't
+        be found.  In the latter case the caller's own error handling applies
+        '''
+        if self.__maxEntries == 0:
+            return None
+
+        try:
+            stat = os.stat(propFilePath)
+        except OSError:
+            return None
+
+        return (os.path.abspath(propFilePath), stat.st_mtime, stat.st_size,
+                hash(frozenset(os.environ.iteritems())),
+                _fingerprint(readSettings))
+
+    def get(self, key):
+        '''Get a copy of cached properties
+
+        @type key: tuple / None
+        @param key: key made with makeKey
+        @rtype: dict / None
+        @return: copy of the properties or None if they're not cached
+        '''
+        if key is None:
+            return None
+
+        with self.__lock:
+            properties = self.__entries.pop(key, None)
+            if properties is None:
+                self.__nMisses += 1
+                return None
+
+            # Most recently used go to the end
+            self.__entries[key] = properties
+            self.__nHits += 1
+
+        return _copyProperties(properties)
+
+    def put(self, key, properties):
+        '''Cache a copy of properties read from a file.  Entries for other
+        versions of the same file are removed
+
+        @type key: tuple / None
+        @param key: key made with makeKey
+        @type properties: dict
+        @param properties: properties read from the file
+        '''
+        if key is None:
+            return
+
+        properties = _copyProperties(properties)
+        path = key[PropertyFileCache.PATH_IDX]
+        version = key[PropertyFileCache.MTIME_IDX:
+                      PropertyFileCache.SIZE_IDX+1]
+        with self.__lock:
+            for _key in self.__entries.keys():
+                if (_key[PropertyFileCache.PATH_IDX] == path and
+                    _key[PropertyFileCache.MTIME_IDX:
+                         PropertyFileCache.SIZE_IDX+1] != version):
+                    del self.__entries[_key]
+
+            self.__entries[key] = properties
+            self._evict()
+
+    def invalidate(self, propFilePath=None):
+        '''Remove cached properties for a file or for all files
+
+        @type propFilePath: basestring / None
+        @param propFilePath: file path to properties file.  If None, all
+        entries are removed
+        '''
+        if propFilePath is None:
+            with self.__lock:
+                self.__entries.clear()
+            return
+
+        path = os.path.abspath(propFilePath)
+        with self.__lock:
+            for key in self.__entries.keys():
+                if key[PropertyFileCache.PATH_IDX] == path:
+                    del self.__entries[key]
+
+    def clear(self):
+        '''Remove all entries and reset the hit and miss counts'''
+        with self.__lock:
+            self.__entries = OrderedDict()
+            self.__nHits = 0
+            self.__nMisses = 0
+
+    def _evict(self):
+        '''Remove the least recently used entries in excess of maxEntries'''
+        while len(self.__entries) > self.__maxEntries:
+            self.__entries.popitem(last=False)
+
+# Cache shared by the INI and XML property file readers in this module
+propertyFileCache = PropertyFileCache()
+
 def readAndValidateProperties(propFilePath, validKeys={}, **iniPropertyFileKw):
     """
     Determine the type of properties file and load the contents appropriately.
@@ -137,6 +364,52 @@ class INIPropertyFile(object):
     
     defaultOptionNames = ('here',)
     
+    def __init__(self):
+        self.__cfg = None
+        
+        # File path and default items to parse the file with if properties
+        # were returned from the cache
+        self.__cfgSettings = None
+        
+    def _getCfg(self):
+        '''Get the config object for the file last read.  If the properties
+        were returned from the cache, the file is parsed on first access'''
+        if self.__cfgSettings is not None:
+            propFilePath, defaultItems = self.__cfgSettings
+            self.__cfgSettings = None
+            self.__cfg = self._makeConfigParser(propFilePath, defaultItems)
+            
+        return self.__cfg
+    
+    def _setCfg(self, value):
+        self.__cfgSettings = None
+        self.__cfg = value
+        
+    cfg = property(_getCfg, _setCfg, 
+                   doc="Config object for the file last read")
+    
+    @staticmethod
+    def _makeConfigParser(propFilePath, defaultItems):
+        '''Parse a file with a new config object
+        
+        @type propFilePath: basestring
+        @param propFilePath: file path to properties file
+        @type defaultItems: dict
+        @param defaultItems: default items for the config object
+        @rtype: CaseSensitiveConfigParser
+        @return: new config object
+        '''
+        # Add default item for file location to enable convenient 
+        # substitutions within the file
+        defaultItems['here'] = os.path.dirname(propFilePath)
+        
+        cfg = CaseSensitiveConfigParser(defaults=defaultItems)
+        cfg.read(propFilePath)
+        if not os.path.isfile(propFilePath):
+            raise IOError('Error parsing properties file "%s": No such '
+                          'file' % propFilePath)
+        return cfg
+    
     def read(self, 
              propFilePath, 
              validKeys, 
@@ -173,17 +446,27 @@ class INIPropertyFile(object):
         
         # Keep a record of property file path setting
         self.propFilePath = propFilePath
-            
+
+        # Only files read with a locally created config object are cached.
+        # The 'here' default item is derived from the file path
+        cacheKey = None
         if cfg is None:
-            # Add default item for file location to enable convenient 
-            # substitutions within the file
-            defaultItems['here'] = os.path.dirname(propFilePath)
-            
-            self.cfg = CaseSensitiveConfigParser(defaults=defaultItems)
-            self.cfg.read(propFilePath)
-            if not os.path.isfile(propFilePath):
-                raise IOError('Error parsing properties file "%s": No such '
-                              'file' % propFilePath)
+            cacheKey = propertyFileCache.makeKey(propFilePath, 'ini',
+                                                 validKeys, sections, prefix,
+                                                 dict([(k, v) for k, v in
+                                                       defaultItems.items()
+                                                       if k != 'here']))
+            properties = propertyFileCache.get(cacheKey)
+            if properties is not None:
+                log.debug("Returning cached properties for %s" %
+                          propFilePath)
+                
+                # Defer parsing until the config object is needed
+                self.cfg = None
+                self.__cfgSettings = (propFilePath, dict(defaultItems))
+                return properties
+
+            self.cfg = self._makeConfigParser(propFilePath, defaultItems)
         else:
             self.cfg = cfg
                
@@ -214,6 +497,8 @@ class INIPropertyFile(object):
         for opt in INIPropertyFile.defaultOptionNames:
             properties.pop(opt, None)
         
+        propertyFileCache.put(cacheKey, properties)
+
         log.debug("Finished reading from INI properties file")
         return properties
     
@@ -269,18 +554,21 @@ def _parseConfig(cfg, validKeys, section='DEFAULT', prefix=''):
     propRoot = {}
     propThisBranch = propRoot
     
+    defaults = cfg.defaults()
     if section == 'DEFAULT':
-        keys = cfg.defaults().keys()
+        keys = defaults.keys()
     else:
         keys = cfg.options(section)
         # NB, we need to be careful here - since this will return the section
         # keywords AND the 'DEFAULT' section entries - so use the difference 
         # between the two
-        keys = filter(lambda x:x not in cfg.defaults().keys(), keys)
+        defaultKeys = set(defaults)
+        keys = [key for key in keys if key not in defaultKeys]
 
     for key in keys:
+        # Each value is read and interpolated once and then converted
         try:
-            val = cfg.get(section, key)
+            rawVal = cfg.get(section, key)
         except InterpolationMissingOptionError, e:
             log.warning('Ignoring property "%s": %s' % (key, e))
             continue
@@ -316,8 +604,7 @@ def _parseConfig(cfg, validKeys, section='DEFAULT', prefix=''):
             subKey = '_'.join(keyLevels[1:])
             if subSectionKey in validKeys and \
                isinstance(validKeys[subSectionKey], dict):
-                val = _parseVal(cfg, section, key, validKeys[subSectionKey],
-                                subKey=subKey)
+                val = _convertVal(rawVal, subKey, validKeys[subSectionKey])
                 if subSectionKey in propThisBranch:
                     propThisBranch[subSectionKey][subKey] = val
                 else:
@@ -325,7 +612,7 @@ def _parseConfig(cfg, validKeys, section='DEFAULT', prefix=''):
         else: 
             # No sub-section present           
             subKey = keyLevels[0]
-            val = _parseVal(cfg, section, key, validKeys, subKey=subKey)
+            val = _convertVal(rawVal, subKey, validKeys)
             
             # check if key already exists; if so, append to list
             if propThisBranch.has_key(subKey):
@@ -338,8 +625,7 @@ def _parseConfig(cfg, validKeys, section='DEFAULT', prefix=''):
     return propRoot
 
 def _parseVal(cfg, section, option, validKeys, subKey=None):
-    '''Convert option to correct type trying each parser config routine in 
-    turn.  Convert to a list if validKeys dict item indicates so
+    '''Read an option and convert it to the correct type - see _convertVal
     
     @type cfg: ndg.security.common.utils.configfileparsers.CaseSensitiveConfigParser
     @param cfg: config file object
@@ -356,34 +642,54 @@ def _parseVal(cfg, section, option, validKeys, subKey=None):
     else:
         key = option
          
-    conversionFuncs = (cfg.getint, cfg.getfloat, cfg.getboolean, cfg.get)
-    for conversionFunc in conversionFuncs:
-        try:
-            val = conversionFunc(section, option)
-            if val == '':
-                # NB, the XML parser will return empty vals as None, so ensure 
-                # consistency here
-                val = None
-                
-            elif isinstance(val, basestring):
-                # expand out any env vars
-                val = expandEnvVars(val)
-                
-                # ensure it is read in as the correct type
-                if key in validKeys and isinstance(validKeys[key], list):
-                    # Treat as a list of space separated string type elements
-                    # Nb. lists only cater for string type elements
-                    val = val.split()
-             
-            return val
-        except ValueError:
-            continue
-        except Exception, e:
-            log.error('Error parsing option "%s" in section "%s": %s' %
-                      (section, key, e))
-            raise
+    try:
+        return _convertVal(cfg.get(section, option), key, validKeys)
+    
+    except Exception, e:
+        log.error('Error parsing option "%s" in section "%s": %s' %
+                  (section, key, e))
+        raise
+
 
-    raise ValueError('Error parsing option "%s" in section "%s"'%(section,key))
+def _convertVal(val, key, validKeys):
+    '''Convert an option value read from a config file to int, float or bool
+    type if it is in the form accepted by ConfigParser getint, getfloat or 
+    getboolean, trying each in turn.  Otherwise, convert to a list if 
+    validKeys dict item indicates so
+    
+    @type val: basestring
+    @param val: option value as read from the config file
+    @type key: basestring
+    @param key: option key
+    @type validKeys: dict
+    @param validKeys: key look-up - if item is set to list type then the option
+    value in the config file will be split into a list.
+    @return: converted value'''
+    if _INT_PAT.match(val):
+        return int(val)
+    
+    if _FLOAT_PAT.match(val):
+        return float(val)
+    
+    boolVal = _BOOLEAN_STATES.get(val.lower())
+    if boolVal is not None:
+        return boolVal
+    
+    if val == '':
+        # NB, the XML parser will return empty vals as None, so ensure 
+        # consistency here
+        return None
+        
+    # expand out any env vars
+    val = expandEnvVars(val)
+    
+    # ensure it is read in as the correct type
+    if key in validKeys and isinstance(validKeys[key], list):
+        # Treat as a list of space separated string type elements
+        # Nb. lists only cater for string type elements
+        val = val.split()
+        
+    return val
 
          
 def readXMLPropertyFile(propFilePath, validKeys, rootElem=None):
@@ -402,7 +708,15 @@ def readXMLPropertyFile(propFilePath, validKeys, rootElem=None):
     @type rootElem: ElementTree.Element
     @return: dict with the loaded properties in
     """
+    # Only whole files are cached
+    cacheKey = None
     if rootElem is None:
+        cacheKey = propertyFileCache.makeKey(propFilePath, 'xml', validKeys)
+        properties = propertyFileCache.get(cacheKey)
+        if properties is not None:
+            log.debug("Returning cached properties for %s" % propFilePath)
+            return properties
+
         try:
             tree = ElementTree.parse(propFilePath)
             
@@ -457,6 +771,8 @@ def readXMLPropertyFile(propFilePath, validKeys, rootElem=None):
         raise ValueError('Error parsing tag "%s" in properties file "%s": %s' %
                          (elem.tag, propFilePath, e))
 
+    propertyFileCache.put(cacheKey, properties)
+
     log.debug("Finished reading from XML properties file")
     return properties
 
@@ -0,0 +1,406 @@
+"""Persistent HTTP(S) connection pooling for SOAP clients
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "17/10/26"
+__copyright__ = "(C) 2009 Science and Technology Facilities Council"
+__license__ = "BSD - see LICENSE file in top-level directory"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import logging
+log = logging.getLogger(__name__)
+import socket
+import select
+import httplib
+import urllib2
+import threading
+from time import time
+from urlparse import urlparse
+from cStringIO import StringIO
+
+from ndg.security.common.utils import FakeUrllib2HTTPRequest
+
+
+class _PooledHTTPResponse(object):
+    """Response read in full from a pooled connection so that the connection
+    can be returned to the pool straight away
+    """
+    __slots__ = ('status', 'reason', 'msg', 'body')
+
+    def __init__(self, status, reason, msg, body):
+        self.status = status
+        self.reason = reason
+        self.msg = msg
+        self.body = body
+
+    def info(self):
+        """Header fields as for urllib2 responses - used by cookielib"""
+        return self.msg
+
+
+class HTTPConnectionPool(object):
+    """Pool of persistent HTTP and HTTPS connections.  Idle connections are
+    kept per (scheme, host, port, SSL context) for reuse by subsequent
+    requests avoiding a new TCP connection and TLS handshake each time.
+
+    Before reuse, idle connections are checked and discarded if they have
+    been idle for longer than idleTimeout or the server has closed them.  A
+    request which fails on a reused connection is retried once on a new
+    connection but only if the request could not be sent or its method is
+    idempotent.  A POST which may have reached the server is not repeated.
+
+    Cookies are handled with an optional cookielib.CookieJar via
+    FakeUrllib2HTTPRequest.
+
+    HTTPS connections are made with the standard library ssl module using
+    the SSL context passed to request.  They don't use the M2Crypto SSL
+    configuration of the SAML SOAP binding client.  If no context is given,
+    the standard library default applies: peer certificates and host names
+    are verified against the system CA certificates.  Pass an
+    ssl.SSLContext to set the trusted CA certificates and any client
+    certificate.
+    """
+    DEFAULT_MAX_SIZE = 4
+    DEFAULT_IDLE_TIMEOUT = 60.
+
+    # Errors indicating a reused connection was closed by the server
+    STALE_CONNECTION_EXCEPTIONS = (httplib.BadStatusLine,
+                                   httplib.CannotSendRequest,
+                                   httplib.ResponseNotReady,
+                                   socket.error)
+
+    # Methods which can safely be repeated if a request may have been
+    # received by the server (RFC 2616 section 9.1.2)
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE')
+
+    def __init__(self, maxSize=DEFAULT_MAX_SIZE,
+                 idleTimeout=DEFAULT_IDLE_TIMEOUT, cookieJar=None):
+        """
+        @type maxSize: int
+        @param maxSize: maximum number of idle connections kept for each
+        (scheme, host, port, SSL context)
+        @type idleTimeout: float
+        @param idleTimeout: time in seconds after which idle connections are
+        discarded
+        @type cookieJar: cookielib.CookieJar / None type
+        @param cookieJar: cookie jar for cookie handling
+        """
+        self.maxSize = maxSize
+        self.idleTimeout = idleTimeout
+        self.cookieJar = cookieJar
+
+        # Map of key to a list of (connection, time last used) tuples
+        self.__idleConnections = {}
+        self.__lock = threading.Lock()
+
+        self.__nCreated = 0
+        self.__nReused = 0
+
+    def _getMaxSize(self):
+        return self.__maxSize
+
+    def _setMaxSize(self, value):
+        if not isinstance(value, (int, long)):
+            raise TypeError('Expecting int type for "maxSize"; got %r' %
+                            type(value))
+        if value < 0:
+            raise ValueError('"maxSize" must be zero or greater')
+        self.__maxSize = value
+
+    maxSize = property(_getMaxSize, _setMaxSize,
+                       doc="Maximum number of idle connections kept for each "
+                           "(scheme, host, port, SSL context)")
+
+    def _getIdleTimeout(self):
+        return self.__idleTimeout
+
+    def _setIdleTimeout(self, value):
+        if isinstance(value, basestring):
+            value = float(value)
+        elif not isinstance(value, (int, long, float)):
+            raise TypeError('Expecting float type for "idleTimeout"; got %r' %
+                            type(value))
+        self.__idleTimeout = float(value)
+
+    idleTimeout = property(_getIdleTimeout, _setIdleTimeout,
+                           doc="Time in seconds after which idle connections "
+                               "are discarded")
+
+    def _getNCreated(self):
+        return self.__nCreated
+
+    nCreated = property(_getNCreated, doc="Number of connections created")
+
+    def _getNReused(self):
+        return self.__nReused
+
+    nReused = property(_getNReused,
+                       doc="Number of times an idle connection has been "
+                           "reused")
+
+    def _getNIdle(self):
+        self.__lock.acquire()
+        try:
+            return sum([len(v) for v in self.__idleConnections.values()])
+        finally:
+            self.__lock.release()
+
+    nIdle = property(_getNIdle, doc="Number of idle connections held")
+
+    @staticmethod
+    def _isConnectionAlive(connection):
+        """Check an idle connection.  The server shouldn't send anything on
+        an idle connection so if the socket is readable, it has been closed
+        or is in an unknown state
+        """
+        if connection.sock is None:
+            return False
+        try:
+            readable = select.select([connection.sock], [], [], 0.)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+
+        return not readable
+
+    def _makeConnection(self, scheme, host, port, timeout, sslContext):
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(host, port, timeout=timeout,
+                                                 context=sslContext)
+        elif scheme == 'http':
+            connection = httplib.HTTPConnection(host, port, timeout=timeout)
+        else:
+            raise ValueError('Expecting http or https scheme; got %r' %
+                             scheme)
+
+        self.__lock.acquire()
+        try:
+            self.__nCreated += 1
+        finally:
+            self.__lock.release()
+
+        return connection
+
+    def _getConnection(self, key, timeout):
+        """Get an idle connection for a key or None if there are none which
+        are usable
+        """
+        now = time()
+        self.__lock.acquire()
+        try:
+            idleConnections = self.__idleConnections.get(key)
+            while idleConnections:
+                connection, lastUsed = idleConnections.pop()
+                if (now - lastUsed < self.__idleTimeout and
+                    self._isConnectionAlive(connection)):
+                    self.__nReused += 1
+                    break
+
+                connection.close()
+            else:
+                return None
+        finally:
+            self.__lock.release()
+
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+
+        connection.timeout = timeout
+        connection.sock.settimeout(timeout)
+        return connection
+
+    def _releaseConnection(self, key, connection):
+        """Return a connection to the pool once a response has been read"""
+        self.__lock.acquire()
+        try:
+            idleConnections = self.__idleConnections.setdefault(key, [])
+            if len(idleConnections) < self.__maxSize:
+                idleConnections.append((connection, time()))
+                return
+        finally:
+            self.__lock.release()
+
+        connection.close()
+
+    def closeAll(self):
+        """Close all idle connections"""
+        self.__lock.acquire()
+        try:
+            idleConnections = self.__idleConnections
+            self.__idleConnections = {}
+        finally:
+            self.__lock.release()
+
+        for connections in idleConnections.values():
+            for connection, lastUsed in connections:
+                connection.close()
+
+    def _send(self, connection, method, path, body, headers):
+        connection.request(method, path, body, headers)
+
+    def _receive(self, connection):
+        response = connection.getresponse()
+        return response, response.read()
+
+    def request(self, uri, body=None, headers=None, method=None,
+                timeout=socket._GLOBAL_DEFAULT_TIMEOUT, sslContext=None):
+        """Make an HTTP request using a pooled connection
+
+        @type uri: basestring
+        @param uri: request URI
+        @type body: basestring / None type
+        @param body: request body
+        @type headers: dict / None type
+        @param headers: HTTP header fields
+        @type method: basestring / None type
+        @param method: HTTP method, defaults to POST if a body is set or GET
+        otherwise
+        @type timeout: float
+        @param timeout: socket timeout
+        @type sslContext: ssl.SSLContext / None type
+        @param sslContext: SSL context for HTTPS requests.  Connections are
+        pooled separately for each context.  If None, the standard library
+        default context is used
+        @rtype: _PooledHTTPResponse
+        @return: response read in full
+        """
+        if method is None:
+            method = 'GET' if body is None else 'POST'
+
+        parsedURI = urlparse(uri)
+        scheme = parsedURI.scheme
+        host = parsedURI.hostname
+        port = parsedURI.port
+        if port is None:
+            port = (httplib.HTTPS_PORT if scheme == 'https'
+                    else httplib.HTTP_PORT)
+
+        path = parsedURI.path or '/'
+        if parsedURI.query:
+            path += '?' + parsedURI.query
+
+        request = FakeUrllib2HTTPRequest(parsedURI, headers=headers or {})
+        if self.cookieJar is not None:
+            self.cookieJar.add_cookie_header(request)
+
+        key = (scheme, host, port, sslContext)
+        connection = self._getConnection(key, timeout)
+        reused = connection is not None
+        if not reused:
+            connection = self._makeConnection(scheme, host, port, timeout,
+                                              sslContext)
+        sent = False
+        try:
+            self._send(connection, method, path, body, request.get_headers())
+            sent = True
+            response, responseBody = self._receive(connection)
+
+        except self.__class__.STALE_CONNECTION_EXCEPTIONS, e:
+            connection.close()
+            if not reused or isinstance(e, socket.timeout):
+                raise
+
+            # Once sent, the server may have processed the request before
+            # closing the connection so only repeat it if that's safe
+            if sent and method not in self.__class__.IDEMPOTENT_METHODS:
+                raise
+
+            # The server may have closed the connection in the meantime
+            log.debug("Retrying request to %r on a new connection following "
+                      "error with reused connection: %s", uri, e)
+            connection = self._makeConnection(scheme, host, port, timeout,
+                                              sslContext)
+            try:
+                self._send(connection, method, path, body,
+                           request.get_headers())
+                response, responseBody = self._receive(connection)
+            except:
+                connection.close()
+                raise
+        except:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._releaseConnection(key, connection)
+
+        pooledResponse = _PooledHTTPResponse(response.status, response.reason,
+                                             response.msg, responseBody)
+        if self.cookieJar is not None:
+            self.cookieJar.extract_cookies(pooledResponse, request)
+
+        return pooledResponse
+
+
+class PooledHTTPHandler(urllib2.HTTPHandler):
+    """urllib2 handler sending requests via an HTTPConnectionPool.  Add to a
+    urllib2.OpenerDirector such as the one used by the SAML SOAP binding
+    client:
+
+    binding.client.openerDirector.add_handler(PooledHTTPHandler(pool))
+    """
+    # Take precedence over the standard handlers
+    handler_order = urllib2.HTTPHandler.handler_order - 100
+
+    def __init__(self, connectionPool, sslContext=None):
+        """
+        @type connectionPool: HTTPConnectionPool
+        @param connectionPool: pool to send requests with
+        @type sslContext: ssl.SSLContext / None type
+        @param sslContext: SSL context for HTTPS requests.  If None, the
+        standard library default context is used
+        """
+        urllib2.HTTPHandler.__init__(self)
+        if not isinstance(connectionPool, HTTPConnectionPool):
+            raise TypeError('Expecting %r type for "connectionPool"; got %r' %
+                            (HTTPConnectionPool, type(connectionPool)))
+        self.connectionPool = connectionPool
+        self.sslContext = sslContext
+
+    def _open(self, req):
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        if req.has_data() and 'Content-type' not in headers:
+            headers['Content-type'] = 'application/x-www-form-urlencoded'
+
+        try:
+            response = self.connectionPool.request(req.get_full_url(),
+                                                   body=req.get_data(),
+                                                   headers=headers,
+                                                   method=req.get_method(),
+                                                   timeout=req.timeout,
+                                                   sslContext=self.sslContext)
+        except socket.error, e:
+            raise urllib2.URLError(e)
+
+        result = urllib2.addinfourl(StringIO(response.body), response.msg,
+                                    req.get_full_url())
+        result.code = response.status
+        result.msg = response.reason
+        return result
+
+    def http_open(self, req):
+        return self._open(req)
+
+
+class PooledHTTPSHandler(PooledHTTPHandler):
+    """urllib2 handler sending HTTPS requests via an HTTPConnectionPool.
+
+    Connections use the standard library ssl module with the sslContext
+    given, in place of the M2Crypto SSL configuration the SAML SOAP binding
+    client otherwise uses.  Without a context, peer certificates are
+    verified against the system CA certificates so set one with the CA
+    certificates and client certificate needed for the attribute
+    authorities queried
+    """
+
+    def http_open(self, req):
+        # Only handle HTTPS
+        return None
+
+    def https_open(self, req):
+        return self._open(req)
+
+    https_request = urllib2.AbstractHTTPHandler.do_request_
@@ -13,23 +13,43 @@ from ndg.security.common.config import Config, importElementTree
 ElementTree = importElementTree()
 
 import re
+import threading
+from xml.etree import ElementTree as PyElementTree
 
 # Fred Lundh's customisation for C14N functionality - egg available from
 # http://ndg.nerc.ac.uk/dist site
-c14nWarning = ("Custom ElementC14N package is not installed, canonicalize "
-               "function is disabled")
 try:
     from elementtree import ElementC14N
     elementC14nNotInstalled = False
 except ImportError:
     elementC14nNotInstalled = True
+
+# lxml's native C14N is used in preference where available
+try:
+    from lxml import etree as lxmlElementTree
+    lxmlNotInstalled = False
+except ImportError:
+    lxmlNotInstalled = True
+
+c14nWarning = ("Neither lxml nor the custom ElementC14N package is installed, "
+               "canonicalize function is disabled")
+if elementC14nNotInstalled and lxmlNotInstalled:
     import warnings
     warnings.warn(c14nWarning)
     
 from cStringIO import StringIO
 
 
+# Serialises updates to the ElementTree global namespace map
+_namespaceMapLock = threading.Lock()
+
+
 if Config.use_lxml:
+    def registerNamespace(nsURI, nsPrefix):
+        """Register a namespace prefix for serialisation.  lxml elements 
+        carry their own namespace maps so there is nothing to do
+        """
+        
     def makeEtreeElement(tag, ns_prefix, ns_uri, attrib={}, **extra):
         """Makes an ElementTree element handling namespaces in the way
         appropriate for the ElementTree implementation in use.
@@ -37,12 +57,32 @@ if Config.use_lxml:
         elem = ElementTree.Element(tag, {ns_prefix: ns_uri}, attrib, **extra)
         return elem
 else:
+    def registerNamespace(nsURI, nsPrefix):
+        """Register a namespace prefix for serialisation in the ElementTree
+        namespace map.  The map is only updated if the prefix is not already
+        set so that repeat calls are a dictionary lookup and concurrent 
+        updates are made under a lock
+        
+        @type nsURI: basestring
+        @param nsURI: namespace URI
+        @type nsPrefix: basestring
+        @param nsPrefix: prefix to serialise nsURI with
+        """
+        if ElementTree._namespace_map.get(nsURI) == nsPrefix:
+            return
+        
+        _namespaceMapLock.acquire()
+        try:
+            ElementTree._namespace_map[nsURI] = nsPrefix
+        finally:
+            _namespaceMapLock.release()
+        
     def makeEtreeElement(tag, ns_prefix, ns_uri, attrib={}, **extra):
         """Makes an ElementTree element handling namespaces in the way
          appropriate for the ElementTree implementation in use.
         """
         elem = ElementTree.Element(tag, attrib, **extra)
-        ElementTree._namespace_map[ns_uri] = ns_prefix
+        registerNamespace(ns_uri, ns_prefix)
         return elem
 
 class QName(ElementTree.QName):
@@ -112,20 +152,121 @@ class QName(ElementTree.QName):
                             "Namespace URI'")
 
 
-def canonicalize(elem, **kw):
-    '''ElementTree based Canonicalization - See ElementC14N for keyword
-    info.  Also useful for pretty printing XML
+def _lxmlCanonicalize(elem, sink, exclusive, inclusiveNamespaces, **kw):
+    '''Canonicalize with lxml's native C14N.  Elements from other 
+    ElementTree implementations are serialised and re-parsed with lxml so 
+    that namespace declarations are placed as they are in serialised output
+    '''
+    if kw:
+        raise NotImplementedError('ElementC14N keyword(s) %s not supported '
+                                  'by the lxml canonicalization backend' %
+                                  ', '.join(sorted(kw)))
+        
+    if not isinstance(elem, lxmlElementTree._Element):
+        # ElementTree may be lxml so use the Standard Library serialisation
+        elem = lxmlElementTree.fromstring(PyElementTree.tostring(elem))
+        
+    lxmlElementTree.ElementTree(elem).write_c14n(sink, 
+                                    exclusive=exclusive,
+                                    with_comments=False,
+                                    inclusive_ns_prefixes=inclusiveNamespaces)
+
+
+def _elementC14NCanonicalize(elem, sink, exclusive, inclusiveNamespaces, 
+                             **kw):
+    '''Canonicalize with the pure Python ElementC14N package'''
+    if inclusiveNamespaces:
+        kw['inclusive_namespaces'] = inclusiveNamespaces
+        
+    ElementC14N.write(ElementC14N.build_scoped_tree(elem), sink, 
+                      exclusive=exclusive, **kw)
+
+
+# Available canonicalization backends in order of preference for lxml 
+# elements.  See _getDefaultC14NBackend for other elements
+C14N_BACKENDS = []
+if not lxmlNotInstalled:
+    C14N_BACKENDS.append(('lxml', _lxmlCanonicalize))
+    
+if not elementC14nNotInstalled:
+    C14N_BACKENDS.append(('ElementC14N', _elementC14NCanonicalize))
+
+
+def _getDefaultC14NBackend(elem):
+    '''Get the name of the canonicalization backend to use for an element 
+    when none is specified.  lxml is used for lxml elements.  Elements from 
+    other ElementTree implementations would have to be serialised and 
+    re-parsed for lxml so ElementC14N is used for them where it's installed
+
     @type elem: ElementTree.Element
     @param elem: element to be canonicalized
     @rtype: basestring
-    @return: canonicalised output
+    @return: backend name
+    @raise NotImplementedError: no backend is available
     '''
-    if elementC14nNotInstalled:
+    if not C14N_BACKENDS:
         raise NotImplementedError(c14nWarning)
     
-    f = StringIO()
-    ElementC14N.write(ElementC14N.build_scoped_tree(elem), f, **kw)
-    return f.getvalue()
+    if (not elementC14nNotInstalled and 
+        (lxmlNotInstalled or 
+         not isinstance(elem, lxmlElementTree._Element))):
+        return 'ElementC14N'
+    
+    return C14N_BACKENDS[0][0]
+
+
+def canonicalize(elem, sink=None, exclusive=False, inclusiveNamespaces=None,
+                 backend=None, **kw):
+    '''ElementTree based Canonicalization.  lxml's native C14N is used for
+    lxml elements and the pure Python ElementC14N package for others, 
+    falling back to whichever is installed.  Also useful for pretty printing 
+    XML
+    
+    @type elem: ElementTree.Element
+    @param elem: element to be canonicalized
+    @type sink: file-like object / None type
+    @param sink: object with a write method to write output to.  If omitted
+    the output is returned as a string
+    @type exclusive: bool
+    @param exclusive: set to True for Exclusive XML Canonicalization
+    @type inclusiveNamespaces: iterable / None type
+    @param inclusiveNamespaces: for exclusive canonicalization, prefixes of 
+    namespaces to treat as for inclusive canonicalization - the 
+    InclusiveNamespaces PrefixList
+    @type backend: basestring / None type
+    @param backend: name of the backend to use from C14N_BACKENDS.  Defaults
+    to the preferred one for the type of element
+    @param kw: additional ElementC14N keywords.  If set, the ElementC14N 
+    backend is selected by default
+    @raise NotImplementedError: the backend is not available or doesn't
+    support the keywords given
+    @rtype: basestring / None type
+    @return: canonicalised output or None if a sink was given
+    '''
+    # Allow for the ElementC14N keyword
+    if inclusiveNamespaces is None:
+        inclusiveNamespaces = kw.pop('inclusive_namespaces', None)
+        
+    if inclusiveNamespaces is not None:
+        inclusiveNamespaces = list(inclusiveNamespaces)
+        
+    if kw and backend is None:
+        backend = 'ElementC14N'
+        
+    backends = dict(C14N_BACKENDS)
+    if backend is None:
+        backend = _getDefaultC14NBackend(elem)
+        
+    elif backend not in backends:
+        raise NotImplementedError('Canonicalization backend %r is not '
+                                  'available' % backend)
+    
+    if sink is None:
+        f = StringIO()
+        backends[backend](elem, f, exclusive, inclusiveNamespaces, **kw)
+        return f.getvalue()
+    
+    backends[backend](elem, sink, exclusive, inclusiveNamespaces, **kw)
 
 
 def prettyPrint(*arg, **kw):
@@ -136,36 +277,67 @@ def prettyPrint(*arg, **kw):
     @type arg: tuple
     @param kw: keyword arguments to pretty print function
     @type kw: dict
+    @return: pretty print format for doc
+    @rtype: basestring       
     '''
-    
-    # Keep track of namespace declarations made so they're not repeated
-    declaredNss = []
-    if not Config.use_lxml:
-        mappedPrefixes = dict.fromkeys(ElementTree._namespace_map.values(), True)
-        namespace_map_backup = ElementTree._namespace_map.copy()
-    else:
-        mappedPrefixes = {}
+    return ''.join(iterPrettyPrint(*arg, **kw))
+
 
-    _prettyPrint = _PrettyPrint(declaredNss, mappedPrefixes)
-    result = _prettyPrint(*arg, **kw)
+def iterPrettyPrint(elem, indent='', html=0, space=' '*4):
+    '''Generator variant of prettyPrint yielding the output in fragments.  
+    Use to stream large documents e.g. to a log handler without building
+    the whole output string first
+    
+    @param elem: ElementTree element
+    @type elem: ElementTree.Element
+    @param indent: set indent for output
+    @type indent: basestring
+    @param space: set output spacing
+    @type space: basestring 
+    @return: pretty print output fragments
+    @rtype: generator
+    '''
+    # Prefixes allocated for namespaces not in the ElementTree namespace map
+    # are held locally for this call rather than added to the global map
+    return _PrettyPrint().iterFragments(elem, indent=indent, space=space)
 
-    if not Config.use_lxml:
-        ElementTree._namespace_map = namespace_map_backup
 
-    return result
+def writePrettyPrint(elem, sink, **kw):
+    '''Pretty print to a file-like object or a list
+    
+    @param elem: ElementTree element
+    @type elem: ElementTree.Element
+    @param sink: object with a write method or list to append output 
+    fragments to
+    @type sink: file-like object / list
+    @param kw: keyword arguments to iterPrettyPrint
+    @type kw: dict
+    '''
+    write = getattr(sink, 'write', None)
+    if write is None:
+        write = sink.append
+        
+    for fragment in iterPrettyPrint(elem, **kw):
+        write(fragment)
 
 
 class _PrettyPrint(object):
-    '''Class for lightweight pretty printing of ElementTree elements'''
+    '''Class for lightweight pretty printing of ElementTree elements.  The 
+    tree is walked in a single pass with an explicit stack and the output 
+    produced as a sequence of fragments so that time is linear in the size
+    of the document'''
     MAX_NS_TRIES = 256
-    def __init__(self, declaredNss, mappedPrefixes):
+    def __init__(self, declaredNss=None, mappedPrefixes=None):
         """
-        @param declaredNss: declared namespaces
+        @param declaredNss: namespaces already declared in the output
         @type declaredNss: iterable of string elements
-        @param mappedPrefixes: map of namespace URIs to prefixes
+        @param mappedPrefixes: map of namespace URIs to prefixes allocated
+        for namespaces not set in the ElementTree namespace map
         @type mappedPrefixes: map of string to string
         """
-        self.declaredNss = declaredNss
+        self.declaredNss = set(declaredNss or ())
+        if mappedPrefixes is None:
+            mappedPrefixes = {}
         self.mappedPrefixes = mappedPrefixes
     
     @staticmethod
@@ -184,9 +356,7 @@ class _PrettyPrint(object):
             return str(elem).strip()
         
     def __call__(self, elem, indent='', html=0, space=' '*4):
-        '''Most of the work done in this wrapped function - wrapped so that
-        state can be maintained for declared namespace declarations during
-        recursive calls using "declaredNss" above
+        '''Pretty print an element
         
         @param elem: ElementTree element
         @type elem: ElementTree.Element
@@ -196,7 +366,64 @@ class _PrettyPrint(object):
         @type space: basestring 
         @return: pretty print format for doc
         @rtype: basestring       
-        '''  
+        '''
+        return ''.join(self.iterFragments(elem, indent=indent, space=space))
+    
+    def iterFragments(self, elem, indent='', space=' '*4):
+        '''Walk the tree yielding output fragments.  Namespaces declared are
+        tracked with a stack of the sets declared by each open element so 
+        that declarations are repeated only outside of their scope
+        
+        @param elem: ElementTree element
+        @type elem: ElementTree.Element
+        @param indent: set indent for output
+        @type indent: basestring
+        @param space: set output spacing
+        @type space: basestring 
+        @return: pretty print output fragments
+        @rtype: generator
+        '''
+        startTag, tag, nss = self._startTag(elem, indent)
+        yield startTag
+        if not len(elem):
+            yield '</%s>' % tag
+            self.declaredNss.difference_update(nss)
+            return
+        
+        # Stack of open elements: (element, indent, iterator over remaining
+        # children, prefixed tag, namespaces declared by element)
+        stack = [(elem, indent, iter(elem), tag, nss)]
+        while stack:
+            parent, parentIndent, children, tag, nss = stack[-1]
+            childIndent = parentIndent + space
+            for child in children:
+                startTag, childTag, childNss = self._startTag(child, 
+                                                              childIndent)
+                yield '\n' + startTag
+                if len(child):
+                    stack.append((child, childIndent, iter(child), childTag,
+                                  childNss))
+                    break
+                
+                yield '</%s>' % childTag
+                self.declaredNss.difference_update(childNss)
+            else:
+                stack.pop()
+                yield '\n%s%s</%s>' % (parentIndent,
+                                       _PrettyPrint.estrip(parent[-1].tail),
+                                       tag)
+                self.declaredNss.difference_update(nss)
+                
+    def _startTag(self, elem, indent):
+        '''Make the start tag for an element together with its text content
+        
+        @return: start tag, prefixed tag name and the set of namespaces 
+        declared with the start tag
+        @rtype: tuple
+        '''
+        declaredNss = self.declaredNss
+        nss = set()
+        
         strAttribs = []
         for attr, attrVal in elem.attrib.items():
             nsDeclaration = ''
@@ -207,9 +434,10 @@ class _PrettyPrint(object):
                 
                 attr = "%s:%s" % (nsPrefix, QName.getLocalPart(attr))
                 
-                if attrNamespace not in self.declaredNss:
+                if attrNamespace not in declaredNss:
                     nsDeclaration = ' xmlns:%s="%s"' % (nsPrefix,attrNamespace)
-                    self.declaredNss.append(attrNamespace)
+                    declaredNss.add(attrNamespace)
+                    nss.add(attrNamespace)
                 
             strAttribs.append('%s %s="%s"' % (nsDeclaration, attr, attrVal))
             
@@ -220,32 +448,17 @@ class _PrettyPrint(object):
             
         tag = "%s:%s" % (nsPrefix, QName.getLocalPart(elem.tag))
         
-        # Put in namespace declaration if one doesn't already exist
-        # FIXME: namespace declaration handling is wrong for handling child
-        # element scope
-        if namespace in self.declaredNss:
+        # Put in namespace declaration if one isn't already in scope
+        if namespace in declaredNss:
             nsDeclaration = ''
         else:
             nsDeclaration = ' xmlns:%s="%s"' % (nsPrefix, namespace)
-            self.declaredNss.append(namespace)
+            declaredNss.add(namespace)
+            nss.add(namespace)
             
-        result = '%s<%s%s%s>%s' % (indent, tag, nsDeclaration, strAttrib, 
-                                   _PrettyPrint.estrip(elem.text))
-        
-        children = len(elem)
-        if children:
-            for child in elem:
-                declaredNss = self.declaredNss[:]
-                _prettyPrint = _PrettyPrint(declaredNss, self.mappedPrefixes)
-                result += '\n'+ _prettyPrint(child, indent=indent+space) 
-                
-            result += '\n%s%s</%s>' % (indent,
-                                     _PrettyPrint.estrip(child.tail),
-                                     tag)
-        else:
-            result += '</%s>' % tag
-            
-        return result
+        startTag = '%s<%s%s%s>%s' % (indent, tag, nsDeclaration, strAttrib, 
+                                     _PrettyPrint.estrip(elem.text))
+        return startTag, tag, nss
 
     if Config.use_lxml:
         def _getNamespacePrefix(self, elem, namespace):
@@ -269,17 +482,18 @@ class _PrettyPrint(object):
             nsPrefix = ElementTree._namespace_map.get(nsURI)
             if nsPrefix is not None:
                 return nsPrefix
-
+            
+            nsPrefix = self.mappedPrefixes.get(nsURI)
+            if nsPrefix is not None:
+                return nsPrefix
+            
+            usedPrefixes = set(ElementTree._namespace_map.values())
+            usedPrefixes.update(self.mappedPrefixes.values())
             for i in range(self.__class__.MAX_NS_TRIES):
                 nsPrefix = "ns%d" % i
-                if nsPrefix not in self.mappedPrefixes:
-                    ElementTree._namespace_map[nsURI] = nsPrefix
-                    self.mappedPrefixes[nsPrefix] = True
-                    break
-
-            if nsURI not in ElementTree._namespace_map:                            
-                raise KeyError('prettyPrint: error adding namespace '
-                               '"%s" to ElementTree._namespace_map' % 
-                               nsURI)   
-
-            return nsPrefix
+                if nsPrefix not in usedPrefixes:
+                    self.mappedPrefixes[nsURI] = nsPrefix
+                    return nsPrefix
+                          
+            raise KeyError('prettyPrint: error allocating a prefix for '
+                           'namespace "%s"' % nsURI)